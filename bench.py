@@ -0,0 +1,805 @@
+# Нагрузочные тесты и бенчмарки бота. Все замеры идут на временной БД,
+# рабочий bot.db не трогается.
+# Запуск: python bench.py <сценарий> [параметры], список сценариев: python bench.py -h
+import argparse
+import asyncio
+import email
+import email.policy
+import itertools
+import json
+import logging
+import os
+import random
+import statistics
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from urllib.parse import parse_qsl
+
+import h11
+
+from telegram import CallbackQuery, Update, User
+
+import bot
+
+# ================= Общие утилиты =================
+
+def use_temp_db(directory: str) -> str:
+    path = os.path.join(directory, "bench.db")
+    bot.DB_PATH = path
+    bot.storage = bot.Storage(path)
+    bot.init_db()
+    return path
+
+def make_order(i: int, user_id: int = 1) -> Dict[str, Any]:
+    return bot.assign_order_id({
+        "user_id": user_id,
+        "username": f"user{user_id}",
+        "category": "Обувь",
+        "price_yuan": 100.0 + i,
+        "commission": 1500,
+        "final_price": (100.0 + i) * 13 + 1500,
+        "order_name": f"Товар {i}",
+        "order_link": f"https://dw4.co/t/{i}",
+        "status": "создан",
+        "created_at": datetime.now().isoformat(),
+    })
+
+def percentile(values: List[float], p: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+def report(title: str, samples_ms: List[float]) -> None:
+    print(
+        f"{title}: n={len(samples_ms)} "
+        f"p50={percentile(samples_ms, 50):.2f}ms p99={percentile(samples_ms, 99):.2f}ms "
+        f"max={max(samples_ms, default=0.0):.2f}ms"
+    )
+
+async def measure_loop_lag(stop: asyncio.Event, interval: float = 0.005) -> List[float]:
+    # Задержка пробуждения event loop относительно запланированного времени
+    lags: List[float] = []
+    loop = asyncio.get_running_loop()
+    while not stop.is_set():
+        started = loop.time()
+        await asyncio.sleep(interval)
+        lags.append((loop.time() - started - interval) * 1000)
+    return lags
+
+# ================= Сценарии =================
+
+async def bench_storage(args: argparse.Namespace) -> None:
+    # Задержка event loop в покое и при насыщении записи через Storage
+    with tempfile.TemporaryDirectory() as tmp:
+        use_temp_db(tmp)
+        bot.storage.open()
+
+        stop = asyncio.Event()
+        idle = asyncio.create_task(measure_loop_lag(stop))
+        await asyncio.sleep(args.seconds)
+        stop.set()
+        report("event loop lag (idle)", await idle)
+
+        stop = asyncio.Event()
+        lag_task = asyncio.create_task(measure_loop_lag(stop))
+        written = 0
+        deadline = time.perf_counter() + args.seconds
+
+        async def writer(worker: int) -> None:
+            nonlocal written
+            i = 0
+            while time.perf_counter() < deadline:
+                await bot.db_insert_order(make_order(i, user_id=worker))
+                await bot.db_get_user_orders_page(worker, None, bot.CABINET_HISTORY_PAGE_SIZE)
+                written += 1
+                i += 1
+
+        await asyncio.gather(*(writer(w) for w in range(args.writers)))
+        stop.set()
+        report(f"event loop lag ({args.writers} writers)", await lag_task)
+        print(f"writes: {written} ({written / args.seconds:.0f}/s)")
+        bot.storage.close()
+
+async def bench_checkout(args: argparse.Namespace) -> None:
+    # Оформление корзины: по одной транзакции на позицию против одной на корзину
+    with tempfile.TemporaryDirectory() as tmp:
+        use_temp_db(tmp)
+        bot.storage.open()
+        per_item: List[float] = []
+        bulk: List[float] = []
+        for n in range(args.rounds):
+            basket = [make_order(i, user_id=n) for i in range(args.items)]
+            started = time.perf_counter()
+            for item in basket:
+                await bot.db_insert_order(item)
+            per_item.append((time.perf_counter() - started) * 1000)
+
+            basket = [make_order(i, user_id=n) for i in range(args.items)]
+            started = time.perf_counter()
+            await bot.db_checkout_basket(n, basket)
+            bulk.append((time.perf_counter() - started) * 1000)
+        report(f"per-item inserts ({args.items} items)", per_item)
+        report(f"db_checkout_basket ({args.items} items)", bulk)
+        print(f"speedup p50: {statistics.median(per_item) / statistics.median(bulk):.1f}x")
+        bot.storage.close()
+
+STATUSES: List[str] = ["создан", "на_подтверждении", "оплачен", "выкуплен", "прибыл", "доставлен"]
+
+def seed_orders(conn: Any, rows: int, users: int, batch: int = 50_000) -> None:
+    # Заказы с монотонным created_at, случайным пользователем и статусом
+    rng = random.Random(42)
+    start = datetime(2024, 1, 1)
+    for offset in range(0, rows, batch):
+        chunk = []
+        for i in range(offset, min(offset + batch, rows)):
+            order = make_order(i, user_id=rng.randrange(users))
+            order["status"] = rng.choice(STATUSES)
+            order["created_at"] = (start + timedelta(seconds=i * 30)).isoformat()
+            chunk.append(bot._order_row(order))
+        conn.executemany(bot.INSERT_ORDER_SQL, chunk)
+        conn.commit()
+    conn.executemany(
+        "INSERT OR IGNORE INTO users (user_id, referral_code, bonus) VALUES (?, ?, 0)",
+        ((u, f"REF{u:07d}") for u in range(users))
+    )
+    conn.commit()
+
+def time_query(conn: Any, sql: str, params_list: List[tuple]) -> List[float]:
+    samples = []
+    for params in params_list:
+        started = time.perf_counter()
+        conn.execute(sql, params).fetchall()
+        samples.append((time.perf_counter() - started) * 1000)
+    return samples
+
+async def bench_indexes(args: argparse.Namespace) -> None:
+    # Латентность выборок по orders/users до и после миграции с индексами
+    with tempfile.TemporaryDirectory() as tmp:
+        use_temp_db(tmp)
+        conn = bot.get_db_connection()
+        for index in ("idx_orders_user_id", "idx_orders_status_created_at", "idx_users_referral_code"):
+            conn.execute(f"DROP INDEX IF EXISTS {index}")
+        started = time.perf_counter()
+        seed_orders(conn, args.rows, args.users)
+        print(f"seeded {args.rows} orders / {args.users} users in {time.perf_counter() - started:.1f}s")
+
+        rng = random.Random(7)
+        queries = {
+            "orders by user_id": (
+                "SELECT * FROM orders WHERE user_id=?",
+                [(rng.randrange(args.users),) for _ in range(args.queries)],
+            ),
+            "orders by status, created_at": (
+                "SELECT * FROM orders WHERE status=? AND created_at>=? ORDER BY created_at LIMIT 50",
+                [(rng.choice(STATUSES), datetime(2024, 1, 1 + rng.randrange(28)).isoformat())
+                 for _ in range(args.queries)],
+            ),
+            "users by referral_code": (
+                "SELECT user_id FROM users WHERE referral_code=?",
+                [(f"REF{rng.randrange(args.users):07d}",) for _ in range(args.queries)],
+            ),
+        }
+        before = {name: time_query(conn, sql, params) for name, (sql, params) in queries.items()}
+        conn.isolation_level = None
+        conn.execute("BEGIN")
+        bot._migrate_indexes(conn)
+        conn.execute("COMMIT")
+        conn.execute("ANALYZE")
+        for name, (sql, params) in queries.items():
+            report(f"{name} без индекса", before[name])
+            report(f"{name} с индексом", time_query(conn, sql, params))
+        conn.close()
+
+async def bench_bonus(args: argparse.Namespace) -> None:
+    # Параллельные списания бонусов одного пользователя из двух «процессов»
+    # (два независимых Storage над одной БД): баланс не должен уйти в минус
+    with tempfile.TemporaryDirectory() as tmp:
+        path = use_temp_db(tmp)
+        second = bot.Storage(path)
+        user_id, balance, debit = 1, 1000, 300
+        await bot.db_change_bonus(user_id, balance, "стартовый баланс")
+
+        async def redeem(storage: bot.Storage, i: int) -> bool:
+            try:
+                await storage.write(bot._checkout_basket, user_id, [make_order(i, user_id)], debit, "БОНУС", debit)
+                return True
+            except ValueError:
+                return False
+
+        started = time.perf_counter()
+        results = await asyncio.gather(*(
+            redeem(bot.storage if i % 2 else second, i) for i in range(args.writers)
+        ))
+        elapsed = time.perf_counter() - started
+        user = await bot.db_get_user(user_id)
+        mismatches = await bot.db_audit_bonus_balances()
+        succeeded = sum(results)
+        print(f"{args.writers} параллельных списаний по {debit}₽ с баланса {balance}₽ за {elapsed * 1000:.0f}ms")
+        print(f"успешно: {succeeded}, отклонено: {len(results) - succeeded}, остаток: {user['bonus']}₽")
+        assert user["bonus"] >= 0, "баланс ушёл в минус"
+        assert succeeded == balance // debit, "списано больше, чем было бонусов"
+        assert not mismatches, f"баланс разошёлся с журналом: {[dict(r) for r in mismatches]}"
+        print("OK: баланс неотрицателен и совпадает с журналом")
+        second.close()
+        bot.storage.close()
+
+async def bench_export(args: argparse.Namespace) -> None:
+    # Потоковая выгрузка orders в .csv.gz: скорость и пик памяти Python
+    # (tracemalloc) — он не должен расти вместе с числом строк
+    with tempfile.TemporaryDirectory() as tmp:
+        use_temp_db(tmp)
+        conn = bot.get_db_connection()
+        started = time.perf_counter()
+        seed_orders(conn, args.rows, args.users)
+        conn.execute("ANALYZE")
+        conn.close()
+        print(f"seeded {args.rows} orders / {args.users} users in {time.perf_counter() - started:.1f}s")
+
+        cases = {
+            "все заказы": {},
+            "status": {"status": STATUSES[0]},
+            "status + месяц": {"status": STATUSES[0], "date_from": "2024-02-01", "date_to": "2024-03-01"},
+            "user": {"user_id": 1},
+        }
+        output = os.path.join(tmp, "orders.csv.gz")
+        for name, conditions in cases.items():
+            started = time.perf_counter()
+            rows = await bot.db_export_orders(output, **conditions)
+            elapsed = time.perf_counter() - started
+            size_mb = os.path.getsize(output) / 1024 / 1024
+            print(f"{name}: {rows} строк за {elapsed:.2f}s ({rows / elapsed:.0f} строк/s), {size_mb:.1f} МБ")
+
+        tracemalloc.start()
+        rows = await bot.db_export_orders(output)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f"пик памяти Python при выгрузке {rows} строк: {peak / 1024 / 1024:.1f} МБ")
+        bot.storage.close()
+
+def synthetic_update(update_id: int, user_id: int, text: str = "/start") -> Dict[str, Any]:
+    user = {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"}
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": user,
+            "text": text,
+        },
+    }
+
+async def post_json(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, path: str,
+                    payload: Dict[str, Any], secret: str) -> int:
+    # Минимальный HTTP/1.1 клиент с keep-alive, чтобы замер не упирался в клиент
+    body = json.dumps(payload).encode()
+    writer.write(
+        f"POST {path} HTTP/1.1\r\nHost: localhost\r\nContent-Type: application/json\r\n"
+        f"X-Telegram-Bot-Api-Secret-Token: {secret}\r\nContent-Length: {len(body)}\r\n\r\n".encode() + body
+    )
+    await writer.drain()
+    head = await reader.readuntil(b"\r\n\r\n")
+    return int(head.split(b" ", 2)[1])
+
+async def bench_webhook(args: argparse.Namespace) -> None:
+    # Пропускная способность вебхука: POST синтетических Update в локальный сервер.
+    # Обработчики не запускаются — очередь Application вычитывается отдельной задачей.
+    with tempfile.TemporaryDirectory() as tmp:
+        use_temp_db(tmp)
+        application = bot.build_application(bot.Application.builder().updater(None))
+        secret = "bench-secret"
+        server = bot.WebhookServer(application, "/telegram", secret, "127.0.0.1", 0,
+                                   max_pending=args.updates + 1)
+        await server.start()
+        received = 0
+
+        async def consume() -> None:
+            nonlocal received
+            while True:
+                await application.update_queue.get()
+                received += 1
+
+        consumer = asyncio.create_task(consume())
+        reader, writer = await asyncio.open_connection("127.0.0.1", server.port)
+        print(f"неверный секрет -> {await post_json(reader, writer, '/telegram', synthetic_update(0, 1), 'wrong')}")
+        writer.close()
+
+        latencies: List[float] = []
+        statuses: Dict[int, int] = {}
+        counter = iter(range(args.updates))
+
+        async def sender() -> None:
+            reader, writer = await asyncio.open_connection("127.0.0.1", server.port)
+            for i in counter:
+                started = time.perf_counter()
+                status = await post_json(reader, writer, "/telegram", synthetic_update(i + 1, i % 1000), secret)
+                latencies.append((time.perf_counter() - started) * 1000)
+                statuses[status] = statuses.get(status, 0) + 1
+            writer.close()
+
+        started = time.perf_counter()
+        await asyncio.gather(*(sender() for _ in range(args.writers)))
+        elapsed = time.perf_counter() - started
+        await server.stop()
+        while received < statuses.get(200, 0):
+            await asyncio.sleep(0.01)
+        consumer.cancel()
+        report(f"POST /telegram ({args.writers} соединений)", latencies)
+        print(f"ответы: {statuses}, в очереди: {received}, {args.updates / elapsed:.0f} updates/s")
+        bot.storage.close()
+
+# Разбор callback_data в формате до CALLBACK_ROUTES: цепочка regex-обработчиков
+# в порядке регистрации и разбор строки внутри выбранного обработчика
+LEGACY_CALLBACK_PATTERNS = [
+    r"^(cabinet_history(:\d+)?|referral_program|new_calc_cabinet|personal_cabinet)$",
+    r"^(admin_main|admin_menu_promos|admin_menu_analytics)$",
+    r"^(admin_menu_orders|admin_orders_list|admin_orders:.+)$",
+    r"^admin_orders_filter:[sc]:\S+:\S+$",
+    r"^admin_order:\S+",
+    r"^update:\d+:\d+$",
+    r"^confirm_payment$",
+]
+
+def legacy_parse(index: int, data: str) -> Any:
+    if index == 0:
+        if data.startswith("cabinet_history"):
+            _, _, before = data.partition(":")
+            return int(before) if before.isdigit() else None
+        return data
+    if index == 2:
+        parts = data.split(":", 4)
+        if len(parts) < 5:
+            return None
+        _, mode, status_idx, category_idx, key = parts
+        return mode, status_idx, category_idx, int(key) if key.isdigit() else None
+    if index == 3:
+        return data.split(":", 3)
+    if index == 4:
+        ref = data.split(":", 1)[1]
+        return int(ref) if ref.isdigit() else ref
+    if index == 5:
+        _, key, status_idx = data.split(":")
+        return int(key), int(status_idx)
+    return data
+
+def callback_update(i: int, data: str) -> Any:
+    user = User(i, f"user{i}", False)
+    return Update(i, callback_query=CallbackQuery(str(i), user, "bench", data=data))
+
+async def bench_callbacks(args: argparse.Namespace) -> None:
+    # Стоимость выбора обработчика кнопки: проверка CallbackQueryHandler по
+    # порядку регистрации плюс разбор аргументов. Сетевые вызовы не участвуют.
+    key = bot.order_keys.next()
+    legacy_data = [
+        "personal_cabinet", "cabinet_history", f"cabinet_history:{key}", "admin_main",
+        "admin_menu_analytics", "admin_menu_orders", f"admin_orders:n:2:-:{key}",
+        "admin_orders_filter:s:2:-", f"admin_order:{key}", f"update:{key}:3", "confirm_payment",
+    ]
+    encoded_data = [
+        bot.encode_callback(bot.CB_PERSONAL_CABINET), bot.encode_callback(bot.CB_CABINET_HISTORY, None),
+        bot.encode_callback(bot.CB_CABINET_HISTORY, key), bot.encode_callback(bot.CB_ADMIN_MAIN),
+        bot.encode_callback(bot.CB_ADMIN_ANALYTICS), bot.orders_page_data(bot.ORDERS_PAGE_FIRST),
+        bot.orders_page_data(bot.ORDERS_PAGE_OLDER, 2, None, key),
+        bot.encode_callback(bot.CB_ADMIN_ORDERS_FILTER, bot.ORDERS_FILTER_STATUS, 2, None),
+        bot.encode_callback(bot.CB_ADMIN_ORDER, key), bot.encode_callback(bot.CB_ORDER_STATUS, key, 3),
+        bot.encode_callback(bot.CB_CONFIRM_PAYMENT),
+    ]
+    print("длина callback_data: " + ", ".join(f"{old!r}={len(old)} -> {len(new)}"
+                                               for old, new in zip(legacy_data, encoded_data)))
+
+    async def noop(update: Any, context: Any) -> None:
+        pass
+
+    legacy_handlers = [bot.CallbackQueryHandler(noop, pattern=p) for p in LEGACY_CALLBACK_PATTERNS]
+    legacy_updates = [callback_update(i, d) for i, d in enumerate(legacy_data)]
+    dispatcher = bot.CallbackQueryHandler(noop, pattern=bot.is_encoded_callback)
+    encoded_updates = [callback_update(i, d) for i, d in enumerate(encoded_data)]
+
+    def legacy_dispatch(update: Any) -> Any:
+        for index, handler in enumerate(legacy_handlers):
+            if handler.check_update(update):
+                return legacy_parse(index, update.callback_query.data)
+        raise AssertionError(update.callback_query.data)
+
+    def table_dispatch(update: Any) -> Any:
+        if dispatcher.check_update(update):
+            resolved = bot.resolve_callback(update.callback_query.data)
+            if resolved is not None:
+                return resolved
+        raise AssertionError(update.callback_query.data)
+
+    for name, dispatch, updates in (("regex-цепочка", legacy_dispatch, legacy_updates),
+                                    ("CALLBACK_ROUTES", table_dispatch, encoded_updates)):
+        per_update: List[float] = []
+        for update in updates:
+            started = time.perf_counter_ns()
+            for _ in range(args.iterations):
+                dispatch(update)
+            per_update.append((time.perf_counter_ns() - started) / args.iterations)
+        worst = max(zip(per_update, (u.callback_query.data for u in updates)))
+        print(f"{name}: среднее {statistics.mean(per_update):.0f} нс/кнопку, "
+              f"худшее {worst[0]:.0f} нс ({worst[1]!r})")
+
+SEARCH_BRANDS: List[Tuple[str, List[str]]] = [
+    ("Nike", ["Air Max 90", "Air Force 1", "Dunk Low", "Blazer Mid", "Pegasus 40"]),
+    ("Jordan", ["Air Jordan 1 High", "Air Jordan 4 Retro", "Jordan 11 Low"]),
+    ("Adidas", ["Samba OG", "Gazelle", "Yeezy Boost 350", "Forum Low", "Ultraboost"]),
+    ("New Balance", ["550", "990v6", "2002R", "9060"]),
+    ("Asics", ["Gel-Kayano 14", "Gel-1130", "GT-2160"]),
+    ("The North Face", ["Nuptse 1996", "Denali", "Mountain Light"]),
+    ("Stone Island", ["Ghost Piece", "Crinkle Reps", "Soft Shell-R"]),
+    ("Apple", ["AirPods Pro 2", "iPhone 15 Pro", "Watch Ultra 2"]),
+]
+SEARCH_COLORS: List[str] = ["белые", "чёрные", "серые", "Panda", "Triple White", "Bred", "бежевые", "оливковые"]
+SEARCH_NAMES: List[str] = ["ivan", "anna", "dmitry", "olga", "sergey", "maria", "alex", "kate", "nikita", "polina"]
+
+def seed_search_orders(conn: Any, rows: int, users: int, batch: int = 50_000) -> List[Dict[str, Any]]:
+    # Заказы с правдоподобными названиями, ссылками и username; вставка идёт
+    # через INSERT_ORDER_SQL, так что orders_fts заполняют триггеры _migrate_order_search.
+    # Возвращает выборку заказов, по которой строятся запросы
+    rng = random.Random(42)
+    alphabet = "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789"
+    usernames = [f"{rng.choice(SEARCH_NAMES)}_{rng.choice(SEARCH_NAMES)}{u}" for u in range(users)]
+    sample: List[Dict[str, Any]] = []
+    for offset in range(0, rows, batch):
+        chunk = []
+        for i in range(offset, min(offset + batch, rows)):
+            user_id = rng.randrange(users)
+            brand, models = rng.choice(SEARCH_BRANDS)
+            order = make_order(i, user_id=user_id)
+            order["username"] = usernames[user_id]
+            order["order_name"] = f"{brand} {rng.choice(models)} {rng.choice(SEARCH_COLORS)} {rng.randrange(36, 47)}"
+            order["order_link"] = f"https://dw4.co/t/A/{''.join(rng.choice(alphabet) for _ in range(10))}"
+            order["status"] = rng.choice(STATUSES)
+            chunk.append(bot._order_row(order))
+            if rng.random() < 0.001:
+                sample.append(order)
+        conn.executemany(bot.INSERT_ORDER_SQL, chunk)
+        conn.commit()
+    return sample
+
+async def bench_find(args: argparse.Namespace) -> None:
+    # /find: orders_fts против LIKE '%…%' по тем же четырём столбцам
+    with tempfile.TemporaryDirectory() as tmp:
+        use_temp_db(tmp)
+        conn = bot.get_db_connection()
+        started = time.perf_counter()
+        sample = seed_search_orders(conn, args.rows, args.users)
+        print(f"seeded {args.rows} orders (с триггерами orders_fts) in {time.perf_counter() - started:.1f}s")
+        # dbstat есть не в каждой сборке SQLite
+        if conn.execute("SELECT 1 FROM pragma_module_list WHERE name='dbstat'").fetchone():
+            for title, pattern in (("таблица orders", "orders"), ("индекс orders_fts", "orders_fts%")):
+                size = conn.execute("SELECT SUM(pgsize) FROM dbstat WHERE name LIKE ?", (pattern,)).fetchone()[0]
+                print(f"{title}: {size / 1024 / 1024:.0f} МБ")
+
+        rng = random.Random(7)
+        picks = [rng.choice(sample) for _ in range(args.queries)]
+        searches = {
+            "order_id целиком": [o["order_id"] for o in picks],
+            "order_id, префикс 6 символов": [o["order_id"][:6] for o in picks],
+            "username целиком": [o["username"] for o in picks],
+            "username, префикс": [o["username"].split("_")[0][:4] for o in picks],
+            "бренд + модель": [" ".join(o["order_name"].split()[:3]) for o in picks],
+            "модель + цвет + размер": [" ".join(o["order_name"].split()[1:]) for o in picks],
+            "фрагмент ссылки": [o["order_link"].rsplit("/", 1)[1][:7] for o in picks],
+        }
+        like_sql = (
+            "SELECT id, order_id, order_name, username, status, created_at FROM orders "
+            "WHERE order_name LIKE ?1 OR order_link LIKE ?1 OR username LIKE ?1 OR order_id LIKE ?1 "
+            "ORDER BY id DESC LIMIT ?2"
+        )
+        for name, texts in searches.items():
+            samples = []
+            found = 0
+            for text in texts:
+                started = time.perf_counter()
+                rows = bot._search_orders(conn, bot.order_search_terms(text), bot.FIND_RESULTS_LIMIT)
+                samples.append((time.perf_counter() - started) * 1000)
+                found += bool(rows)
+            report(f"orders_fts: {name}", samples)
+            example = bot.order_search_query(bot.order_search_terms(texts[0]))
+            print(f"  найдено для {found}/{len(texts)} запросов, пример: {texts[0]!r} -> {example}")
+            # LIKE перебирает всю таблицу, хватает нескольких замеров
+            report(f"LIKE: {name}", time_query(conn, like_sql, [(f"%{t}%", bot.FIND_RESULTS_LIMIT) for t in texts[:3]]))
+        conn.close()
+
+# ================= Сквозной тест с имитацией Bot API =================
+
+# Локальная замена api.telegram.org для Application из bot.py: getUpdates
+# отдаёт обновления, которые кладут симулированные пользователи, методы
+# отправки и редактирования возвращают правдоподобные Message, getFile и
+# скачивание файлов нужны архиву фото. Каждый вызов проверяется ожиданиями
+# пользователей (expect), так измеряется время от обновления до ответа бота.
+class FakeBotApi:
+    BOT_USER = {"id": 1, "is_bot": True, "first_name": "BenchBot", "username": "bench_bot"}
+
+    def __init__(self) -> None:
+        self.updates: List[Dict[str, Any]] = []
+        self._new_updates = asyncio.Condition()
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        self._waiters: Dict[int, Tuple[Callable[[str, Dict[str, Any]], bool], asyncio.Future]] = {}
+        self.last_message: Dict[int, Dict[str, Any]] = {}
+        self.calls: Dict[str, int] = {}
+        self._server: Optional[asyncio.base_events.Server] = None
+        self.port = 0
+
+    async def start(self) -> None:
+        self._server = await asyncio.start_server(self._handle_connection, "127.0.0.1", 0)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def stop(self) -> None:
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+
+    async def push(self, update: Dict[str, Any]) -> None:
+        update["update_id"] = next(self._update_ids)
+        async with self._new_updates:
+            self.updates.append(update)
+            self._new_updates.notify_all()
+
+    # Ожидание вызова Bot API в чат chat_id, для которого match вернёт True
+    def expect(self, chat_id: int, match: Callable[[str, Dict[str, Any]], bool]) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        self._waiters[chat_id] = (match, future)
+        return future
+
+    def _message(self, chat_id: int, **fields: Any) -> Dict[str, Any]:
+        message = {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": self.BOT_USER,
+            **fields,
+        }
+        self.last_message[chat_id] = message
+        return message
+
+    @staticmethod
+    def _photo(file_id: str) -> List[Dict[str, Any]]:
+        return [{"file_id": file_id, "file_unique_id": file_id[-16:], "width": 800, "height": 600}]
+
+    async def _get_updates(self, params: Dict[str, Any]) -> List[Dict[str, Any]]:
+        offset = int(params.get("offset", 0))
+        limit = int(params.get("limit", 100))
+        timeout = float(params.get("timeout", 0))
+        async with self._new_updates:
+            self.updates = [u for u in self.updates if u["update_id"] >= offset]
+            if not self.updates and timeout:
+                try:
+                    await asyncio.wait_for(self._new_updates.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+            return self.updates[:limit]
+
+    async def _call(self, method: str, params: Dict[str, Any]) -> Any:
+        if method == "getUpdates":
+            return await self._get_updates(params)
+        if method == "getMe":
+            return self.BOT_USER
+        if method in ("deleteWebhook", "answerCallbackQuery", "setWebhook"):
+            return True
+        if method == "getFile":
+            return {"file_id": params["file_id"], "file_unique_id": params["file_id"][-16:],
+                    "file_size": 1024, "file_path": f"photos/{params['file_id']}.jpg"}
+        chat_id = int(params.get("chat_id", 0))
+        if method == "sendMessage":
+            return self._message(chat_id, text=params.get("text", ""))
+        if method == "sendPhoto":
+            photo = params.get("photo")
+            file_id = photo if isinstance(photo, str) and not photo.startswith("attach://") else f"upload-{next(self._message_ids)}"
+            return self._message(chat_id, photo=self._photo(file_id), caption=params.get("caption", ""))
+        if method == "sendMediaGroup":
+            return [self._message(chat_id, photo=self._photo(f"group-{next(self._message_ids)}"))
+                    for _ in json.loads(params.get("media", "[]"))]
+        if method in ("editMessageText", "editMessageCaption", "editMessageReplyMarkup"):
+            message = dict(self.last_message.get(chat_id) or self._message(chat_id))
+            message.update({k: params[k] for k in ("text", "caption") if k in params})
+            return message
+        return True
+
+    @staticmethod
+    def _parse_body(content_type: str, body: bytes) -> Dict[str, Any]:
+        if content_type.startswith("multipart/"):
+            message = email.message_from_bytes(
+                f"Content-Type: {content_type}\r\n\r\n".encode() + body, policy=email.policy.HTTP
+            )
+            params = {}
+            for part in message.iter_parts():
+                name = part.get_param("name", header="content-disposition")
+                params[name] = "attach://file" if part.get_filename() else part.get_payload(decode=True).decode()
+            return params
+        return dict(parse_qsl(body.decode()))
+
+    async def _respond(self, target: str, content_type: str, body: bytes) -> Tuple[str, bytes]:
+        if target.startswith("/file/"):
+            return "image/jpeg", target.encode() * 16
+        method = target.rsplit("/", 1)[-1]
+        params = self._parse_body(content_type, body)
+        self.calls[method] = self.calls.get(method, 0) + 1
+        result = await self._call(method, params)
+        chat_id = int(params.get("chat_id", 0) or 0)
+        waiter = self._waiters.get(chat_id)
+        if waiter is not None and waiter[0](method, params):
+            del self._waiters[chat_id]
+            if not waiter[1].done():
+                waiter[1].set_result(time.perf_counter())
+        return "application/json", json.dumps({"ok": True, "result": result}, ensure_ascii=False).encode()
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        conn = h11.Connection(h11.SERVER)
+        try:
+            while True:
+                request = None
+                body = b""
+                while True:
+                    event = conn.next_event()
+                    if event is h11.NEED_DATA:
+                        data = await reader.read(65536)
+                        if not data:
+                            return
+                        conn.receive_data(data)
+                    elif isinstance(event, h11.Request):
+                        request = event
+                    elif isinstance(event, h11.Data):
+                        body += event.data
+                    elif isinstance(event, h11.EndOfMessage):
+                        break
+                    else:
+                        return
+                headers = dict(request.headers)
+                content_type, payload = await self._respond(
+                    request.target.decode(), headers.get(b"content-type", b"").decode(), body
+                )
+                writer.write(conn.send(h11.Response(status_code=200, headers=[
+                    ("content-type", content_type), ("content-length", str(len(payload))),
+                ])))
+                writer.write(conn.send(h11.Data(data=payload)))
+                writer.write(conn.send(h11.EndOfMessage()))
+                await writer.drain()
+                conn.start_next_cycle()
+        except (h11.ProtocolError, ConnectionError, asyncio.CancelledError):
+            # CancelledError — незавершённый long polling getUpdates при остановке
+            pass
+        finally:
+            writer.close()
+
+def user_message(user_id: int, **fields: Any) -> Dict[str, Any]:
+    user = {"id": user_id, "is_bot": False, "first_name": f"user{user_id}", "username": f"user{user_id}"}
+    message = {"message_id": random.randrange(1 << 30), "date": int(time.time()),
+               "chat": {"id": user_id, "type": "private"}, "from": user, **fields}
+    return {"message": message}
+
+def user_text(user_id: int, text: str) -> Dict[str, Any]:
+    fields: Dict[str, Any] = {"text": text}
+    if text.startswith("/"):
+        fields["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    return user_message(user_id, **fields)
+
+def user_photo(user_id: int, file_id: str) -> Dict[str, Any]:
+    return user_message(user_id, photo=FakeBotApi._photo(file_id))
+
+def user_button(api: FakeBotApi, user_id: int, data: str) -> Dict[str, Any]:
+    user = user_message(user_id)["message"]["from"]
+    message = api.last_message.get(user_id) or api._message(user_id)
+    return {"callback_query": {"id": str(random.randrange(1 << 62)), "from": user,
+                               "chat_instance": str(user_id), "data": data, "message": message}}
+
+def bot_said(methods: Tuple[str, ...], needle: str) -> Callable[[str, Dict[str, Any]], bool]:
+    def match(method: str, params: Dict[str, Any]) -> bool:
+        return method in methods and needle in (params.get("text") or params.get("caption") or "")
+    return match
+
+# Шаги полного сценария заказа: (имя, обновление от пользователя, ответ бота,
+# которым шаг считается завершённым)
+E2E_STEPS: List[Tuple[str, Callable[[FakeBotApi, int], Dict[str, Any]], Callable[[str, Dict[str, Any]], bool]]] = [
+    ("start", lambda api, uid: user_text(uid, "/start"), bot_said(("sendPhoto", "sendMessage"), "Выберите категорию")),
+    ("category_chosen", lambda api, uid: user_button(api, uid, "Обувь"), bot_said(("sendMessage",), "Введите цену")),
+    ("calculate_price", lambda api, uid: user_text(uid, str(random.randint(100, 3000))), bot_said(("sendMessage",), "Выберите действие")),
+    ("make_order", lambda api, uid: user_button(api, uid, "make_order"),
+     bot_said(("editMessageCaption", "editMessageText"), "Укажите название")),
+    ("order_name", lambda api, uid: user_text(uid, f"Кроссовки {uid}"), bot_said(("sendPhoto", "sendMessage"), "ссылку")),
+    ("order_link", lambda api, uid: user_text(uid, f"https://dw4.co/t/{uid}"), bot_said(("sendPhoto", "sendMessage"), "скриншот")),
+    ("screenshot", lambda api, uid: user_photo(uid, f"shot-{uid}"), bot_said(("sendPhoto",), "Название:")),
+    ("finish_order", lambda api, uid: user_button(api, uid, "finish_order"),
+     bot_said(("editMessageText", "sendMessage"), "промокод")),
+    ("promo", lambda api, uid: user_text(uid, "Нет"), bot_said(("sendMessage",), "квитанции")),
+    ("receipt", lambda api, uid: user_photo(uid, f"receipt-{uid}"), bot_said(("sendMessage",), "Квитанция получена")),
+]
+
+async def bench_e2e(args: argparse.Namespace) -> None:
+    # Сквозной прогон: Application из bot.py (polling, persistence, outbox,
+    # архив фото) против FakeBotApi; --clients пользователей одновременно
+    # проходят полный сценарий заказа. Общий лимит частоты снят — иначе он,
+    # а не обработчики и БД, определял бы пропускную способность.
+    with tempfile.TemporaryDirectory() as tmp:
+        use_temp_db(tmp)
+        bot.media_store.root = os.path.join(tmp, "media_archive")
+        bot.metrics_server.port = 0
+        # httpx пишет строку в лог на каждый запрос — на тысячах запросов это заметная доля времени
+        logging.getLogger("httpx").setLevel(logging.WARNING)
+        bot.rate_limiter.global_bucket = bot.TokenBucket(float("inf"), float("inf"))
+        api = FakeBotApi()
+        await api.start()
+        base = f"http://127.0.0.1:{api.port}"
+        application = bot.build_application(
+            bot.Application.builder().base_url(f"{base}/bot").base_file_url(f"{base}/file/bot"),
+            args.concurrency,
+        )
+        bot.storage.open()
+        await application.initialize()
+        await application.updater.start_polling(poll_interval=0, timeout=5)
+        await application.start()
+        await bot.on_startup(application)
+
+        latencies: Dict[str, List[float]] = {name: [] for name, _, _ in E2E_STEPS}
+        failures: Dict[str, int] = {}
+
+        async def client(user_id: int) -> None:
+            for name, make_update, done in E2E_STEPS:
+                answered = api.expect(user_id, done)
+                started = time.perf_counter()
+                await api.push(make_update(api, user_id))
+                try:
+                    finished = await asyncio.wait_for(answered, args.step_timeout)
+                except asyncio.TimeoutError:
+                    failures[name] = failures.get(name, 0) + 1
+                    return
+                latencies[name].append((finished - started) * 1000)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(client(1_000_000 + i) for i in range(args.clients)))
+        elapsed = time.perf_counter() - started
+        for name, samples in latencies.items():
+            report(name, samples)
+        updates = sum(len(samples) for samples in latencies.values()) + sum(failures.values())
+        completed = len(latencies[E2E_STEPS[-1][0]])
+        print(f"{args.clients} пользователей, завершили сценарий: {completed}, сбои по шагам: {failures or 'нет'}")
+        print(f"{updates} обновлений за {elapsed:.1f}s: {updates / elapsed:.0f} updates/s, "
+              f"{completed / elapsed:.1f} заказов/s")
+        print("вызовы Bot API: " + ", ".join(f"{m}={n}" for m, n in sorted(api.calls.items())))
+
+        await application.updater.stop()
+        await application.stop()
+        await application.shutdown()
+        await bot.on_shutdown(application)
+        await api.stop()
+
+SCENARIOS: Dict[str, Callable[[argparse.Namespace], Any]] = {
+    "storage": bench_storage,
+    "checkout": bench_checkout,
+    "indexes": bench_indexes,
+    "bonus": bench_bonus,
+    "webhook": bench_webhook,
+    "export": bench_export,
+    "callbacks": bench_callbacks,
+    "find": bench_find,
+    "e2e": bench_e2e,
+}
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Бенчмарки бота")
+    parser.add_argument("scenario", choices=sorted(SCENARIOS))
+    parser.add_argument("--seconds", type=float, default=3.0)
+    parser.add_argument("--writers", type=int, default=32)
+    parser.add_argument("--rounds", type=int, default=200)
+    parser.add_argument("--items", type=int, default=10)
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--users", type=int, default=50_000)
+    parser.add_argument("--queries", type=int, default=20)
+    parser.add_argument("--updates", type=int, default=5000)
+    parser.add_argument("--iterations", type=int, default=20_000)
+    parser.add_argument("--clients", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=bot.UPDATE_CONCURRENCY)
+    parser.add_argument("--step-timeout", type=float, default=30.0)
+    args = parser.parse_args()
+    asyncio.run(SCENARIOS[args.scenario](args))
+
+if __name__ == "__main__":
+    main()
@@ -1,27 +1,59 @@
+import argparse
+import asyncio
+import base64
+import binascii
+import bisect
+import csv
+import functools
+import gzip
+import hashlib
+import json
 import logging
+import math
+import queue
 import re
 import random
+import secrets
+import signal
 import string
 import sqlite3
-import uuid
+import sys
+import tempfile
+import threading
+import time
 import os
-from datetime import datetime
-from typing import Any, Dict, List, Optional, Set
+import urllib.parse
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, suppress
+from datetime import datetime, timedelta
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Iterator, List, Optional, Set, Tuple, TypeVar, Union
 
+import h11
 from telegram import (
     Update,
     InlineKeyboardButton,
     InlineKeyboardMarkup,
     InputMediaPhoto,
+    Message,
     ReplyKeyboardMarkup,
 )
+from telegram.error import BadRequest, Forbidden, RetryAfter, TelegramError
+from telegram.request import HTTPXRequest
 from telegram.ext import (
     Application,
+    ApplicationBuilder,
+    ApplicationHandlerStop,
+    BaseHandler,
+    BasePersistence,
+    BaseUpdateProcessor,
+    PersistenceInput,
     CommandHandler,
     CallbackQueryHandler,
     MessageHandler,
     ConversationHandler,
     ContextTypes,
+    TypeHandler,
     filters,
 )
 
@@ -40,23 +72,741 @@ logger = logging.getLogger(__name__)
 
 # Только для этих ID доступна админ-панель
 ADMIN_IDS: Set[int] = {733949485, 619771192}
+ORDER_STATUSES: List[str] = ["создан", "на_подтверждении", "оплачен", "выкуплен", "ждет отправки", "отправлен в РФ", "прибыл", "отправлен внутри РФ", "доставлен"]
+# Статусы, начиная с которых заказ считается оплаченным (для аналитики)
+PAID_STATUSES: List[str] = ["оплачен", "выкуплен", "отправлен в РФ", "прибыл", "отправлен внутри РФ", "доставлен"]
+CATEGORIES: List[str] = ["Одежда", "Обувь", "Аксессуары", "Сумки", "Часы", "Парфюм"]
+ADMIN_ORDERS_PAGE_SIZE: int = 10
+CABINET_HISTORY_PAGE_SIZE: int = 10
+ORDER_CARD_CACHE_SIZE: int = 1024
+# Сколько сводок пользователей (личный кабинет) держать в памяти
+USER_SUMMARY_CACHE_SIZE: int = 4096
+ORDERS_BATCH_SIZE: int = 500
+# Ключ заказа (orders.id) — 60-битное число, растущее со временем:
+# миллисекунды от ORDER_KEY_EPOCH_MS в старших битах и счётчик в младших.
+# Для людей показывается order_id — тот же ключ в base32 Crockford (12 символов).
+ORDER_KEY_EPOCH_MS: int = 1704067200000  # 2024-01-01 UTC
+ORDER_KEY_SEQUENCE_BITS: int = 18
+ORDER_CODE_ALPHABET: str = "0123456789ABCDEFGHJKMNPQRSTVWXYZ"
+ORDER_CODE_LENGTH: int = 12
+ANALYTICS_DAYS: int = 7
+BONUS_HISTORY_LIMIT: int = 20
+# Поиск /find: сколько заказов показывать, сколько слов запроса учитывать,
+# среди скольких самых новых совпадений ранжировать и веса столбцов в ранжировании
+FIND_RESULTS_LIMIT: int = 10
+FIND_MAX_TERMS: int = 8
+FIND_CANDIDATES: int = 200
+# Самый длинный префиксный индекс orders_fts (prefix в _migrate_order_search)
+FIND_PREFIX_MAX: int = 10
+FIND_COLUMN_WEIGHTS: Dict[str, int] = {"order_id": 20, "order_name": 10, "username": 5, "order_link": 2}
+# Вебхук (python bot.py run --webhook-url ...): адрес локального сервера и ограничения
+WEBHOOK_LISTEN: str = "127.0.0.1"
+WEBHOOK_PORT: int = 8080
+WEBHOOK_PATH: str = "/telegram"
+WEBHOOK_MAX_CONCURRENCY: int = 40
+WEBHOOK_MAX_PENDING: int = 1000
+WEBHOOK_MAX_BODY: int = 1024 * 1024
+WEBHOOK_DRAIN_TIMEOUT: float = 30.0
+# Очередь исходящих уведомлений: лимиты Telegram ~30 сообщений/с на бота и
+# ~1 сообщение/с в один чат; при ошибках — повтор с экспоненциальной задержкой
+OUTBOX_GLOBAL_RATE: float = 25.0
+OUTBOX_CHAT_RATE: float = 1.0
+OUTBOX_CHAT_BURST: int = 3
+OUTBOX_CONCURRENCY: int = 8
+OUTBOX_BATCH_SIZE: int = 100
+OUTBOX_POLL_INTERVAL: float = 1.0
+OUTBOX_MAX_ATTEMPTS: int = 8
+OUTBOX_BASE_BACKOFF: float = 2.0
+OUTBOX_MAX_BACKOFF: float = 600.0
+# Отчёт админу о массовой рассылке
+OUTBOX_PROGRESS_INTERVAL: float = 3.0
+OUTBOX_PROGRESS_TIMEOUT: float = 3600.0
+OUTBOX_PROGRESS_FAILURES: int = 20
+# /bulk_status: сколько ненайденных ID перечислять в ответе
+BULK_UNMATCHED_SHOWN: int = 20
+# Ограничение частоты входящих обновлений: (токенов в секунду, размер пачки)
+# на пользователя по типу обновления и общий лимит на всех пользователей
+RATE_LIMITS: Dict[str, Tuple[float, float]] = {
+    "command": (0.5, 5),
+    "text": (1.0, 10),
+    "photo": (0.2, 5),
+    "callback": (2.0, 15),
+}
+RATE_LIMIT_GLOBAL: Tuple[float, float] = (100.0, 200)
+RATE_LIMIT_MAX_USERS: int = 10000
+# Не чаще одного предупреждения «слишком часто» за это время
+RATE_LIMIT_WARN_INTERVAL: float = 10.0
+# Обработка входящих обновлений: до UPDATE_CONCURRENCY одновременно, но
+# обновления одного пользователя (чата) — строго по очереди. UPDATE_MAX_PENDING
+# ограничивает число принятых, но ещё не обработанных обновлений.
+UPDATE_CONCURRENCY: int = 32
+UPDATE_MAX_PENDING: int = 10000
+# Как часто PTB сбрасывает изменённые user_data/chat_data/состояния диалога в хранилище
+PERSISTENCE_UPDATE_INTERVAL: float = 5.0
+TELEGRAM_MESSAGE_LIMIT: int = 4096
+# Бот может отправить документ не больше 50 МБ
+TELEGRAM_DOCUMENT_LIMIT: int = 50 * 1024 * 1024
+# Выгрузка заказов: строк за один fetchmany и уровень сжатия gzip
+EXPORT_CHUNK_SIZE: int = 5000
+EXPORT_GZIP_LEVEL: int = 6
 DB_PATH: str = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bot.db")
+# Архив скриншотов и квитанций: каждое фото скачивается один раз и хранится
+# под своим sha256 в MEDIA_ARCHIVE_DIR/ab/cd/<хэш>
+MEDIA_ARCHIVE_DIR: str = os.path.join(os.path.dirname(os.path.abspath(__file__)), "media_archive")
+MEDIA_ARCHIVE_CONCURRENCY: int = 4
+MEDIA_ARCHIVE_BATCH_SIZE: int = 50
+MEDIA_ARCHIVE_MAX_ATTEMPTS: int = 8
+# Своя политика повторов, независимая от Outbox: архив не срочный, поэтому
+# опрашиваем реже и после сбоев ждём дольше
+MEDIA_ARCHIVE_POLL_INTERVAL: float = 5.0
+MEDIA_ARCHIVE_BASE_BACKOFF: float = 10.0
+MEDIA_ARCHIVE_MAX_BACKOFF: float = 3600.0
 
-# Промокоды и реферальные данные (в памяти)
-promo_codes: Dict[str, Dict[str, Any]] = {}
-referral_usage: Dict[str, Any] = {}
+# Промокоды хранятся в БД (promo_codes, promo_redemptions), см. раздел «Промокоды»
+PROMO_TYPES: Tuple[str, ...] = ("one-time", "multi")
+PROMO_CACHE_TTL: float = 60.0
+REFERRAL_DISCOUNT: int = 300
+
+# Правила ценообразования хранятся версиями в pricing_rules (см. раздел
+# «Ценообразование»); это начальная версия, совпадающая с прежним расчётом.
+# commission: категория (или "*" по умолчанию) -> базовая комиссия и пороги
+# [цена в юанях, комиссия], срабатывающие при цене строго выше порога.
+# rounding: шаг округления итоговой цены вверх, 0 — без округления.
+DEFAULT_PRICING_RULES: Dict[str, Any] = {
+    "rate": 13,
+    "rounding": 0,
+    "commission": {"*": {"base": 1500, "tiers": [[3000, 2500]]}},
+}
+
+# Метрики: границы корзин гистограмм задержек (секунды) и локальный HTTP-эндпоинт
+# в формате Prometheus (порт 0 — не запускать)
+LATENCY_BUCKETS: Tuple[float, ...] = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+METRICS_LISTEN: str = "127.0.0.1"
+METRICS_PORT: int = 9102
+METRICS_PATH: str = "/metrics"
+# Сколько самых затратных операций каждого вида показывать в /stats
+STATS_TOP_LIMIT: int = 10
+TELEGRAM_CONNECTION_POOL_SIZE: int = 256
+
+# ================= Метрики =================
+
+T = TypeVar("T")
+
+class Histogram:
+    __slots__ = ("counts", "sum", "count", "max")
+
+    def __init__(self) -> None:
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.max = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+        if value > self.max:
+            self.max = value
+
+    # Оценка квантиля сверху: граница корзины, в которую он попал
+    def quantile(self, q: float) -> float:
+        rank = q * self.count
+        seen = 0
+        for bound, n in zip(LATENCY_BUCKETS, self.counts):
+            seen += n
+            if seen >= rank:
+                return bound
+        return self.max
+
+# Счётчики для обработчиков («handler»), кнопок по маршрутам CALLBACK_ROUTES
+# («callback»), операций БД («db») и запросов к Bot API («telegram_api»):
+# гистограмма задержек, число ошибок и число выполняющихся вызовов. Всё обновляется из event loop, поэтому без блокировок.
+class Metrics:
+    KINDS: Tuple[str, ...] = ("handler", "callback", "db", "telegram_api")
+
+    def __init__(self) -> None:
+        self.latency: Dict[Tuple[str, str], Histogram] = {}
+        self.errors: Dict[Tuple[str, str], int] = {}
+        self.in_flight: Dict[Tuple[str, str], int] = {}
+        # Имя метрики -> функция, возвращающая текущее значение
+        self.gauges: Dict[str, Callable[[], float]] = {}
+
+    @contextmanager
+    def track(self, kind: str, name: str) -> Iterator[None]:
+        key = (kind, name)
+        self.in_flight[key] = self.in_flight.get(key, 0) + 1
+        started = time.perf_counter()
+        try:
+            yield
+        except ApplicationHandlerStop:
+            raise
+        except BaseException:
+            self.errors[key] = self.errors.get(key, 0) + 1
+            raise
+        finally:
+            self.in_flight[key] -= 1
+            histogram = self.latency.get(key)
+            if histogram is None:
+                histogram = self.latency[key] = Histogram()
+            histogram.observe(time.perf_counter() - started)
+
+    def render_prometheus(self) -> str:
+        labels = {"handler": "handler", "callback": "route", "db": "op", "telegram_api": "method"}
+        lines: List[str] = []
+        for kind in self.KINDS:
+            metric = f"bot_{kind}_duration_seconds"
+            label = labels[kind]
+            lines.append(f"# TYPE {metric} histogram")
+            for (k, name), h in sorted(self.latency.items()):
+                if k != kind:
+                    continue
+                cumulative = 0
+                for bound, n in zip(LATENCY_BUCKETS, h.counts):
+                    cumulative += n
+                    lines.append(f'{metric}_bucket{{{label}="{name}",le="{bound}"}} {cumulative}')
+                lines.append(f'{metric}_bucket{{{label}="{name}",le="+Inf"}} {h.count}')
+                lines.append(f'{metric}_sum{{{label}="{name}"}} {h.sum:.6f}')
+                lines.append(f'{metric}_count{{{label}="{name}"}} {h.count}')
+        lines.append("# TYPE bot_errors_total counter")
+        for (kind, name), n in sorted(self.errors.items()):
+            lines.append(f'bot_errors_total{{kind="{kind}",name="{name}"}} {n}')
+        lines.append("# TYPE bot_in_flight gauge")
+        for (kind, name), n in sorted(self.in_flight.items()):
+            lines.append(f'bot_in_flight{{kind="{kind}",name="{name}"}} {n}')
+        for name, value in sorted(self.gauges.items()):
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {value()}")
+        return "\n".join(lines) + "\n"
+
+    # Самые «дорогие» по суммарному времени операции указанного вида
+    def top(self, kind: str, limit: int) -> List[Tuple[str, Histogram]]:
+        items = [(name, h) for (k, name), h in self.latency.items() if k == kind]
+        items.sort(key=lambda item: item[1].sum, reverse=True)
+        return items[:limit]
+
+metrics = Metrics()
+
+def instrument(kind: str, name: str, callback: Callable[..., Awaitable[T]]) -> Callable[..., Awaitable[T]]:
+    async def wrapper(*args: Any, **kwargs: Any) -> T:
+        with metrics.track(kind, name):
+            return await callback(*args, **kwargs)
+    wrapper.__name__ = getattr(callback, "__name__", name)
+    wrapper.__wrapped__ = callback
+    return wrapper
+
+# Оборачивает колбэки всех зарегистрированных обработчиков, включая
+# вложенные в ConversationHandler
+def instrument_handlers(application: Application) -> None:
+    def wrap(handler: BaseHandler) -> None:
+        if isinstance(handler, ConversationHandler):
+            for nested in handler.entry_points + handler.fallbacks:
+                wrap(nested)
+            for handlers in handler.states.values():
+                for nested in handlers:
+                    wrap(nested)
+            return
+        callback = handler.callback
+        # Диспетчер кнопок сам замеряет каждый маршрут («callback»); общий
+        # замер поверх него посчитал бы то же нажатие второй раз
+        if callback is callback_dispatcher:
+            return
+        name = getattr(callback, "__name__", type(callback).__name__)
+        if name == "<lambda>" and isinstance(handler, CommandHandler):
+            name = "cmd_" + "_".join(sorted(handler.commands))
+        handler.callback = instrument("handler", name, callback)
+
+    for handlers in application.handlers.values():
+        for handler in handlers:
+            wrap(handler)
+
+# HTTP-клиент Bot API, который замеряет время каждого запроса по имени метода
+class InstrumentedRequest(HTTPXRequest):
+    async def do_request(self, url: str, *args: Any, **kwargs: Any) -> Tuple[int, bytes]:
+        with metrics.track("telegram_api", url.rsplit("/", 1)[-1]):
+            return await super().do_request(url, *args, **kwargs)
+
+# Отдаёт metrics.render_prometheus() по GET METRICS_PATH; одно соединение — один запрос
+class MetricsServer:
+    def __init__(self, listen: str = METRICS_LISTEN, port: int = METRICS_PORT) -> None:
+        self.listen = listen
+        self.port = port
+        self._server: Optional[asyncio.base_events.Server] = None
+
+    async def start(self) -> None:
+        if not self.port:
+            return
+        self._server = await asyncio.start_server(self._handle_connection, self.listen, self.port)
+        logger.info("Метрики доступны на http://%s:%s%s", self.listen, self.port, METRICS_PATH)
+
+    async def stop(self) -> None:
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        conn = h11.Connection(h11.SERVER)
+        try:
+            event = conn.next_event()
+            while event is h11.NEED_DATA:
+                data = await reader.read(65536)
+                if not data:
+                    return
+                conn.receive_data(data)
+                event = conn.next_event()
+            if not isinstance(event, h11.Request):
+                return
+            if event.method == b"GET" and event.target.decode().split("?", 1)[0] == METRICS_PATH:
+                status, body = 200, metrics.render_prometheus().encode()
+            else:
+                status, body = 404, b""
+            writer.write(conn.send(h11.Response(status_code=status, headers=[
+                ("content-type", "text/plain; version=0.0.4; charset=utf-8"),
+                ("content-length", str(len(body))),
+                ("connection", "close"),
+            ])))
+            writer.write(conn.send(h11.Data(data=body)))
+            writer.write(conn.send(h11.EndOfMessage()))
+            await writer.drain()
+        except (h11.ProtocolError, ConnectionError) as e:
+            logger.debug("Метрики: соединение закрыто с ошибкой: %s", e)
+        finally:
+            writer.close()
+
+metrics_server = MetricsServer()
 
 # ================= Работа с БД =================
 
+# Размер пула читающих соединений. Запись всегда идёт через одно соединение
+# в отдельном потоке, чтобы SQLite не ловил "database is locked".
+DB_READ_POOL_SIZE: int = 4
+DB_BUSY_TIMEOUT_MS: int = 30000
+
 def get_db_connection() -> sqlite3.Connection:
-    conn = sqlite3.connect(DB_PATH)
+    conn = sqlite3.connect(DB_PATH, timeout=DB_BUSY_TIMEOUT_MS / 1000)
     conn.row_factory = sqlite3.Row
     return conn
 
+# Асинхронное хранилище: долгоживущие соединения, работа с диском вне event loop.
+# Чтения идут через пул из DB_READ_POOL_SIZE потоков, запись — через единственный
+# поток-писатель, каждая операция записи выполняется одной транзакцией.
+class Storage:
+    def __init__(self, path: str, pool_size: int = DB_READ_POOL_SIZE) -> None:
+        self.path = path
+        self.pool_size = pool_size
+        self._readers: "queue.Queue[sqlite3.Connection]" = queue.Queue()
+        self._reader_conns: List[sqlite3.Connection] = []
+        self._writer: Optional[sqlite3.Connection] = None
+        self._read_executor: Optional[ThreadPoolExecutor] = None
+        self._write_executor: Optional[ThreadPoolExecutor] = None
+        self._lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=DB_BUSY_TIMEOUT_MS / 1000,
+                               check_same_thread=False, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        conn.execute(f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}")
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def open(self) -> None:
+        with self._lock:
+            if self._writer is not None:
+                return
+            self._writer = self._connect()
+            for _ in range(self.pool_size):
+                conn = self._connect()
+                self._reader_conns.append(conn)
+                self._readers.put(conn)
+            self._read_executor = ThreadPoolExecutor(max_workers=self.pool_size, thread_name_prefix="db-read")
+            self._write_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-write")
+
+    def close(self) -> None:
+        with self._lock:
+            if self._writer is None:
+                return
+            self._read_executor.shutdown(wait=True)
+            self._write_executor.shutdown(wait=True)
+            for conn in self._reader_conns:
+                conn.close()
+            self._writer.close()
+            self._reader_conns.clear()
+            self._readers = queue.Queue()
+            self._writer = None
+            self._read_executor = None
+            self._write_executor = None
+
+    def _run_read(self, fn: Callable[..., T], args: Tuple[Any, ...]) -> T:
+        conn = self._readers.get()
+        try:
+            return fn(conn, *args)
+        finally:
+            self._readers.put(conn)
+
+    # Отдельное соединение только для чтения, закрывается после fn
+    def _run_dedicated(self, fn: Callable[..., T], args: Tuple[Any, ...]) -> T:
+        uri = "file:" + urllib.parse.quote(os.path.abspath(self.path)) + "?mode=ro"
+        conn = sqlite3.connect(uri, uri=True, timeout=DB_BUSY_TIMEOUT_MS / 1000)
+        try:
+            conn.row_factory = sqlite3.Row
+            conn.execute(f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}")
+            return fn(conn, *args)
+        finally:
+            conn.close()
+
+    def _run_write(self, fn: Callable[..., T], args: Tuple[Any, ...]) -> T:
+        conn = self._writer
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            result = fn(conn, *args)
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+        return result
+
+    # Время операций учитывается в метриках «db» вместе с ожиданием свободного соединения
+    async def read(self, fn: Callable[..., T], *args: Any) -> T:
+        self.open()
+        loop = asyncio.get_running_loop()
+        with metrics.track("db", fn.__name__.lstrip("_")):
+            return await loop.run_in_executor(self._read_executor, self._run_read, fn, args)
+
+    # Долгое чтение (потоковая выгрузка) на своём соединении и в своём потоке:
+    # соединения и потоки пула остаются обработчикам
+    async def read_dedicated(self, fn: Callable[..., T], *args: Any) -> T:
+        with metrics.track("db", fn.__name__.lstrip("_")):
+            return await asyncio.to_thread(self._run_dedicated, fn, args)
+
+    async def write(self, fn: Callable[..., T], *args: Any) -> T:
+        self.open()
+        loop = asyncio.get_running_loop()
+        with metrics.track("db", fn.__name__.lstrip("_")):
+            return await loop.run_in_executor(self._write_executor, self._run_write, fn, args)
+
+storage = Storage(DB_PATH)
+
+# ================= Миграции схемы =================
+
+# Базовая схема (orders, users) создаётся в init_db, всё остальное — миграциями.
+# Миграции применяются по возрастанию версии, каждая в своей транзакции;
+# применённые версии записываются в schema_version.
+
+def _migrate_checkouts(conn: sqlite3.Connection) -> None:
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS checkouts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            created_at TEXT,
+            items_count INTEGER,
+            total_price REAL,
+            discount REAL,
+            final_price REAL,
+            promo_code_used TEXT,
+            bonus_debit INTEGER DEFAULT 0
+        )
+    ''')
+    order_columns = {row["name"] for row in conn.execute("PRAGMA table_info(orders)")}
+    if "checkout_id" not in order_columns:
+        conn.execute("ALTER TABLE orders ADD COLUMN checkout_id INTEGER")
+
+def _migrate_media_cache(conn: sqlite3.Connection) -> None:
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS media_cache (
+            path TEXT PRIMARY KEY,
+            content_hash TEXT NOT NULL,
+            file_id TEXT NOT NULL,
+            updated_at TEXT
+        )
+    ''')
+
+def _migrate_indexes(conn: sqlite3.Connection) -> None:
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_orders_user_id ON orders(user_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_orders_status_created_at ON orders(status, created_at)")
+    # Пустой код раньше записывался вместо NULL; дубликаты сбрасываются,
+    # такой пользователь получит новый код при входе в личный кабинет
+    conn.execute("UPDATE users SET referral_code=NULL WHERE referral_code=''")
+    conn.execute('''
+        UPDATE users SET referral_code=NULL
+        WHERE referral_code IS NOT NULL AND user_id NOT IN (
+            SELECT MIN(user_id) FROM users WHERE referral_code IS NOT NULL GROUP BY referral_code
+        )
+    ''')
+    conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_users_referral_code ON users(referral_code)")
+
+def _migrate_order_browser_indexes(conn: sqlite3.Connection) -> None:
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_orders_created_at ON orders(created_at)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_orders_category_created_at ON orders(category, created_at)")
+
+def _migrate_order_stats(conn: sqlite3.Connection) -> None:
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS order_stats (
+            dimension TEXT NOT NULL,
+            key TEXT NOT NULL,
+            orders_count INTEGER NOT NULL DEFAULT 0,
+            revenue REAL NOT NULL DEFAULT 0,
+            PRIMARY KEY (dimension, key)
+        )
+    ''')
+    _rebuild_order_stats(conn)
+
+def _migrate_promo_codes(conn: sqlite3.Connection) -> None:
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS promo_codes (
+            code TEXT PRIMARY KEY,
+            type TEXT NOT NULL,
+            discount INTEGER NOT NULL,
+            max_uses INTEGER,
+            uses INTEGER NOT NULL DEFAULT 0,
+            expires_at TEXT,
+            created_at TEXT
+        )
+    ''')
+    # once_key = user_id для одноразовых кодов и рефералок, NULL для многоразовых:
+    # уникальный индекс не даёт одному пользователю применить код дважды
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS promo_redemptions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            code TEXT NOT NULL,
+            user_id INTEGER NOT NULL,
+            once_key INTEGER,
+            checkout_id INTEGER,
+            redeemed_at TEXT
+        )
+    ''')
+    conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_promo_redemptions_once ON promo_redemptions(code, once_key)")
+
+def _migrate_bonus_ledger(conn: sqlite3.Connection) -> None:
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS bonus_ledger (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            amount INTEGER NOT NULL,
+            reason TEXT,
+            checkout_id INTEGER,
+            created_at TEXT
+        )
+    ''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_bonus_ledger_user_id ON bonus_ledger(user_id, id)")
+    # Текущие балансы переносятся в журнал начальным остатком
+    conn.execute(
+        "INSERT INTO bonus_ledger (user_id, amount, reason, created_at) "
+        "SELECT user_id, bonus, 'начальный остаток', ? FROM users WHERE bonus != 0",
+        (datetime.now().isoformat(),)
+    )
+
+def _migrate_persistence(conn: sqlite3.Connection) -> None:
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS persistence (
+            kind TEXT NOT NULL,
+            key TEXT NOT NULL,
+            data TEXT NOT NULL,
+            updated_at TEXT,
+            PRIMARY KEY (kind, key)
+        )
+    ''')
+
+def _migrate_outbox(conn: sqlite3.Connection) -> None:
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id INTEGER NOT NULL,
+            method TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at REAL NOT NULL,
+            last_error TEXT,
+            created_at TEXT
+        )
+    ''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_outbox_status_next ON outbox(status, next_attempt_at)")
+
+def _migrate_pricing_rules(conn: sqlite3.Connection) -> None:
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS pricing_rules (
+            version INTEGER PRIMARY KEY AUTOINCREMENT,
+            rules TEXT NOT NULL,
+            created_by INTEGER,
+            created_at TEXT
+        )
+    ''')
+    if conn.execute("SELECT COUNT(*) FROM pricing_rules").fetchone()[0] == 0:
+        conn.execute(
+            "INSERT INTO pricing_rules (rules, created_at) VALUES (?, ?)",
+            (json.dumps(DEFAULT_PRICING_RULES, ensure_ascii=False), datetime.now().isoformat())
+        )
+    order_columns = {row["name"] for row in conn.execute("PRAGMA table_info(orders)")}
+    if "pricing_version" not in order_columns:
+        conn.execute("ALTER TABLE orders ADD COLUMN pricing_version INTEGER")
+        # Все прежние заказы посчитаны по правилам, совпадающим с версией 1
+        conn.execute("UPDATE orders SET pricing_version=1")
+
+# Переводит существующие заказы на ключи из времени создания: orders.id и
+# order_id переписываются, старые UUID остаются в order_id_aliases. Новые ключи
+# больше всех старых id, поэтому UPDATE первичного ключа не даёт конфликтов.
+# Списки заказов листаются по id, им нужны индексы с id в порядке ключа.
+def _migrate_order_keys(conn: sqlite3.Connection) -> None:
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS order_id_aliases (
+            old_order_id TEXT PRIMARY KEY,
+            order_key INTEGER NOT NULL
+        )
+    ''')
+    conn.execute("CREATE TEMP TABLE order_key_map (old_id INTEGER PRIMARY KEY, new_id INTEGER, code TEXT)")
+    last_key = conn.execute("SELECT COALESCE(MAX(id), 0) FROM orders").fetchone()[0]
+    cursor = conn.execute("SELECT id, created_at FROM orders ORDER BY created_at, id")
+    while True:
+        chunk = cursor.fetchmany(ORDERS_BATCH_SIZE)
+        if not chunk:
+            break
+        mapping = []
+        for row in chunk:
+            last_key = max(order_key_from_time(row["created_at"]), last_key + 1)
+            mapping.append((row["id"], last_key, format_order_key(last_key)))
+        conn.executemany("INSERT INTO order_key_map (old_id, new_id, code) VALUES (?, ?, ?)", mapping)
+    conn.execute('''
+        INSERT OR IGNORE INTO order_id_aliases (old_order_id, order_key)
+        SELECT o.order_id, m.new_id FROM orders o JOIN order_key_map m ON m.old_id = o.id
+        WHERE o.order_id IS NOT NULL
+    ''')
+    conn.execute("UPDATE orders SET id = m.new_id, order_id = m.code FROM order_key_map m WHERE orders.id = m.old_id")
+    conn.execute("DROP TABLE order_key_map")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_orders_status ON orders(status)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_orders_category ON orders(category)")
+    conn.execute("DROP INDEX IF EXISTS idx_orders_category_created_at")
+
+# Очередь и журнал архива фото: строка на file_id, после скачивания — sha256
+# файла в локальном хранилище. Уже сохранённые в заказах фото ставятся в очередь.
+def _migrate_media_archive(conn: sqlite3.Connection) -> None:
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS media_archive (
+            file_id TEXT PRIMARY KEY,
+            status TEXT NOT NULL DEFAULT 'pending',
+            sha256 TEXT,
+            size INTEGER,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at REAL NOT NULL DEFAULT 0,
+            last_error TEXT,
+            archived_at TEXT
+        )
+    ''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_media_archive_status_next ON media_archive(status, next_attempt_at)")
+    conn.execute('''
+        INSERT OR IGNORE INTO media_archive (file_id)
+        SELECT screenshot FROM orders WHERE screenshot IS NOT NULL
+        UNION SELECT receipt FROM orders WHERE receipt IS NOT NULL
+    ''')
+
+# Полнотекстовый индекс заказов для /find. Таблица external content: FTS5
+# хранит только индекс, текст читается из orders; синхронность держат
+# триггеры. Префиксные индексы на 2–10 символов: без них запрос «слово*»
+# собирает в памяти списки всех подходящих слов, и «бежевые*» на миллионе
+# заказов занимает 80 мс вместо 1 мс. detail=none: позиции слов не хранятся,
+# индекс меньше в полтора раза — а фразовых запросов /find не строит.
+def _migrate_order_search(conn: sqlite3.Connection) -> None:
+    conn.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS orders_fts USING fts5(
+            order_name, order_link, username, order_id,
+            content='orders', content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2', prefix='2 3 4 5 6 7 8 9 10', detail=none
+        )
+    ''')
+    # Триггеры по одному: executescript сам делает COMMIT посреди транзакции миграции
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS orders_fts_ai AFTER INSERT ON orders BEGIN
+            INSERT INTO orders_fts (rowid, order_name, order_link, username, order_id)
+            VALUES (new.id, new.order_name, new.order_link, new.username, new.order_id);
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS orders_fts_ad AFTER DELETE ON orders BEGIN
+            INSERT INTO orders_fts (orders_fts, rowid, order_name, order_link, username, order_id)
+            VALUES ('delete', old.id, old.order_name, old.order_link, old.username, old.order_id);
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS orders_fts_au
+        AFTER UPDATE OF id, order_name, order_link, username, order_id ON orders BEGIN
+            INSERT INTO orders_fts (orders_fts, rowid, order_name, order_link, username, order_id)
+            VALUES ('delete', old.id, old.order_name, old.order_link, old.username, old.order_id);
+            INSERT INTO orders_fts (rowid, order_name, order_link, username, order_id)
+            VALUES (new.id, new.order_name, new.order_link, new.username, new.order_id);
+        END
+    ''')
+    conn.execute("INSERT INTO orders_fts (orders_fts) VALUES ('rebuild')")
+
+# Счётчики заказов пользователя для личного кабинета: число заказов и их сумма.
+# Растут в той же транзакции, что и запись заказа; сейчас считаются по orders,
+# пользователям с заказами без строки в users строка создаётся.
+def _migrate_user_summary(conn: sqlite3.Connection) -> None:
+    user_columns = {row["name"] for row in conn.execute("PRAGMA table_info(users)")}
+    if "orders_count" not in user_columns:
+        conn.execute("ALTER TABLE users ADD COLUMN orders_count INTEGER NOT NULL DEFAULT 0")
+    if "orders_total" not in user_columns:
+        conn.execute("ALTER TABLE users ADD COLUMN orders_total REAL NOT NULL DEFAULT 0")
+    conn.execute(
+        "INSERT OR IGNORE INTO users (user_id, referral_code, bonus) "
+        "SELECT DISTINCT user_id, NULL, 0 FROM orders WHERE user_id IS NOT NULL"
+    )
+    conn.execute('''
+        UPDATE users SET orders_count = s.orders_count, orders_total = s.orders_total
+        FROM (
+            SELECT user_id, COUNT(*) AS orders_count, COALESCE(SUM(final_price), 0) AS orders_total
+            FROM orders GROUP BY user_id
+        ) AS s
+        WHERE users.user_id = s.user_id
+    ''')
+
+# Голова очереди каждого чата — самое старое pending-сообщение: частичный
+# индекс даёт её без просмотра уже отправленных
+def _migrate_outbox_chat_index(conn: sqlite3.Connection) -> None:
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_outbox_pending_chat ON outbox(chat_id, id) WHERE status='pending'")
+
+MIGRATIONS: List[Tuple[int, str, Callable[[sqlite3.Connection], None]]] = [
+    (1, "checkouts и orders.checkout_id", _migrate_checkouts),
+    (2, "media_cache", _migrate_media_cache),
+    (3, "индексы orders(user_id), orders(status, created_at), users(referral_code)", _migrate_indexes),
+    (4, "индексы orders(created_at), orders(category, created_at)", _migrate_order_browser_indexes),
+    (5, "агрегаты аналитики order_stats", _migrate_order_stats),
+    (6, "промокоды promo_codes и promo_redemptions", _migrate_promo_codes),
+    (7, "бонусный журнал bonus_ledger", _migrate_bonus_ledger),
+    (8, "состояние диалогов persistence", _migrate_persistence),
+    (9, "очередь исходящих сообщений outbox", _migrate_outbox),
+    (10, "правила ценообразования pricing_rules и orders.pricing_version", _migrate_pricing_rules),
+    (11, "ключи заказов по времени и order_id_aliases", _migrate_order_keys),
+    (12, "архив фото media_archive", _migrate_media_archive),
+    (13, "полнотекстовый поиск заказов orders_fts", _migrate_order_search),
+    (14, "счётчики заказов users.orders_count и users.orders_total", _migrate_user_summary),
+    (15, "индекс outbox(chat_id, id) по pending-сообщениям", _migrate_outbox_chat_index),
+]
+
+def run_migrations(conn: sqlite3.Connection) -> int:
+    conn.execute("CREATE TABLE IF NOT EXISTS schema_version (version INTEGER PRIMARY KEY, applied_at TEXT)")
+    version = conn.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version").fetchone()[0]
+    for target, description, migrate in MIGRATIONS:
+        if target <= version:
+            continue
+        logger.info("Миграция БД до версии %s: %s", target, description)
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            migrate(conn)
+            conn.execute("INSERT INTO schema_version (version, applied_at) VALUES (?, ?)",
+                         (target, datetime.now().isoformat()))
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+        version = target
+    return version
+
 def init_db() -> None:
-    with get_db_connection() as conn:
-        cur = conn.cursor()
-        cur.execute('''
+    conn = get_db_connection()
+    conn.isolation_level = None
+    try:
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute('''
             CREATE TABLE IF NOT EXISTS orders (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
                 order_id TEXT UNIQUE,
@@ -76,111 +826,2083 @@ def init_db() -> None:
                 promo_code_used TEXT
             )
         ''')
-        cur.execute('''
+        conn.execute('''
             CREATE TABLE IF NOT EXISTS users (
                 user_id INTEGER PRIMARY KEY,
                 referral_code TEXT,
                 bonus INTEGER DEFAULT 0
             )
         ''')
-        conn.commit()
-
-def db_insert_order(order: Dict[str, Any]) -> None:
-    with get_db_connection() as conn:
-        cur = conn.cursor()
-        cur.execute('''
-            INSERT INTO orders 
-            (order_id, user_id, username, category, price_yuan, commission, final_price, order_name, order_link, status, created_at, screenshot, receipt, discount, promo_code_used)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (
-            order["order_id"],
-            order["user_id"],
-            order["username"],
-            order["category"],
-            order["price_yuan"],
-            order["commission"],
-            order["final_price"],
-            order["order_name"],
-            order["order_link"],
-            order["status"],
-            order["created_at"],
-            order.get("screenshot"),
-            order.get("receipt"),
-            order.get("discount"),
-            order.get("promo_code_used"),
-        ))
-        conn.commit()
-
-def db_update_order_status(order_id: str, new_status: str) -> None:
-    with get_db_connection() as conn:
-        cur = conn.cursor()
-        cur.execute("UPDATE orders SET status=? WHERE order_id=?", (new_status, order_id))
-        conn.commit()
-
-def db_get_orders() -> List[sqlite3.Row]:
-    with get_db_connection() as conn:
-        cur = conn.cursor()
-        cur.execute("SELECT * FROM orders")
-        return cur.fetchall()
-
-def db_get_user_orders(user_id: int) -> List[sqlite3.Row]:
-    with get_db_connection() as conn:
-        cur = conn.cursor()
-        cur.execute("SELECT * FROM orders WHERE user_id=?", (user_id,))
-        return cur.fetchall()
-
-def db_set_referral_code(user_id: int, code: str) -> None:
-    with get_db_connection() as conn:
-        cur = conn.cursor()
-        cur.execute(
-            "INSERT OR REPLACE INTO users (user_id, referral_code, bonus) VALUES (?, ?, COALESCE((SELECT bonus FROM users WHERE user_id=?), 0))",
-            (user_id, code, user_id)
+        run_migrations(conn)
+    finally:
+        conn.close()
+
+# Синхронные запросы принимают соединение первым аргументом и выполняются
+# в потоках Storage; обработчики используют только асинхронные db_* обёртки.
+
+ORDER_COLUMNS: Tuple[str, ...] = (
+    "id", "order_id", "user_id", "username", "category", "price_yuan", "commission", "final_price",
+    "order_name", "order_link", "status", "created_at", "screenshot", "receipt", "discount",
+    "promo_code_used", "checkout_id", "pricing_version",
+)
+INSERT_ORDER_SQL: str = (
+    f"INSERT INTO orders ({', '.join(ORDER_COLUMNS)}) "
+    f"VALUES ({', '.join('?' for _ in ORDER_COLUMNS)})"
+)
+
+def _order_row(order: Dict[str, Any]) -> Tuple[Any, ...]:
+    return tuple(order.get(column) for column in ORDER_COLUMNS)
+
+# ----- Агрегаты аналитики -----
+# order_stats хранит счётчики и суммы: dimension="status" — по всем заказам в
+# разрезе статуса, "category" и "day" — только по оплаченным (PAID_STATUSES).
+# Обновляются в той же транзакции, что и запись/смена статуса заказа.
+
+def _bump_order_stat(conn: sqlite3.Connection, dimension: str, key: str, count: int, revenue: float) -> None:
+    conn.execute(
+        "INSERT INTO order_stats (dimension, key, orders_count, revenue) VALUES (?, ?, ?, ?) "
+        "ON CONFLICT(dimension, key) DO UPDATE SET "
+        "orders_count = orders_count + excluded.orders_count, revenue = revenue + excluded.revenue",
+        (dimension, key, count, revenue)
+    )
+
+def _apply_order_stats(conn: sqlite3.Connection, status: str, category: Optional[str],
+                       created_at: Optional[str], final_price: Optional[float], sign: int,
+                       status_only: bool = False) -> None:
+    revenue = sign * (final_price or 0)
+    _bump_order_stat(conn, "status", status, sign, revenue)
+    if status in PAID_STATUSES and not status_only:
+        _bump_order_stat(conn, "category", category or "", sign, revenue)
+        _bump_order_stat(conn, "day", (created_at or "")[:10], sign, revenue)
+
+def _rebuild_order_stats(conn: sqlite3.Connection) -> None:
+    paid = ", ".join("?" for _ in PAID_STATUSES)
+    conn.execute("DELETE FROM order_stats")
+    conn.execute(
+        "INSERT INTO order_stats (dimension, key, orders_count, revenue) "
+        "SELECT 'status', status, COUNT(*), COALESCE(SUM(final_price), 0) FROM orders GROUP BY status"
+    )
+    conn.execute(
+        "INSERT INTO order_stats (dimension, key, orders_count, revenue) "
+        "SELECT 'category', COALESCE(category, ''), COUNT(*), COALESCE(SUM(final_price), 0) "
+        f"FROM orders WHERE status IN ({paid}) GROUP BY COALESCE(category, '')",
+        PAID_STATUSES
+    )
+    conn.execute(
+        "INSERT INTO order_stats (dimension, key, orders_count, revenue) "
+        "SELECT 'day', substr(COALESCE(created_at, ''), 1, 10), COUNT(*), COALESCE(SUM(final_price), 0) "
+        f"FROM orders WHERE status IN ({paid}) GROUP BY substr(COALESCE(created_at, ''), 1, 10)",
+        PAID_STATUSES
+    )
+
+def _get_order_stats(conn: sqlite3.Connection, dimension: str, limit: int = -1) -> List[sqlite3.Row]:
+    return conn.execute(
+        "SELECT key, orders_count, revenue FROM order_stats WHERE dimension=? AND orders_count > 0 "
+        "ORDER BY key DESC LIMIT ?",
+        (dimension, limit)
+    ).fetchall()
+
+def _insert_order(conn: sqlite3.Connection, order: Dict[str, Any]) -> None:
+    if "order_id" not in order:
+        assign_order_id(order)
+    conn.execute(INSERT_ORDER_SQL, _order_row(order))
+    _apply_order_stats(conn, order["status"], order.get("category"), order.get("created_at"), order.get("final_price"), 1)
+    _bump_user_orders(conn, order["user_id"], 1, order.get("final_price") or 0)
+    _queue_media_archive(conn, [order.get("screenshot"), order.get("receipt")])
+
+# ----- Правила ценообразования -----
+
+def _get_pricing_rules(conn: sqlite3.Connection) -> sqlite3.Row:
+    return conn.execute("SELECT * FROM pricing_rules ORDER BY version DESC LIMIT 1").fetchone()
+
+# Новая версия сохраняется, только если с момента чтения base_version никто
+# не успел сохранить свою — иначе правки одного админа затёрли бы правки другого
+def _save_pricing_rules(conn: sqlite3.Connection, base_version: int, rules: str, created_by: int) -> int:
+    latest = conn.execute("SELECT MAX(version) FROM pricing_rules").fetchone()[0]
+    if latest != base_version:
+        raise ValueError("Правила уже изменены другим администратором, повторите команду.")
+    return conn.execute(
+        "INSERT INTO pricing_rules (rules, created_by, created_at) VALUES (?, ?, ?)",
+        (rules, created_by, datetime.now().isoformat())
+    ).lastrowid
+
+# ----- Промокоды -----
+
+def _get_promo(conn: sqlite3.Connection, code: str) -> Optional[sqlite3.Row]:
+    return conn.execute("SELECT * FROM promo_codes WHERE code=?", (code,)).fetchone()
+
+def _list_promos(conn: sqlite3.Connection) -> List[sqlite3.Row]:
+    return conn.execute("SELECT * FROM promo_codes ORDER BY created_at").fetchall()
+
+def _upsert_promo(conn: sqlite3.Connection, code: str, promo_type: str, discount: int,
+                  max_uses: Optional[int], expires_at: Optional[str]) -> None:
+    conn.execute(
+        "INSERT INTO promo_codes (code, type, discount, max_uses, expires_at, created_at) VALUES (?, ?, ?, ?, ?, ?) "
+        "ON CONFLICT(code) DO UPDATE SET type=excluded.type, discount=excluded.discount, "
+        "max_uses=excluded.max_uses, expires_at=excluded.expires_at",
+        (code, promo_type, discount, max_uses, expires_at, datetime.now().isoformat())
+    )
+
+def _has_redeemed(conn: sqlite3.Connection, code: str, user_id: int) -> bool:
+    row = conn.execute("SELECT 1 FROM promo_redemptions WHERE code=? AND once_key=?", (code, user_id)).fetchone()
+    return row is not None
+
+def promo_expired(promo: sqlite3.Row) -> bool:
+    return promo["expires_at"] is not None and promo["expires_at"] < datetime.now().isoformat()
+
+# kind: "promo" — код из promo_codes, "referral" — чужой реферальный код.
+# Лимит использований проверяется и увеличивается одним UPDATE, повторное
+# применение отсекает уникальный индекс; ошибки — ValueError с текстом для пользователя.
+def _redeem_code(conn: sqlite3.Connection, code: str, user_id: int, checkout_id: int, kind: str) -> None:
+    once_key: Optional[int] = user_id
+    if kind == "promo":
+        promo = _get_promo(conn, code)
+        if promo is None:
+            raise ValueError("Промокод не найден")
+        if promo_expired(promo):
+            raise ValueError("Срок действия промокода истёк")
+        cur = conn.execute(
+            "UPDATE promo_codes SET uses = uses + 1 WHERE code=? AND (max_uses IS NULL OR uses < max_uses)",
+            (code,)
+        )
+        if cur.rowcount == 0:
+            raise ValueError("Лимит использований промокода исчерпан")
+        if promo["type"] != "one-time":
+            once_key = None
+    try:
+        conn.execute(
+            "INSERT INTO promo_redemptions (code, user_id, once_key, checkout_id, redeemed_at) VALUES (?, ?, ?, ?, ?)",
+            (code, user_id, once_key, checkout_id, datetime.now().isoformat())
+        )
+    except sqlite3.IntegrityError:
+        raise ValueError("Код уже был вами использован")
+
+# Оформление всей корзины одной транзакцией: запись checkout, списание бонусов,
+# погашение промокода и все позиции. Скидка раскладывается по позициям с конца
+# корзины, так что сумма final_price позиций совпадает с итогом checkout.
+# Позиции дополняются на месте, поэтому db_checkout_basket передаёт сюда копии.
+def _checkout_basket(conn: sqlite3.Connection, user_id: int, basket: List[Dict[str, Any]],
+                     discount: float = 0, promo_code: Optional[str] = None, bonus_debit: int = 0,
+                     redemption: Optional[str] = None) -> int:
+    total_price = sum(item["final_price"] for item in basket)
+    discount = min(discount, total_price)
+    cur = conn.execute(
+        "INSERT INTO checkouts (user_id, created_at, items_count, total_price, discount, final_price, promo_code_used, bonus_debit) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+        (user_id, datetime.now().isoformat(), len(basket), total_price, discount,
+         total_price - discount, promo_code, bonus_debit)
+    )
+    checkout_id = cur.lastrowid
+    if bonus_debit:
+        _change_bonus(conn, user_id, -bonus_debit, "оплата заказа", checkout_id)
+    if redemption and promo_code:
+        _redeem_code(conn, promo_code, user_id, checkout_id, redemption)
+    remaining = discount
+    for item in reversed(basket):
+        item_discount = min(remaining, item["final_price"])
+        if item_discount:
+            item["final_price"] -= item_discount
+            item["discount"] = item_discount
+            item["promo_code_used"] = promo_code
+            remaining -= item_discount
+    for item in basket:
+        if "order_id" not in item:
+            assign_order_id(item)
+        item["checkout_id"] = checkout_id
+    conn.executemany(INSERT_ORDER_SQL, [_order_row(item) for item in basket])
+    for item in basket:
+        _apply_order_stats(conn, item["status"], item.get("category"), item.get("created_at"), item["final_price"], 1)
+    _bump_user_orders(conn, user_id, len(basket), sum(item["final_price"] for item in basket))
+    _queue_media_archive(conn, [file_id for item in basket for file_id in (item.get("screenshot"), item.get("receipt"))])
+    return checkout_id
+
+def _set_order_status(conn: sqlite3.Connection, row: sqlite3.Row, new_status: str) -> None:
+    conn.execute("UPDATE orders SET status=? WHERE id=?", (new_status, row["id"]))
+    # Категория/день меняются только при переходе между оплаченными и неоплаченными
+    paid_unchanged = (row["status"] in PAID_STATUSES) == (new_status in PAID_STATUSES)
+    _apply_order_stats(conn, row["status"], row["category"], row["created_at"], row["final_price"], -1, paid_unchanged)
+    _apply_order_stats(conn, new_status, row["category"], row["created_at"], row["final_price"], 1, paid_unchanged)
+
+# Возвращает (order_id, user_id), если статус действительно изменился
+def _update_order_status(conn: sqlite3.Connection, key: int, new_status: str) -> Optional[Tuple[str, int]]:
+    row = conn.execute(
+        "SELECT id, order_id, user_id, status, category, created_at, final_price FROM orders WHERE id=?", (key,)
+    ).fetchone()
+    if row is None or row["status"] == new_status:
+        return None
+    _set_order_status(conn, row, new_status)
+    return row["order_id"], row["user_id"]
+
+# Квитанция к уже оформленному заказу: сохраняется file_id, фото ставится в
+# очередь архива, статус меняется как в _update_order_status
+def _attach_order_receipt(conn: sqlite3.Connection, key: int, file_id: str, new_status: str) -> Optional[Tuple[str, int]]:
+    conn.execute("UPDATE orders SET receipt=? WHERE id=?", (file_id, key))
+    _queue_media_archive(conn, [file_id])
+    return _update_order_status(conn, key, new_status)
+
+# Условия WHERE для фильтров заказов из parse_order_filters; дата — [date_from, date_to)
+def _order_filter_sql(status: Optional[str] = None, date_from: Optional[str] = None,
+                      date_to: Optional[str] = None, user_id: Optional[int] = None) -> Tuple[List[str], List[Any]]:
+    where: List[str] = []
+    params: List[Any] = []
+    if status:
+        where.append("status=?")
+        params.append(status)
+    if date_from:
+        where.append("created_at >= ?")
+        params.append(date_from)
+    if date_to:
+        where.append("created_at < ?")
+        params.append(date_to)
+    if user_id is not None:
+        where.append("user_id=?")
+        params.append(user_id)
+    return where, params
+
+# Потоковая выгрузка заказов в gzip-CSV: строки читаются курсором по
+# EXPORT_CHUNK_SIZE и сразу пишутся в файл, так что память не зависит от
+# объёма выгрузки. Порядок — по created_at, его покрывают индексы по дате и
+# (status, created_at). Возвращает число выгруженных строк.
+def _export_orders(conn: sqlite3.Connection, path: str, status: Optional[str] = None,
+                   date_from: Optional[str] = None, date_to: Optional[str] = None,
+                   user_id: Optional[int] = None) -> int:
+    where, params = _order_filter_sql(status, date_from, date_to, user_id)
+    columns = ORDER_COLUMNS
+    sql = f"SELECT {', '.join(columns)} FROM orders"
+    if where:
+        sql += f" WHERE {' AND '.join(where)}"
+    sql += " ORDER BY created_at, id"
+    cursor = conn.execute(sql, params)
+    rows = 0
+    # utf-8-sig — чтобы Excel правильно открыл кириллицу
+    with gzip.open(path, "wt", encoding="utf-8-sig", newline="", compresslevel=EXPORT_GZIP_LEVEL) as f:
+        writer = csv.writer(f)
+        writer.writerow(columns)
+        while True:
+            chunk = cursor.fetchmany(EXPORT_CHUNK_SIZE)
+            if not chunk:
+                break
+            writer.writerows(chunk)
+            rows += len(chunk)
+    return rows
+
+# ID заказов из ввода админа -> ключи, как и для одного заказа: код в любом
+# регистре и с дефисами разбирается parse_order_code, старые UUID ищутся
+# через order_id_aliases. Возвращает ключи существующих заказов и ID, которым
+# заказ не нашёлся.
+def _resolve_order_keys(conn: sqlite3.Connection, order_ids: List[str]) -> Tuple[List[int], List[str]]:
+    keys: List[int] = []
+    unmatched: List[str] = []
+    for order_id in order_ids:
+        key = parse_order_code(order_id.replace("-", ""))
+        if key is not None:
+            found = conn.execute("SELECT id FROM orders WHERE id=?", (key,)).fetchone()
+        else:
+            found = conn.execute(
+                "SELECT o.id FROM order_id_aliases a JOIN orders o ON o.id = a.order_key WHERE a.old_order_id IN (?, ?)",
+                (order_id, order_id.lower())
+            ).fetchone()
+        if found is None:
+            unmatched.append(order_id)
+        elif found["id"] not in keys:
+            keys.append(found["id"])
+    return keys, unmatched
+
+# Массовая смена статуса одной транзакцией: заказы выбираются по списку ID,
+# текущему статусу и/или диапазону дат [date_from, date_to). Уведомления
+# клиентам ставятся в outbox в той же транзакции; возвращаются ID изменённых
+# заказов, ID сообщений в outbox и ID из order_ids, которым заказ не нашёлся.
+def _bulk_update_order_status(conn: sqlite3.Connection, new_status: str, order_ids: Optional[List[str]] = None,
+                              status: Optional[str] = None, date_from: Optional[str] = None,
+                              date_to: Optional[str] = None) -> Tuple[List[str], List[int], List[str]]:
+    where, params = _order_filter_sql(status, date_from, date_to)
+    where.insert(0, "status != ?")
+    params.insert(0, new_status)
+    sql = f"SELECT id, order_id, user_id, status, category, created_at, final_price FROM orders WHERE {' AND '.join(where)}"
+    unmatched: List[str] = []
+    if order_ids is None:
+        rows = conn.execute(sql, params).fetchall()
+    else:
+        keys, unmatched = _resolve_order_keys(conn, order_ids)
+        rows = []
+        for i in range(0, len(keys), ORDERS_BATCH_SIZE):
+            chunk = keys[i:i + ORDERS_BATCH_SIZE]
+            rows.extend(conn.execute(
+                f"{sql} AND id IN ({','.join('?' * len(chunk))})", params + chunk
+            ).fetchall())
+    for row in rows:
+        _set_order_status(conn, row, new_status)
+    message_ids = _enqueue_outbox(conn, [
+        (row["user_id"], "send_message",
+         json.dumps({"text": order_status_message(row["order_id"], new_status)}, ensure_ascii=False))
+        for row in rows
+    ])
+    return [row["order_id"] for row in rows], message_ids, unmatched
+
+# Поиск по коду заказа; UUID заказов, созданных до перехода на ключи, ищутся через order_id_aliases
+def _get_order(conn: sqlite3.Connection, order_id: str) -> Optional[sqlite3.Row]:
+    row = conn.execute("SELECT * FROM orders WHERE order_id=?", (order_id,)).fetchone()
+    if row is None:
+        row = conn.execute(
+            "SELECT o.* FROM order_id_aliases a JOIN orders o ON o.id = a.order_key WHERE a.old_order_id=?",
+            (order_id,)
+        ).fetchone()
+    return row
+
+def _get_order_by_key(conn: sqlite3.Connection, key: int) -> Optional[sqlite3.Row]:
+    return conn.execute("SELECT * FROM orders WHERE id=?", (key,)).fetchone()
+
+# Keyset-пагинация по ключу заказа, от новых к старым: ключ растёт со временем,
+# так что порядок совпадает с порядком создания. Курсор — ключ на границе
+# предыдущей страницы; backward=True листает к более новым заказам.
+def _get_orders_page(conn: sqlite3.Connection, status: Optional[str], category: Optional[str],
+                     cursor: Optional[int], backward: bool, limit: int) -> List[sqlite3.Row]:
+    where = []
+    params: List[Any] = []
+    if status:
+        where.append("status=?")
+        params.append(status)
+    if category:
+        where.append("category=?")
+        params.append(category)
+    if cursor:
+        where.append("id > ?" if backward else "id < ?")
+        params.append(cursor)
+    direction = "ASC" if backward else "DESC"
+    sql = "SELECT id, order_id, order_name, status, created_at FROM orders"
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += f" ORDER BY id {direction} LIMIT ?"
+    params.append(limit)
+    return conn.execute(sql, params).fetchall()
+
+# Постраничное чтение заказов по id: в памяти не больше одной пачки строк
+# columns — имена столбцов из ORDER_COLUMNS; id выбирается всегда, он нужен для курсора
+def _get_orders_batch(conn: sqlite3.Connection, after_id: int, limit: int, columns: Tuple[str, ...]) -> List[sqlite3.Row]:
+    if not set(columns) <= set(ORDER_COLUMNS):
+        raise ValueError(f"Неизвестные столбцы: {columns}")
+    return conn.execute(
+        f"SELECT id, {', '.join(columns)} FROM orders WHERE id>? ORDER BY id LIMIT ?",
+        (after_id, limit)
+    ).fetchall()
+
+def _get_user_orders_page(conn: sqlite3.Connection, user_id: int, before_id: Optional[int], limit: int) -> List[sqlite3.Row]:
+    if before_id is None:
+        return conn.execute(
+            "SELECT id, order_id, order_name, status, final_price FROM orders WHERE user_id=? ORDER BY id DESC LIMIT ?",
+            (user_id, limit)
+        ).fetchall()
+    return conn.execute(
+        "SELECT id, order_id, order_name, status, final_price FROM orders WHERE user_id=? AND id<? ORDER BY id DESC LIMIT ?",
+        (user_id, before_id, limit)
+    ).fetchall()
+
+# Слова запроса /find в нижнем регистре, не больше FIND_MAX_TERMS. Слова делятся
+# так же, как их делит токенизатор unicode61: «_» — разделитель, @ivan_petrov —
+# это два слова
+def order_search_terms(text: str) -> List[str]:
+    return re.findall(r"[^\W_]+", text.lower())[:FIND_MAX_TERMS]
+
+# Слова -> выражение FTS5 MATCH. Каждое слово экранируется кавычками, поэтому
+# операторы FTS5 из ввода не исполняются, и ищется по префиксу ("сло"*) так,
+# чтобы хватило префиксного индекса: однобуквенные — целиком (индекса на 1 символ
+# нет), длиннее FIND_PREFIX_MAX — по первым FIND_PREFIX_MAX символам, остаток
+# проверяет _search_orders. Совпасть должны все слова (AND).
+def order_search_query(terms: List[str]) -> str:
+    return " ".join(f'"{t[:FIND_PREFIX_MAX]}"*' if len(t) > 1 else f'"{t}"' for t in terms)
+
+# Вес совпадения заказа с запросом: за каждое слово — вес лучшего столбца, где
+# с него начинается какое-нибудь слово, вдвое больше при совпадении целиком.
+# None, если не нашлось обязательное слово — то, что FTS5 проверил лишь по префиксу
+def order_search_score(row: sqlite3.Row, patterns: List[Tuple[str, "re.Pattern[str]", bool]]) -> Optional[int]:
+    values = [(weight, (row[column] or "").lower()) for column, weight in FIND_COLUMN_WEIGHTS.items()]
+    score = 0
+    for term, pattern, required in patterns:
+        best = 0
+        for weight, value in values:
+            # Поиск подстроки намного дешевле регулярного выражения и отсеивает почти все столбцы
+            if term not in value:
+                continue
+            tails = pattern.findall(value)
+            if tails:
+                best = max(best, weight * 2 if "" in tails else weight)
+        if required and not best:
+            return None
+        score += best
+    return score
+
+# Поиск заказов по orders_fts. bm25 здесь не годится: для IDF он считает все
+# строки с каждым словом, и запрос «nike» на миллионе заказов стоит десятки мс.
+# Поэтому FTS5 отдаёт candidates самых новых совпадений (по rowid, с ранней
+# остановкой), а ранжируются они уже здесь; при равном весе новее — выше.
+def _search_orders(conn: sqlite3.Connection, terms: List[str], limit: int,
+                   candidates: int = FIND_CANDIDATES) -> List[sqlite3.Row]:
+    rows = conn.execute('''
+        SELECT id, order_id, order_name, order_link, username, status, created_at FROM orders
+        WHERE id IN (
+            SELECT rowid FROM orders_fts WHERE orders_fts MATCH ? ORDER BY rowid DESC LIMIT ?
         )
-        conn.commit()
-
-def db_get_user(user_id: int) -> Optional[sqlite3.Row]:
-    with get_db_connection() as conn:
-        cur = conn.cursor()
-        cur.execute("SELECT referral_code, bonus FROM users WHERE user_id=?", (user_id,))
-        return cur.fetchone()
-
-def db_update_user_bonus(user_id: int, bonus_change: int) -> None:
-    with get_db_connection() as conn:
-        cur = conn.cursor()
-        cur.execute("SELECT bonus FROM users WHERE user_id=?", (user_id,))
-        row = cur.fetchone()
-        if row:
-            new_bonus = row["bonus"] + bonus_change
-            cur.execute("UPDATE users SET bonus=? WHERE user_id=?", (new_bonus, user_id))
+    ''', (order_search_query(terms), candidates)).fetchall()
+    # Для каждого слова — остаток совпавшего слова столбца: пустой при точном совпадении
+    patterns = [(term, re.compile(r"(?<![^\W_])" + re.escape(term) + r"([^\W_]*)"), len(term) > FIND_PREFIX_MAX)
+                for term in terms]
+    scored = []
+    for row in rows:
+        score = order_search_score(row, patterns)
+        if score is not None:
+            scored.append((-score, -row["id"], row))
+    scored.sort(key=lambda item: item[:2])
+    return [row for _, _, row in scored[:limit]]
+
+def _set_referral_code(conn: sqlite3.Connection, user_id: int, code: str) -> None:
+    # Не INSERT OR REPLACE: при конфликте по уникальному referral_code он удалил бы чужую строку
+    conn.execute(
+        "INSERT INTO users (user_id, referral_code, bonus) VALUES (?, ?, 0) "
+        "ON CONFLICT(user_id) DO UPDATE SET referral_code=excluded.referral_code",
+        (user_id, code)
+    )
+
+def _get_user(conn: sqlite3.Connection, user_id: int) -> Optional[sqlite3.Row]:
+    return conn.execute("SELECT referral_code, bonus FROM users WHERE user_id=?", (user_id,)).fetchone()
+
+def _get_user_summary(conn: sqlite3.Connection, user_id: int) -> Optional[sqlite3.Row]:
+    return conn.execute(
+        "SELECT user_id, referral_code, bonus, orders_count, orders_total FROM users WHERE user_id=?",
+        (user_id,)
+    ).fetchone()
+
+# Счётчики кабинета: статус заказа на них не влияет, в сумму идут все заказы
+def _bump_user_orders(conn: sqlite3.Connection, user_id: int, count: int, total: float) -> None:
+    conn.execute(
+        "INSERT INTO users (user_id, referral_code, bonus, orders_count, orders_total) VALUES (?, NULL, 0, ?, ?) "
+        "ON CONFLICT(user_id) DO UPDATE SET orders_count = orders_count + excluded.orders_count, "
+        "orders_total = orders_total + excluded.orders_total",
+        (user_id, count, total)
+    )
+
+def _get_user_by_referral_code(conn: sqlite3.Connection, code: str) -> Optional[sqlite3.Row]:
+    return conn.execute("SELECT user_id FROM users WHERE referral_code=?", (code,)).fetchone()
+
+# ----- Бонусный журнал -----
+# bonus_ledger — неизменяемый журнал начислений и списаний, users.bonus —
+# кэш текущего баланса. Оба меняются в одной транзакции, а списание — одним
+# условным UPDATE, поэтому параллельные списания не уводят баланс в минус.
+
+def _change_bonus(conn: sqlite3.Connection, user_id: int, amount: int, reason: str,
+                  checkout_id: Optional[int] = None) -> int:
+    conn.execute("INSERT OR IGNORE INTO users (user_id, referral_code, bonus) VALUES (?, NULL, 0)", (user_id,))
+    cur = conn.execute(
+        "UPDATE users SET bonus = bonus + ? WHERE user_id=? AND bonus + ? >= 0",
+        (amount, user_id, amount)
+    )
+    if cur.rowcount == 0:
+        raise ValueError("Недостаточно бонусов для списания")
+    conn.execute(
+        "INSERT INTO bonus_ledger (user_id, amount, reason, checkout_id, created_at) VALUES (?, ?, ?, ?, ?)",
+        (user_id, amount, reason, checkout_id, datetime.now().isoformat())
+    )
+    return conn.execute("SELECT bonus FROM users WHERE user_id=?", (user_id,)).fetchone()["bonus"]
+
+def _get_bonus_history(conn: sqlite3.Connection, user_id: int, limit: int) -> List[sqlite3.Row]:
+    return conn.execute(
+        "SELECT id, amount, reason, checkout_id, created_at FROM bonus_ledger WHERE user_id=? ORDER BY id DESC LIMIT ?",
+        (user_id, limit)
+    ).fetchall()
+
+# Пользователи, у которых кэш баланса разошёлся с суммой журнала
+def _audit_bonus_balances(conn: sqlite3.Connection) -> List[sqlite3.Row]:
+    return conn.execute('''
+        SELECT u.user_id, u.bonus, COALESCE(l.total, 0) AS ledger_total
+        FROM users u
+        LEFT JOIN (SELECT user_id, SUM(amount) AS total FROM bonus_ledger GROUP BY user_id) l
+            ON l.user_id = u.user_id
+        WHERE u.bonus != COALESCE(l.total, 0) OR u.bonus < 0
+    ''').fetchall()
+
+# ----- Состояние диалогов -----
+
+def _load_persistence(conn: sqlite3.Connection, kind: str) -> List[sqlite3.Row]:
+    return conn.execute("SELECT key, data FROM persistence WHERE kind=?", (kind,)).fetchall()
+
+# changes: (kind, key) -> JSON или None для удаления; всё пишется одной транзакцией
+def _save_persistence(conn: sqlite3.Connection, changes: Dict[Tuple[str, str], Optional[str]]) -> None:
+    now = datetime.now().isoformat()
+    conn.executemany(
+        "INSERT INTO persistence (kind, key, data, updated_at) VALUES (?, ?, ?, ?) "
+        "ON CONFLICT(kind, key) DO UPDATE SET data=excluded.data, updated_at=excluded.updated_at",
+        [(kind, key, data, now) for (kind, key), data in changes.items() if data is not None]
+    )
+    conn.executemany(
+        "DELETE FROM persistence WHERE kind=? AND key=?",
+        [(kind, key) for (kind, key), data in changes.items() if data is None]
+    )
+
+# ----- Очередь исходящих сообщений -----
+
+def _enqueue_outbox(conn: sqlite3.Connection, messages: List[Tuple[int, str, str]]) -> List[int]:
+    now = time.time()
+    created_at = datetime.now().isoformat()
+    return [
+        conn.execute(
+            "INSERT INTO outbox (chat_id, method, payload, next_attempt_at, created_at) VALUES (?, ?, ?, ?, ?)",
+            (chat_id, method, payload, now, created_at)
+        ).lastrowid
+        for chat_id, method, payload in messages
+    ]
+
+# Сводка доставки по набору сообщений: счётчики по статусам и последние ошибки
+def _get_outbox_progress(conn: sqlite3.Connection, message_ids: List[int]) -> Tuple[Dict[str, int], List[sqlite3.Row]]:
+    counts: Dict[str, int] = {"pending": 0, "sent": 0, "failed": 0}
+    failed: List[sqlite3.Row] = []
+    for i in range(0, len(message_ids), ORDERS_BATCH_SIZE):
+        chunk = message_ids[i:i + ORDERS_BATCH_SIZE]
+        placeholders = ",".join("?" * len(chunk))
+        for row in conn.execute(f"SELECT status, COUNT(*) AS n FROM outbox WHERE id IN ({placeholders}) GROUP BY status", chunk):
+            counts[row["status"]] += row["n"]
+        failed.extend(conn.execute(
+            f"SELECT chat_id, last_error FROM outbox WHERE status='failed' AND id IN ({placeholders})", chunk
+        ).fetchall())
+    return counts, failed
+
+# Только самое старое pending-сообщение каждого чата и только если его время
+# пришло: пока оно ждёт повтора, более новые сообщения этого чата не уходят
+def _get_due_outbox(conn: sqlite3.Connection, now: float, limit: int) -> List[sqlite3.Row]:
+    return conn.execute('''
+        SELECT o.* FROM outbox o
+        JOIN (SELECT MIN(id) AS id FROM outbox WHERE status='pending' GROUP BY chat_id) AS head ON head.id = o.id
+        WHERE o.next_attempt_at <= ?
+        ORDER BY o.next_attempt_at, o.id LIMIT ?
+    ''', (now, limit)).fetchall()
+
+def _finish_outbox(conn: sqlite3.Connection, message_id: int, status: str, error: Optional[str]) -> None:
+    conn.execute(
+        "UPDATE outbox SET status=?, attempts=attempts+1, last_error=? WHERE id=?",
+        (status, error, message_id)
+    )
+
+def _reschedule_outbox(conn: sqlite3.Connection, message_id: int, next_attempt_at: float, error: str) -> None:
+    conn.execute(
+        "UPDATE outbox SET attempts=attempts+1, next_attempt_at=?, last_error=? WHERE id=?",
+        (next_attempt_at, error, message_id)
+    )
+
+# ----- Архив фото -----
+
+def _queue_media_archive(conn: sqlite3.Connection, file_ids: List[Optional[str]]) -> None:
+    now = time.time()
+    conn.executemany(
+        "INSERT OR IGNORE INTO media_archive (file_id, next_attempt_at) VALUES (?, ?)",
+        [(file_id, now) for file_id in file_ids if file_id]
+    )
+
+def _get_due_media_archive(conn: sqlite3.Connection, now: float, limit: int) -> List[sqlite3.Row]:
+    return conn.execute(
+        "SELECT * FROM media_archive WHERE status='pending' AND next_attempt_at<=? ORDER BY next_attempt_at LIMIT ?",
+        (now, limit)
+    ).fetchall()
+
+def _finish_media_archive(conn: sqlite3.Connection, file_id: str, sha256: str, size: int) -> None:
+    conn.execute(
+        "UPDATE media_archive SET status='archived', sha256=?, size=?, attempts=attempts+1, last_error=NULL, "
+        "archived_at=? WHERE file_id=?",
+        (sha256, size, datetime.now().isoformat(), file_id)
+    )
+
+def _fail_media_archive(conn: sqlite3.Connection, file_id: str, error: str) -> None:
+    conn.execute(
+        "UPDATE media_archive SET status='failed', attempts=attempts+1, last_error=? WHERE file_id=?",
+        (error, file_id)
+    )
+
+def _reschedule_media_archive(conn: sqlite3.Connection, file_id: str, next_attempt_at: float, error: str) -> None:
+    conn.execute(
+        "UPDATE media_archive SET attempts=attempts+1, next_attempt_at=?, last_error=? WHERE file_id=?",
+        (next_attempt_at, error, file_id)
+    )
+
+# Скриншот и квитанция заказа вместе с хэшами их локальных копий
+def _get_order_media(conn: sqlite3.Connection, key: int) -> Optional[sqlite3.Row]:
+    return conn.execute(
+        "SELECT o.id, o.order_id, o.screenshot, o.receipt, "
+        "s.sha256 AS screenshot_sha256, r.sha256 AS receipt_sha256 FROM orders o "
+        "LEFT JOIN media_archive s ON s.file_id = o.screenshot "
+        "LEFT JOIN media_archive r ON r.file_id = o.receipt WHERE o.id=?",
+        (key,)
+    ).fetchone()
+
+def _get_media_archive_stats(conn: sqlite3.Connection) -> sqlite3.Row:
+    return conn.execute(
+        "SELECT COUNT(*) AS total, "
+        "COALESCE(SUM(status='pending'), 0) AS pending, COALESCE(SUM(status='failed'), 0) AS failed, "
+        "COUNT(sha256) AS archived, COUNT(DISTINCT sha256) AS files FROM media_archive"
+    ).fetchone()
+
+def _get_media_file_ids(conn: sqlite3.Connection) -> List[sqlite3.Row]:
+    return conn.execute("SELECT path, content_hash, file_id FROM media_cache").fetchall()
+
+def _set_media_file_id(conn: sqlite3.Connection, path: str, content_hash: str, file_id: str) -> None:
+    conn.execute(
+        "INSERT OR REPLACE INTO media_cache (path, content_hash, file_id, updated_at) VALUES (?, ?, ?, ?)",
+        (path, content_hash, file_id, datetime.now().isoformat())
+    )
+
+def _delete_media_file_id(conn: sqlite3.Connection, path: str) -> None:
+    conn.execute("DELETE FROM media_cache WHERE path=?", (path,))
+
+async def db_insert_order(order: Dict[str, Any]) -> None:
+    await storage.write(_insert_order, order)
+    user_summaries.invalidate(order["user_id"])
+    media_archiver.wake()
+
+async def db_checkout_basket(user_id: int, basket: List[Dict[str, Any]], discount: float = 0,
+                             promo_code: Optional[str] = None, bonus_debit: int = 0,
+                             redemption: Optional[str] = None) -> int:
+    # Скидка и ключи попадают в корзину из user_data только после коммита: при откате
+    # и повторной попытке final_price не уменьшится второй раз
+    items = [dict(item) for item in basket]
+    checkout_id = await storage.write(_checkout_basket, user_id, items, discount, promo_code, bonus_debit, redemption)
+    for item, written in zip(basket, items):
+        item.update(written)
+    user_summaries.invalidate(user_id)
+    media_archiver.wake()
+    return checkout_id
+
+async def db_get_pricing_rules() -> sqlite3.Row:
+    return await storage.read(_get_pricing_rules)
+
+async def db_save_pricing_rules(base_version: int, rules: str, created_by: int) -> int:
+    return await storage.write(_save_pricing_rules, base_version, rules, created_by)
+
+async def db_get_promo(code: str) -> Optional[sqlite3.Row]:
+    return await storage.read(_get_promo, code)
+
+async def db_list_promos() -> List[sqlite3.Row]:
+    return await storage.read(_list_promos)
+
+async def db_upsert_promo(code: str, promo_type: str, discount: int,
+                          max_uses: Optional[int], expires_at: Optional[str]) -> None:
+    await storage.write(_upsert_promo, code, promo_type, discount, max_uses, expires_at)
+
+async def db_has_redeemed(code: str, user_id: int) -> bool:
+    return await storage.read(_has_redeemed, code, user_id)
+
+async def db_update_order_status(key: int, new_status: str) -> Optional[Tuple[str, int]]:
+    changed = await storage.write(_update_order_status, key, new_status)
+    if changed is not None:
+        order_cards.invalidate(key)
+    return changed
+
+async def db_attach_order_receipt(key: int, file_id: str, new_status: str) -> Optional[Tuple[str, int]]:
+    changed = await storage.write(_attach_order_receipt, key, file_id, new_status)
+    order_cards.invalidate(key)
+    media_archiver.wake()
+    return changed
+
+async def db_bulk_update_order_status(new_status: str, order_ids: Optional[List[str]] = None,
+                                      status: Optional[str] = None, date_from: Optional[str] = None,
+                                      date_to: Optional[str] = None) -> Tuple[List[str], List[int], List[str]]:
+    changed, message_ids, unmatched = await storage.write(
+        _bulk_update_order_status, new_status, order_ids, status, date_from, date_to
+    )
+    if changed:
+        order_cards.clear()
+    return changed, message_ids, unmatched
+
+async def db_get_order_stats(dimension: str, limit: int = -1) -> List[sqlite3.Row]:
+    return await storage.read(_get_order_stats, dimension, limit)
+
+async def db_rebuild_order_stats() -> None:
+    await storage.write(_rebuild_order_stats)
+
+async def db_get_order(order_id: str) -> Optional[sqlite3.Row]:
+    return await storage.read(_get_order, order_id)
+
+async def db_get_order_by_key(key: int) -> Optional[sqlite3.Row]:
+    return await storage.read(_get_order_by_key, key)
+
+async def db_get_orders_page(status: Optional[str], category: Optional[str],
+                             cursor: Optional[int], backward: bool, limit: int) -> List[sqlite3.Row]:
+    return await storage.read(_get_orders_page, status, category, cursor, backward, limit)
+
+async def db_search_orders(terms: List[str], limit: int = FIND_RESULTS_LIMIT) -> List[sqlite3.Row]:
+    return await storage.read(_search_orders, terms, limit)
+
+async def db_export_orders(path: str, **conditions: Any) -> int:
+    return await storage.read_dedicated(_export_orders, path, conditions.get("status"), conditions.get("date_from"),
+                                        conditions.get("date_to"), conditions.get("user_id"))
+
+async def db_iter_orders(batch_size: int = ORDERS_BATCH_SIZE,
+                         columns: Tuple[str, ...] = ("order_id", "order_name", "status")) -> AsyncIterator[sqlite3.Row]:
+    after_id = 0
+    while True:
+        rows = await storage.read(_get_orders_batch, after_id, batch_size, columns)
+        for row in rows:
+            yield row
+        if len(rows) < batch_size:
+            return
+        after_id = rows[-1]["id"]
+
+async def db_get_user_orders_page(user_id: int, before_id: Optional[int], limit: int) -> List[sqlite3.Row]:
+    return await storage.read(_get_user_orders_page, user_id, before_id, limit)
+
+async def db_set_referral_code(user_id: int, code: str) -> None:
+    await storage.write(_set_referral_code, user_id, code)
+    user_summaries.invalidate(user_id)
+
+# Реферальные коды уникальны (idx_users_referral_code): при коллизии генерируем новый
+async def issue_referral_code(user_id: int, attempts: int = 5) -> str:
+    for attempt in range(attempts):
+        code = generate_random_code()
+        try:
+            await db_set_referral_code(user_id, code)
+            return code
+        except sqlite3.IntegrityError:
+            if attempt == attempts - 1:
+                raise
+            logger.warning("Коллизия реферального кода %s, генерируем заново", code)
+
+async def db_get_user(user_id: int) -> Optional[sqlite3.Row]:
+    return await storage.read(_get_user, user_id)
+
+async def db_get_user_summary(user_id: int) -> Optional[sqlite3.Row]:
+    return await storage.read(_get_user_summary, user_id)
+
+async def db_get_user_by_referral_code(code: str) -> Optional[sqlite3.Row]:
+    return await storage.read(_get_user_by_referral_code, code)
+
+async def db_change_bonus(user_id: int, amount: int, reason: str, checkout_id: Optional[int] = None) -> int:
+    balance = await storage.write(_change_bonus, user_id, amount, reason, checkout_id)
+    user_summaries.invalidate(user_id)
+    return balance
+
+async def db_get_bonus_history(user_id: int, limit: int = BONUS_HISTORY_LIMIT) -> List[sqlite3.Row]:
+    return await storage.read(_get_bonus_history, user_id, limit)
+
+async def db_audit_bonus_balances() -> List[sqlite3.Row]:
+    return await storage.read(_audit_bonus_balances)
+
+async def db_enqueue_outbox(messages: List[Tuple[int, str, str]]) -> List[int]:
+    return await storage.write(_enqueue_outbox, messages)
+
+async def db_get_outbox_progress(message_ids: List[int]) -> Tuple[Dict[str, int], List[sqlite3.Row]]:
+    return await storage.read(_get_outbox_progress, message_ids)
+
+async def db_get_due_outbox(now: float, limit: int) -> List[sqlite3.Row]:
+    return await storage.read(_get_due_outbox, now, limit)
+
+async def db_finish_outbox(message_id: int, status: str, error: Optional[str] = None) -> None:
+    await storage.write(_finish_outbox, message_id, status, error)
+
+async def db_reschedule_outbox(message_id: int, next_attempt_at: float, error: str) -> None:
+    await storage.write(_reschedule_outbox, message_id, next_attempt_at, error)
+
+async def db_get_due_media_archive(now: float, limit: int) -> List[sqlite3.Row]:
+    return await storage.read(_get_due_media_archive, now, limit)
+
+async def db_finish_media_archive(file_id: str, sha256: str, size: int) -> None:
+    await storage.write(_finish_media_archive, file_id, sha256, size)
+
+async def db_fail_media_archive(file_id: str, error: str) -> None:
+    await storage.write(_fail_media_archive, file_id, error)
+
+async def db_reschedule_media_archive(file_id: str, next_attempt_at: float, error: str) -> None:
+    await storage.write(_reschedule_media_archive, file_id, next_attempt_at, error)
+
+async def db_get_order_media(key: int) -> Optional[sqlite3.Row]:
+    return await storage.read(_get_order_media, key)
+
+async def db_get_media_archive_stats() -> sqlite3.Row:
+    return await storage.read(_get_media_archive_stats)
+
+async def db_get_media_file_ids() -> List[sqlite3.Row]:
+    return await storage.read(_get_media_file_ids)
+
+async def db_set_media_file_id(path: str, content_hash: str, file_id: str) -> None:
+    await storage.write(_set_media_file_id, path, content_hash, file_id)
+
+async def db_delete_media_file_id(path: str) -> None:
+    await storage.write(_delete_media_file_id, path)
+
+# ================= Кэш медиафайлов =================
+
+# Статичные картинки загружаются в Telegram один раз, дальше отправляется file_id.
+# Ключ — путь к файлу и хэш содержимого: изменённый файл загружается заново,
+# а отвергнутый Telegram file_id удаляется и файл перезаливается.
+class MediaRegistry:
+    def __init__(self) -> None:
+        self._file_ids: Dict[str, Tuple[str, str]] = {}
+        self._hashes: Dict[str, Tuple[float, int, str]] = {}
+        self._loaded = False
+
+    def content_hash(self, path: str) -> str:
+        stat = os.stat(path)
+        cached = self._hashes.get(path)
+        if cached and cached[0] == stat.st_mtime and cached[1] == stat.st_size:
+            return cached[2]
+        with open(path, "rb") as f:
+            digest = hashlib.sha256(f.read()).hexdigest()
+        self._hashes[path] = (stat.st_mtime, stat.st_size, digest)
+        return digest
+
+    async def _load(self) -> None:
+        if self._loaded:
+            return
+        for row in await db_get_media_file_ids():
+            self._file_ids[row["path"]] = (row["content_hash"], row["file_id"])
+        self._loaded = True
+
+    async def get_file_id(self, path: str, digest: str) -> Optional[str]:
+        await self._load()
+        cached = self._file_ids.get(path)
+        if cached and cached[0] == digest:
+            return cached[1]
+        return None
+
+    async def remember(self, path: str, digest: str, file_id: str) -> None:
+        self._file_ids[path] = (digest, file_id)
+        await db_set_media_file_id(path, digest, file_id)
+
+    async def forget(self, path: str) -> None:
+        self._file_ids.pop(path, None)
+        await db_delete_media_file_id(path)
+
+    # send — reply_photo или bot.send_photo с уже подставленными chat_id/caption
+    async def send_photo(self, send: Callable[..., Awaitable[Message]], path: str, **kwargs: Any) -> Message:
+        digest = self.content_hash(path)
+        file_id = await self.get_file_id(path, digest)
+        if file_id:
+            try:
+                return await send(photo=file_id, **kwargs)
+            except BadRequest as e:
+                logger.warning("file_id для %s отвергнут Telegram (%s), загружаем заново", path, e)
+                await self.forget(path)
+        with open(path, "rb") as photo:
+            message = await send(photo=photo, **kwargs)
+        await self.remember(path, digest, message.photo[-1].file_id)
+        return message
+
+    async def send_media_group(self, bot: Any, chat_id: int, paths: List[str]) -> None:
+        paths = [p for p in paths if os.path.exists(p)]
+        if not paths:
+            return
+        digests = [self.content_hash(p) for p in paths]
+        file_ids = [await self.get_file_id(p, d) for p, d in zip(paths, digests)]
+        if all(file_ids):
+            try:
+                await bot.send_media_group(chat_id=chat_id, media=[InputMediaPhoto(media=fid) for fid in file_ids])
+                return
+            except BadRequest as e:
+                logger.warning("file_id медиа-группы отвергнуты Telegram (%s), загружаем заново", e)
+                for p in paths:
+                    await self.forget(p)
+        files = [open(p, "rb") for p in paths]
+        try:
+            messages = await bot.send_media_group(chat_id=chat_id, media=[InputMediaPhoto(media=f) for f in files])
+        finally:
+            for f in files:
+                f.close()
+        for p, d, message in zip(paths, digests, messages):
+            if message.photo:
+                await self.remember(p, d, message.photo[-1].file_id)
+
+media_registry = MediaRegistry()
+
+# ================= Промокоды =================
+
+# Горячий кэш промокодов поверх БД. Кэшируются только найденные коды; запись
+# сбрасывается по TTL, при изменении кода админом и после погашения.
+class PromoCache:
+    def __init__(self, ttl: float = PROMO_CACHE_TTL) -> None:
+        self.ttl = ttl
+        self._entries: Dict[str, Tuple[float, sqlite3.Row]] = {}
+
+    async def get(self, code: str) -> Optional[sqlite3.Row]:
+        now = time.monotonic()
+        entry = self._entries.get(code)
+        if entry and entry[0] > now:
+            return entry[1]
+        promo = await db_get_promo(code)
+        if promo is None:
+            self._entries.pop(code, None)
+        else:
+            self._entries[code] = (now + self.ttl, promo)
+        return promo
+
+    def invalidate(self, code: Optional[str] = None) -> None:
+        if code is None:
+            self._entries.clear()
+        else:
+            self._entries.pop(code, None)
+
+promo_cache = PromoCache()
+
+# Предварительная проверка кода перед оформлением: возвращает (скидка, вид погашения)
+# или None. Окончательная проверка — в транзакции db_checkout_basket.
+async def resolve_discount_code(code: str, user_id: int) -> Optional[Tuple[int, str]]:
+    promo = await promo_cache.get(code)
+    if promo is not None:
+        if promo_expired(promo):
+            return None
+        if promo["max_uses"] is not None and promo["uses"] >= promo["max_uses"]:
+            return None
+        if promo["type"] == "one-time" and await db_has_redeemed(code, user_id):
+            return None
+        return promo["discount"], "promo"
+    row = await db_get_user_by_referral_code(code)
+    if row and row["user_id"] != user_id and not await db_has_redeemed(code, user_id):
+        return REFERRAL_DISCOUNT, "referral"
+    return None
+
+# ================= Ценообразование =================
+
+# Неизменяемый снимок одной версии правил. Пороги комиссий разложены в
+# отсортированные кортежи, так что комиссия ищется бинарным поиском.
+class PricingRules:
+    __slots__ = ("version", "rate", "rounding", "rules", "_commissions")
+
+    def __init__(self, version: int, rules: Dict[str, Any]) -> None:
+        commissions: Dict[str, Tuple[float, Tuple[float, ...], Tuple[float, ...]]] = {}
+        for category, spec in rules["commission"].items():
+            tiers = sorted((float(threshold), float(value)) for threshold, value in spec.get("tiers", []))
+            commissions[category] = (
+                float(spec["base"]),
+                tuple(threshold for threshold, _ in tiers),
+                tuple(value for _, value in tiers),
+            )
+        if "*" not in commissions:
+            raise ValueError("Нет комиссии по умолчанию (категория *)")
+        rate = float(rules["rate"])
+        rounding = float(rules.get("rounding", 0))
+        if rate <= 0 or rounding < 0:
+            raise ValueError("Курс должен быть больше нуля, шаг округления — не меньше нуля")
+        self.version = version
+        self.rate = rate
+        self.rounding = rounding
+        self.rules = json.dumps(rules, ensure_ascii=False, sort_keys=True)
+        self._commissions = commissions
+
+    def __setattr__(self, name: str, value: Any) -> None:
+        if hasattr(self, "_commissions"):
+            raise AttributeError("PricingRules неизменяем")
+        object.__setattr__(self, name, value)
+
+    # Копия правил в виде словаря — основа для следующей версии
+    def to_dict(self) -> Dict[str, Any]:
+        return json.loads(self.rules)
+
+    def _round(self, value: float) -> float:
+        if not self.rounding:
+            return value
+        # round() гасит погрешность float, чтобы 1300.0000001 не ушло на следующий шаг
+        return math.ceil(round(value / self.rounding, 9)) * self.rounding
+
+    def commission(self, category: Optional[str], price_yuan: float) -> float:
+        base, thresholds, values = self._commissions.get(category) or self._commissions["*"]
+        idx = bisect.bisect_left(thresholds, price_yuan)
+        return values[idx - 1] if idx else base
+
+    # -> (комиссия, итоговая цена)
+    def quote(self, category: Optional[str], price_yuan: float) -> Tuple[float, float]:
+        commission = self.commission(category, price_yuan)
+        return commission, self._round(price_yuan * self.rate + commission)
+
+    # Пакетный расчёт для отчётов: правила категории разрешаются один раз на
+    # категорию, а не на каждую позицию
+    def quote_many(self, items: List[Tuple[Optional[str], float]]) -> List[Tuple[float, float]]:
+        rate = self.rate
+        round_ = self._round
+        bisect_left = bisect.bisect_left
+        default = self._commissions["*"]
+        resolved: Dict[Optional[str], Tuple[float, Tuple[float, ...], Tuple[float, ...]]] = {}
+        result: List[Tuple[float, float]] = []
+        append = result.append
+        for category, price_yuan in items:
+            spec = resolved.get(category)
+            if spec is None:
+                spec = resolved[category] = self._commissions.get(category) or default
+            base, thresholds, values = spec
+            idx = bisect_left(thresholds, price_yuan)
+            commission = values[idx - 1] if idx else base
+            append((commission, round_(price_yuan * rate + commission)))
+        return result
+
+# Держит текущий снимок правил. Смена правил — одна запись в pricing_rules и
+# замена ссылки на снимок; уже начатые расчёты дорабатывают со старым снимком.
+class PricingEngine:
+    def __init__(self) -> None:
+        self._snapshot: Optional[PricingRules] = None
+
+    async def current(self) -> PricingRules:
+        if self._snapshot is None:
+            await self.reload()
+        return self._snapshot
+
+    async def reload(self) -> PricingRules:
+        row = await db_get_pricing_rules()
+        self._snapshot = PricingRules(row["version"], json.loads(row["rules"]))
+        return self._snapshot
+
+    # change правит копию текущих правил; результат проверяется до сохранения
+    async def update(self, change: Callable[[Dict[str, Any]], None], created_by: int) -> PricingRules:
+        current = await self.current()
+        rules = current.to_dict()
+        change(rules)
+        PricingRules(0, rules)
+        await db_save_pricing_rules(current.version, json.dumps(rules, ensure_ascii=False), created_by)
+        return await self.reload()
+
+pricing = PricingEngine()
+
+# ================= Сохранение диалогов =================
+
+# Persistence для Application: user_data, chat_data и состояния ConversationHandler
+# хранятся в таблице persistence в виде JSON. PTB раз в PERSISTENCE_UPDATE_INTERVAL
+# передаёт изменённые записи, они копятся в _dirty и пишутся одной транзакцией.
+class SQLitePersistence(BasePersistence):
+    def __init__(self, update_interval: float = PERSISTENCE_UPDATE_INTERVAL) -> None:
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=True, user_data=True, callback_data=False),
+            update_interval=update_interval,
+        )
+        self._dirty: Dict[Tuple[str, str], Optional[str]] = {}
+        self._flush_task: Optional[asyncio.Task] = None
+
+    async def _load(self, kind: str) -> Dict[str, Any]:
+        return {row["key"]: json.loads(row["data"]) for row in await storage.read(_load_persistence, kind)}
+
+    def _mark_dirty(self, kind: str, key: str, data: Any) -> None:
+        self._dirty[(kind, key)] = None if data is None else json.dumps(data, ensure_ascii=False)
+        # PTB вызывает update_* пачкой через gather: задача сброса, созданная первым
+        # вызовом, выполнится после остальных и запишет их все разом
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._write_dirty())
+
+    async def _write_dirty(self) -> None:
+        while self._dirty:
+            changes, self._dirty = self._dirty, {}
+            try:
+                await storage.write(_save_persistence, changes)
+            except Exception:
+                # Не теряем изменения: вернём их, если новее ничего не пришло
+                for key, data in changes.items():
+                    self._dirty.setdefault(key, data)
+                raise
+
+    async def get_user_data(self) -> Dict[int, Dict[Any, Any]]:
+        return {int(key): data for key, data in (await self._load("user_data")).items()}
+
+    async def get_chat_data(self) -> Dict[int, Dict[Any, Any]]:
+        return {int(key): data for key, data in (await self._load("chat_data")).items()}
+
+    async def get_bot_data(self) -> Dict[Any, Any]:
+        return {}
+
+    async def get_callback_data(self) -> None:
+        return None
+
+    async def get_conversations(self, name: str) -> Dict[Tuple[Union[int, str], ...], object]:
+        return {tuple(json.loads(key)): state for key, state in (await self._load(f"conversation:{name}")).items()}
+
+    async def update_conversation(self, name: str, key: Tuple[Union[int, str], ...], new_state: Optional[object]) -> None:
+        self._mark_dirty(f"conversation:{name}", json.dumps(list(key)), new_state)
+
+    async def update_user_data(self, user_id: int, data: Dict[Any, Any]) -> None:
+        self._mark_dirty("user_data", str(user_id), data)
+
+    async def update_chat_data(self, chat_id: int, data: Dict[Any, Any]) -> None:
+        self._mark_dirty("chat_data", str(chat_id), data)
+
+    async def update_bot_data(self, data: Dict[Any, Any]) -> None:
+        pass
+
+    async def update_callback_data(self, data: Any) -> None:
+        pass
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        self._mark_dirty("chat_data", str(chat_id), None)
+
+    async def drop_user_data(self, user_id: int) -> None:
+        self._mark_dirty("user_data", str(user_id), None)
+
+    async def refresh_user_data(self, user_id: int, user_data: Dict[Any, Any]) -> None:
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: Dict[Any, Any]) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data: Dict[Any, Any]) -> None:
+        pass
+
+    async def flush(self) -> None:
+        if self._flush_task is not None:
+            await asyncio.gather(self._flush_task, return_exceptions=True)
+        await self._write_dirty()
+
+# ================= Исходящие уведомления =================
+
+# Корзина токенов: rate токенов в секунду, не больше capacity
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    # Сколько ждать, пока накопится cost токенов
+    def delay(self, cost: float = 1.0) -> float:
+        self._refill()
+        return 0.0 if self.tokens >= cost else (cost - self.tokens) / self.rate
+
+    def consume(self, cost: float = 1.0) -> None:
+        self._refill()
+        self.tokens -= cost
+
+# Обработчики кладут уведомления в таблицу outbox и сразу отвечают пользователю.
+# Фоновый Outbox рассылает их с ограничением скорости (общий и по чатам),
+# сохраняя порядок сообщений в одном чате: из чата берётся только самое старое
+# неотправленное сообщение, даже если оно ждёт повтора. При RetryAfter вся отправка ставится
+# на паузу на указанное Telegram время, сетевые ошибки повторяются с backoff,
+# Forbidden/BadRequest и исчерпание попыток помечают сообщение как failed.
+class Outbox:
+    def __init__(self) -> None:
+        self.global_bucket = TokenBucket(OUTBOX_GLOBAL_RATE, OUTBOX_GLOBAL_RATE)
+        self._chat_buckets: Dict[int, TokenBucket] = {}
+        self._busy_chats: Set[int] = set()
+        self._in_flight: Set[int] = set()
+        self._semaphore = asyncio.Semaphore(OUTBOX_CONCURRENCY)
+        self._wakeup = asyncio.Event()
+        self._paused_until = 0.0
+        self._task: Optional[asyncio.Task] = None
+        self._bot: Any = None
+
+    async def enqueue(self, chat_id: int, method: str, **kwargs: Any) -> None:
+        await self.enqueue_many([(chat_id, method, kwargs)])
+
+    async def enqueue_many(self, messages: List[Tuple[int, str, Dict[str, Any]]]) -> List[int]:
+        message_ids = await db_enqueue_outbox([
+            (chat_id, method, json.dumps(kwargs, ensure_ascii=False)) for chat_id, method, kwargs in messages
+        ])
+        self.wake()
+        return message_ids
+
+    # Для сообщений, записанных в outbox в чужой транзакции
+    def wake(self) -> None:
+        self._wakeup.set()
+
+    def start(self, bot: Any) -> None:
+        self._bot = bot
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self._chat_buckets) > 10000:
+                # Полные корзины ничего не ограничивают — их можно выбросить
+                self._chat_buckets = {k: b for k, b in self._chat_buckets.items() if b.delay(OUTBOX_CHAT_BURST) > 0}
+            bucket = self._chat_buckets[chat_id] = TokenBucket(OUTBOX_CHAT_RATE, OUTBOX_CHAT_BURST)
+        return bucket
+
+    async def _run(self) -> None:
+        while True:
+            started = 0
+            try:
+                # Снимок до чтения: отправка, завершившаяся во время чтения,
+                # иначе выглядела бы как новое pending-сообщение
+                in_flight = set(self._in_flight)
+                rows = await db_get_due_outbox(time.time(), OUTBOX_BATCH_SIZE)
+                for row in rows:
+                    chat_id = row["chat_id"]
+                    if row["id"] in in_flight or chat_id in self._busy_chats:
+                        continue
+                    if self._chat_bucket(chat_id).delay() > 0:
+                        continue
+                    pause = self._paused_until - time.monotonic()
+                    if pause > 0:
+                        await asyncio.sleep(pause)
+                    await asyncio.sleep(self.global_bucket.delay())
+                    self.global_bucket.consume()
+                    self._chat_bucket(chat_id).consume()
+                    await self._semaphore.acquire()
+                    self._in_flight.add(row["id"])
+                    self._busy_chats.add(chat_id)
+                    asyncio.create_task(self._deliver(row))
+                    started += 1
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error("Ошибка очереди уведомлений: %s", e)
+            if not started:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), OUTBOX_POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+                self._wakeup.clear()
+
+    async def _deliver(self, row: sqlite3.Row) -> None:
+        try:
+            await getattr(self._bot, row["method"])(chat_id=row["chat_id"], **json.loads(row["payload"]))
+            await db_finish_outbox(row["id"], "sent")
+        except RetryAfter as e:
+            self._paused_until = max(self._paused_until, time.monotonic() + float(e.retry_after))
+            logger.warning("Flood control: пауза отправки на %s с", e.retry_after)
+            await db_reschedule_outbox(row["id"], time.time() + float(e.retry_after), str(e))
+        except (Forbidden, BadRequest) as e:
+            logger.error("Уведомление в чат %s не доставлено: %s", row["chat_id"], e)
+            await db_finish_outbox(row["id"], "failed", str(e))
+        except TelegramError as e:
+            if row["attempts"] + 1 >= OUTBOX_MAX_ATTEMPTS:
+                logger.error("Уведомление в чат %s не доставлено после %s попыток: %s", row["chat_id"], row["attempts"] + 1, e)
+                await db_finish_outbox(row["id"], "failed", str(e))
+            else:
+                backoff = min(OUTBOX_MAX_BACKOFF, OUTBOX_BASE_BACKOFF * 2 ** row["attempts"])
+                await db_reschedule_outbox(row["id"], time.time() + backoff, str(e))
+        except Exception as e:
+            logger.error("Ошибка отправки уведомления %s: %s", row["id"], e)
+            await db_finish_outbox(row["id"], "failed", str(e))
+        finally:
+            self._in_flight.discard(row["id"])
+            self._busy_chats.discard(row["chat_id"])
+            self._semaphore.release()
+            self._wakeup.set()
+
+outbox = Outbox()
+
+# Задачи прогресса рассылок. Запускаются мимо application.create_task: иначе
+# Application.stop() ждал бы их до OUTBOX_PROGRESS_TIMEOUT; on_shutdown их отменяет
+_progress_tasks: Set[asyncio.Task] = set()
+
+def start_outbox_progress(message: Message, message_ids: List[int], title: str) -> None:
+    task = asyncio.create_task(report_outbox_progress(message, message_ids, title))
+    _progress_tasks.add(task)
+    task.add_done_callback(_progress_tasks.discard)
+
+async def cancel_outbox_progress() -> None:
+    tasks = list(_progress_tasks)
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+# Периодически обновляет сообщение message сводкой доставки рассылки
+async def report_outbox_progress(message: Message, message_ids: List[int], title: str) -> None:
+    deadline = time.monotonic() + OUTBOX_PROGRESS_TIMEOUT
+    last_text = None
+    while True:
+        counts, failed = await db_get_outbox_progress(message_ids)
+        done = counts["pending"] == 0
+        lines = [
+            title,
+            f"Доставлено: {counts['sent']}/{len(message_ids)}, ошибок: {counts['failed']}, в очереди: {counts['pending']}",
+        ]
+        if done or time.monotonic() >= deadline:
+            if failed:
+                lines.append("\nНе доставлено:")
+                lines.extend(f"{row['chat_id']}: {row['last_error']}" for row in failed[:OUTBOX_PROGRESS_FAILURES])
+                if len(failed) > OUTBOX_PROGRESS_FAILURES:
+                    lines.append(f"…и ещё {len(failed) - OUTBOX_PROGRESS_FAILURES}")
+            if not done:
+                lines.append("\nОстальные сообщения остаются в очереди.")
+        text = "\n".join(lines)
+        if text != last_text:
+            try:
+                await message.edit_text(text[:TELEGRAM_MESSAGE_LIMIT])
+                last_text = text
+            except TelegramError as e:
+                logger.warning("Не удалось обновить прогресс рассылки: %s", e)
+        if done or time.monotonic() >= deadline:
+            return
+        await asyncio.sleep(OUTBOX_PROGRESS_INTERVAL)
+
+# ================= Планировщик обновлений =================
+
+class UpdateLane:
+    __slots__ = ("lock", "depth")
+
+    def __init__(self) -> None:
+        self.lock = asyncio.Lock()
+        self.depth = 0
+
+# Параллельная обработка обновлений с сохранением порядка для каждого
+# пользователя. Обновления одного ключа (пользователь, иначе чат) проходят
+# через его asyncio.Lock по одному и в порядке поступления, поэтому фото и
+# текст одного клиента не гоняются в ConversationHandler. Слот из общего
+# семафора берётся только после блокировки ключа: очередь одного пользователя
+# не занимает слоты, нужные остальным. Ключ без ожидающих обновлений сразу
+# удаляется.
+class KeyedUpdateProcessor(BaseUpdateProcessor):
+    def __init__(self, concurrency: int = UPDATE_CONCURRENCY, max_pending: int = UPDATE_MAX_PENDING) -> None:
+        # Семафор базового класса ограничивает все принятые обновления, свой — выполняющиеся
+        super().__init__(max(max_pending, concurrency))
+        self.concurrency = concurrency
+        self._slots = asyncio.Semaphore(concurrency)
+        self._lanes: Dict[int, UpdateLane] = {}
+        self.running = 0
+        self.waiting = 0
+        self.processed = 0
+        self.wait_time = Histogram()
+        metrics.gauges.update({
+            "bot_updates_running": lambda: self.running,
+            "bot_updates_waiting": lambda: self.waiting,
+            "bot_update_keys": lambda: len(self._lanes),
+            "bot_update_max_key_depth": self.max_depth,
+        })
+
+    @staticmethod
+    def update_key(update: object) -> Optional[int]:
+        if isinstance(update, Update):
+            if update.effective_user is not None:
+                return update.effective_user.id
+            if update.effective_chat is not None:
+                return update.effective_chat.id
+        return None
+
+    def max_depth(self) -> int:
+        return max((lane.depth for lane in self._lanes.values()), default=0)
+
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        key = self.update_key(update)
+        lane = None
+        if key is not None:
+            lane = self._lanes.get(key)
+            if lane is None:
+                lane = self._lanes[key] = UpdateLane()
+            lane.depth += 1
+        queued = time.perf_counter()
+        self.waiting += 1
+        started = False
+        try:
+            if lane is not None:
+                await lane.lock.acquire()
+            try:
+                async with self._slots:
+                    self.waiting -= 1
+                    started = True
+                    self.wait_time.observe(time.perf_counter() - queued)
+                    self.running += 1
+                    try:
+                        await coroutine
+                    finally:
+                        self.running -= 1
+                        self.processed += 1
+            finally:
+                if lane is not None:
+                    lane.lock.release()
+        finally:
+            if not started:
+                self.waiting -= 1
+                # Отменено в очереди: корутина обработки так и не запускалась
+                if asyncio.iscoroutine(coroutine):
+                    coroutine.close()
+            if lane is not None:
+                lane.depth -= 1
+                if lane.depth == 0:
+                    del self._lanes[key]
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    def stats_text(self) -> str:
+        return (
+            f"Обновления: выполняется {self.running}/{self.concurrency}, в очереди {self.waiting}, "
+            f"ключей {len(self._lanes)}, макс. очередь ключа {self.max_depth()}, обработано {self.processed}, "
+            f"ожидание p95 {self.wait_time.quantile(0.95) * 1000:.0f} мс"
+        )
+
+# ================= Архив скриншотов и квитанций =================
+
+# Хранилище с адресацией по содержимому: файл лежит под своим sha256 в
+# подкаталогах по первым байтам хэша, одинаковые фото хранятся один раз.
+# Запись идёт через временный файл и os.replace, так что файл под хэшем
+# всегда целый.
+class MediaStore:
+    def __init__(self, root: str) -> None:
+        self.root = root
+
+    def path_for(self, digest: str) -> str:
+        return os.path.join(self.root, digest[:2], digest[2:4], digest)
+
+    def put(self, data: bytes) -> str:
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.path_for(digest)
+        if os.path.exists(path):
+            return digest
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, path)
+        except BaseException:
+            with suppress(OSError):
+                os.unlink(tmp_path)
+            raise
+        return digest
+
+    def read(self, digest: str) -> bytes:
+        with open(self.path_for(digest), "rb") as f:
+            return f.read()
+
+media_store = MediaStore(MEDIA_ARCHIVE_DIR)
+
+# Фоновый архиватор: берёт из media_archive фото, ещё не скачанные, и
+# скачивает их не больше чем MEDIA_ARCHIVE_CONCURRENCY одновременно.
+# Устройство как у Outbox: RetryAfter ставит паузу, сетевые ошибки
+# повторяются с backoff, отвергнутый Telegram file_id помечается failed.
+class MediaArchiver:
+    def __init__(self, store: MediaStore) -> None:
+        self.store = store
+        self._in_flight: Set[str] = set()
+        self._semaphore = asyncio.Semaphore(MEDIA_ARCHIVE_CONCURRENCY)
+        self._wakeup = asyncio.Event()
+        self._paused_until = 0.0
+        self._task: Optional[asyncio.Task] = None
+        self._bot: Any = None
+
+    def wake(self) -> None:
+        self._wakeup.set()
+
+    def start(self, bot: Any) -> None:
+        self._bot = bot
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run(self) -> None:
+        while True:
+            started = 0
+            try:
+                in_flight = set(self._in_flight)
+                rows = await db_get_due_media_archive(time.time(), MEDIA_ARCHIVE_BATCH_SIZE)
+                for row in rows:
+                    if row["file_id"] in in_flight:
+                        continue
+                    pause = self._paused_until - time.monotonic()
+                    if pause > 0:
+                        await asyncio.sleep(pause)
+                    await self._semaphore.acquire()
+                    self._in_flight.add(row["file_id"])
+                    asyncio.create_task(self._archive(row))
+                    started += 1
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error("Ошибка архива фото: %s", e)
+            if not started:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), MEDIA_ARCHIVE_POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+                self._wakeup.clear()
+
+    async def _archive(self, row: sqlite3.Row) -> None:
+        file_id = row["file_id"]
+        try:
+            file = await self._bot.get_file(file_id)
+            data = bytes(await file.download_as_bytearray())
+            digest = await asyncio.to_thread(self.store.put, data)
+            await db_finish_media_archive(file_id, digest, len(data))
+        except RetryAfter as e:
+            self._paused_until = max(self._paused_until, time.monotonic() + float(e.retry_after))
+            await db_reschedule_media_archive(file_id, time.time() + float(e.retry_after), str(e))
+        except BadRequest as e:
+            logger.error("Фото %s не скачать: %s", file_id, e)
+            await db_fail_media_archive(file_id, str(e))
+        except (TelegramError, OSError) as e:
+            if row["attempts"] + 1 >= MEDIA_ARCHIVE_MAX_ATTEMPTS:
+                logger.error("Фото %s не скачано после %s попыток: %s", file_id, row["attempts"] + 1, e)
+                await db_fail_media_archive(file_id, str(e))
+            else:
+                backoff = min(MEDIA_ARCHIVE_MAX_BACKOFF, MEDIA_ARCHIVE_BASE_BACKOFF * 2 ** row["attempts"])
+                await db_reschedule_media_archive(file_id, time.time() + backoff, str(e))
+        except Exception as e:
+            logger.error("Ошибка архивации фото %s: %s", file_id, e)
+            await db_fail_media_archive(file_id, str(e))
+        finally:
+            self._in_flight.discard(file_id)
+            self._semaphore.release()
+            self._wakeup.set()
+
+media_archiver = MediaArchiver(media_store)
+
+# Отправляет фото по file_id, а если Telegram его больше не принимает —
+# локальную копию из архива. Возвращает False, если фото взять негде.
+async def send_archived_photo(bot: Any, chat_id: int, file_id: str, digest: Optional[str], caption: str) -> bool:
+    try:
+        await bot.send_photo(chat_id, file_id, caption=caption)
+        return True
+    except BadRequest as e:
+        if digest is None:
+            logger.error("Фото %s недоступно и не архивировано: %s", file_id, e)
+            return False
+        logger.warning("Фото %s недоступно в Telegram (%s), отправляем копию из архива", file_id, e)
+    try:
+        data = await asyncio.to_thread(media_store.read, digest)
+    except OSError as e:
+        logger.error("Копия фото %s не прочитана: %s", digest, e)
+        return False
+    await bot.send_photo(chat_id, data, caption=caption)
+    return True
+
+# ================= Ограничение частоты запросов =================
+
+class UserLimits:
+    def __init__(self) -> None:
+        self.buckets = {kind: TokenBucket(rate, burst) for kind, (rate, burst) in RATE_LIMITS.items()}
+        self.warned_at = 0.0
+
+# Защита от флуда: обработчик в группе -1 видит каждое обновление раньше
+# остальных и прерывает обработку через ApplicationHandlerStop, если у
+# пользователя (или у бота в целом) закончились токены. Состояние хранится
+# в LRU с ограниченным числом пользователей: давно не писавшие вытесняются,
+# а новая корзина всё равно начинается полной.
+class RateLimiter:
+    def __init__(self, max_users: int = RATE_LIMIT_MAX_USERS) -> None:
+        self.max_users = max_users
+        self.global_bucket = TokenBucket(*RATE_LIMIT_GLOBAL)
+        self._users: "OrderedDict[int, UserLimits]" = OrderedDict()
+        self.dropped: Dict[str, int] = {kind: 0 for kind in RATE_LIMITS}
+        self.dropped_global = 0
+        self.evicted = 0
+
+    @staticmethod
+    def update_kind(update: Update) -> str:
+        if update.callback_query:
+            return "callback"
+        message = update.effective_message
+        if message and (message.photo or message.document):
+            return "photo"
+        if message and message.text and message.text.startswith("/"):
+            return "command"
+        return "text"
+
+    def _limits(self, user_id: int) -> UserLimits:
+        limits = self._users.get(user_id)
+        if limits is None:
+            limits = self._users[user_id] = UserLimits()
+            if len(self._users) > self.max_users:
+                self._users.popitem(last=False)
+                self.evicted += 1
+        else:
+            self._users.move_to_end(user_id)
+        return limits
+
+    async def __call__(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        user = update.effective_user
+        if user is None or user.id in ADMIN_IDS:
+            return
+        kind = self.update_kind(update)
+        limits = self._limits(user.id)
+        bucket = limits.buckets[kind]
+        if bucket.delay() > 0:
+            self.dropped[kind] += 1
+            await self._warn(update, limits)
+            raise ApplicationHandlerStop
+        if self.global_bucket.delay() > 0:
+            self.dropped_global += 1
+            raise ApplicationHandlerStop
+        bucket.consume()
+        self.global_bucket.consume()
+
+    async def _warn(self, update: Update, limits: UserLimits) -> None:
+        now = time.monotonic()
+        warn = now - limits.warned_at >= RATE_LIMIT_WARN_INTERVAL
+        if warn:
+            limits.warned_at = now
+        text = "Слишком много запросов. Подождите немного и попробуйте снова."
+        # Устаревший или уже отвеченный запрос даёт BadRequest — обновление
+        # всё равно отбрасывается, ошибка не должна из него выйти
+        try:
+            if update.callback_query:
+                await update.callback_query.answer(text if warn else None)
+            elif warn and update.effective_message:
+                await update.effective_message.reply_text(text)
+        except TelegramError as e:
+            logger.warning("Не удалось предупредить пользователя о лимите: %s", e)
+
+    def stats_text(self) -> str:
+        dropped = ", ".join(f"{kind}: {count}" for kind, count in self.dropped.items())
+        return (
+            f"Отброшено по лимиту пользователя: {dropped}\n"
+            f"Отброшено по общему лимиту: {self.dropped_global}\n"
+            f"Пользователей в памяти: {len(self._users)} (вытеснено: {self.evicted})"
+        )
+
+rate_limiter = RateLimiter()
+
+# ================= Вспомогательные функции =================
+
+def generate_random_code(length: int = 6) -> str:
+    return ''.join(random.choices(string.ascii_uppercase + string.digits, k=length))
+
+# Генератор ключей заказов: монотонно растёт в пределах процесса (при нескольких
+# заказах в одну миллисекунду увеличивается счётчик), а случайное начало
+# счётчика снижает шанс совпадения ключей после перезапуска
+class OrderKeyGenerator:
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._last = 0
+
+    def next(self) -> int:
+        ms = max(0, int(time.time() * 1000) - ORDER_KEY_EPOCH_MS)
+        candidate = (ms << ORDER_KEY_SEQUENCE_BITS) | random.getrandbits(ORDER_KEY_SEQUENCE_BITS - 2)
+        with self._lock:
+            key = self._last = max(candidate, self._last + 1)
+        return key
+
+order_keys = OrderKeyGenerator()
+
+def order_key_from_time(created_at: Optional[str]) -> int:
+    try:
+        ms = int(datetime.fromisoformat(created_at).timestamp() * 1000) - ORDER_KEY_EPOCH_MS
+    except (TypeError, ValueError):
+        ms = 0
+    return max(0, ms) << ORDER_KEY_SEQUENCE_BITS
+
+def format_order_key(key: int) -> str:
+    chars = []
+    for _ in range(ORDER_CODE_LENGTH):
+        chars.append(ORDER_CODE_ALPHABET[key & 31])
+        key >>= 5
+    return "".join(reversed(chars))
+
+def parse_order_code(code: str) -> Optional[int]:
+    code = code.upper().replace("O", "0").replace("I", "1").replace("L", "1")
+    if len(code) != ORDER_CODE_LENGTH or any(c not in ORDER_CODE_ALPHABET for c in code):
+        return None
+    key = 0
+    for c in code:
+        key = key * 32 + ORDER_CODE_ALPHABET.index(c)
+    return key
+
+# Проставляет заказу ключ (id) и его код (order_id)
+def assign_order_id(order: Dict[str, Any]) -> Dict[str, Any]:
+    order["id"] = order_keys.next()
+    order["order_id"] = format_order_key(order["id"])
+    return order
+
+def order_status_message(order_id: str, new_status: str) -> str:
+    return f"Ваш заказ (ID: {order_id}) изменил статус на '{new_status}'."
+
+# Фильтры заказов в аргументах команд вида ключ=значение:
+# ids=ID,ID,... status=<статус> from=ГГГГ-ММ-ДД to=ГГГГ-ММ-ДД (включительно) user=<user_id>.
+# Возвращает именованные аргументы для _order_filter_sql и ID заказов (order_ids).
+def parse_order_filters(args: List[str], allowed: Tuple[str, ...]) -> Dict[str, Any]:
+    result: Dict[str, Any] = {}
+    for arg in args:
+        key, sep, value = arg.partition("=")
+        if not sep or key not in allowed or not value:
+            raise ValueError(f"Неизвестный фильтр: {arg}")
+        if key == "ids":
+            result["order_ids"] = [i for i in value.split(",") if i]
+        elif key == "status":
+            result["status"] = parse_status_arg(value)
+            if result["status"] is None:
+                raise ValueError(f"Неизвестный статус: {value}")
+        elif key == "user":
+            if not value.isdigit():
+                raise ValueError("user должен быть числовым ID пользователя")
+            result["user_id"] = int(value)
+        else:
+            try:
+                day = datetime.strptime(value, "%Y-%m-%d")
+            except ValueError:
+                raise ValueError("Даты должны быть в формате ГГГГ-ММ-ДД.")
+            if key == "from":
+                result["date_from"] = day.isoformat()
+            else:
+                result["date_to"] = (day + timedelta(days=1)).isoformat()
+    return result
+
+# Статус в аргументах команды: номер из ORDER_STATUSES (с 1) или название,
+# где пробелы заменены на "_"
+def parse_status_arg(value: str) -> Optional[str]:
+    if value.isdigit():
+        idx = int(value) - 1
+        return ORDER_STATUSES[idx] if 0 <= idx < len(ORDER_STATUSES) else None
+    for status in ORDER_STATUSES:
+        if value in (status, status.replace(" ", "_")):
+            return status
+    return None
+
+# Telegram считает длину сообщения в UTF-16 единицах
+def telegram_len(text: str) -> int:
+    return len(text.encode("utf-16-le")) // 2
+
+# Собирает блоки текста в сообщения не длиннее лимита Telegram.
+# add() возвращает готовое сообщение, когда очередной блок в него не влезает.
+class MessageChunker:
+    def __init__(self, header: str = "", limit: int = TELEGRAM_MESSAGE_LIMIT) -> None:
+        self.limit = limit
+        self._parts: List[str] = [header] if header else []
+        self._size = telegram_len(header)
+
+    def fits(self, block: str) -> bool:
+        return self._size + telegram_len(block) <= self.limit
+
+    def add(self, block: str) -> Optional[str]:
+        if telegram_len(block) > self.limit:
+            block = block.encode("utf-16-le")[:(self.limit - 1) * 2].decode("utf-16-le", "ignore") + "…"
+        chunk = None
+        if not self.fits(block) and self._parts:
+            chunk = self.flush()
+        self._parts.append(block)
+        self._size += telegram_len(block)
+        return chunk
+
+    def flush(self) -> Optional[str]:
+        if not self._parts:
+            return None
+        chunk = "".join(self._parts)
+        self._parts = []
+        self._size = 0
+        return chunk
+
+async def send_chunked(send: Callable[[str], Awaitable[Any]], blocks: AsyncIterator[str], header: str = "") -> int:
+    chunker = MessageChunker(header)
+    sent = 0
+    empty = True
+    async for block in blocks:
+        empty = False
+        chunk = chunker.add(block)
+        if chunk:
+            await send(chunk)
+            sent += 1
+    chunk = chunker.flush()
+    if chunk and not empty:
+        await send(chunk)
+        sent += 1
+    return sent
+
+# ================= Callback-данные =================
+
+# Кнопки вне диалога заказа кодируют в callback_data номер действия и
+# целочисленные аргументы: "~" + base64url(байт действия + varint-аргументы).
+# None кодируется как 0, число n — как n + 1. Разбор — без регулярных
+# выражений, обработчик выбирается по номеру действия в CALLBACK_ROUTES.
+CALLBACK_PREFIX: str = "~"
+CALLBACK_DATA_LIMIT: int = 64
+
+CB_PERSONAL_CABINET = 1
+CB_CABINET_HISTORY = 2        # (id заказа-границы | None)
+CB_REFERRAL_PROGRAM = 3
+CB_NEW_CALC_CABINET = 4
+CB_CONFIRM_PAYMENT = 5
+CB_ADMIN_MAIN = 10
+CB_ADMIN_PROMOS = 11
+CB_ADMIN_ANALYTICS = 12
+CB_ADMIN_ORDERS = 13          # (режим, индекс статуса | None, индекс категории | None, курсор | None)
+CB_ADMIN_ORDERS_FILTER = 14   # (вид фильтра, индекс статуса | None, индекс категории | None)
+CB_ADMIN_ORDER = 15           # (ключ заказа)
+CB_ORDER_STATUS = 16          # (ключ заказа, индекс нового статуса)
+CB_ADMIN_PROMO_LIST = 17
+CB_ADMIN_PROMO_ADD = 18
+CB_ORDER_MEDIA = 19           # (ключ заказа, индекс в ORDER_MEDIA_KINDS)
+
+def encode_callback(action: int, *args: Optional[int]) -> str:
+    buf = bytearray((action,))
+    for arg in args:
+        value = 0 if arg is None else arg + 1
+        while value >= 0x80:
+            buf.append(value & 0x7F | 0x80)
+            value >>= 7
+        buf.append(value)
+    data = CALLBACK_PREFIX + base64.urlsafe_b64encode(bytes(buf)).rstrip(b"=").decode()
+    if len(data) > CALLBACK_DATA_LIMIT:
+        raise ValueError(f"callback_data длиннее {CALLBACK_DATA_LIMIT} байт: {action} {args}")
+    return data
+
+def decode_callback(data: str) -> Tuple[int, List[Optional[int]]]:
+    encoded = data[len(CALLBACK_PREFIX):]
+    raw = base64.urlsafe_b64decode(encoded + "=" * (-len(encoded) % 4))
+    if not raw:
+        raise ValueError("Пустые callback-данные")
+    args: List[Optional[int]] = []
+    value = shift = 0
+    for byte in raw[1:]:
+        value |= (byte & 0x7F) << shift
+        if byte & 0x80:
+            shift += 7
+            continue
+        args.append(value - 1 if value else None)
+        value = shift = 0
+    if shift:
+        raise ValueError("Обрезанные callback-данные")
+    return raw[0], args
+
+def is_encoded_callback(data: object) -> bool:
+    return isinstance(data, str) and data.startswith(CALLBACK_PREFIX)
+
+# Режимы страницы заказов: первая страница, старше курсора, новее курсора.
+# Фильтры статуса и категории — индексы в ORDER_STATUSES/CATEGORIES или None,
+# курсор — orders.id заказа на границе страницы.
+ORDERS_PAGE_FIRST = 0
+ORDERS_PAGE_OLDER = 1
+ORDERS_PAGE_NEWER = 2
+ORDERS_FILTER_STATUS = 0
+ORDERS_FILTER_CATEGORY = 1
+
+def orders_page_data(mode: int, status_idx: Optional[int] = None, category_idx: Optional[int] = None,
+                     cursor: Optional[int] = None) -> str:
+    return encode_callback(CB_ADMIN_ORDERS, mode, status_idx, category_idx, cursor)
+
+# ================= Отображение заказов и клавиатуры =================
+
+# Объекты telegram неизменяемы, поэтому статичные клавиатуры создаются один
+# раз и переиспользуются во всех ответах.
+@functools.lru_cache(maxsize=None)
+def get_main_menu_keyboard() -> ReplyKeyboardMarkup:
+    keyboard = [
+        ["💼 Личный кабинет", "🧮 Рассчитать"],
+        ["💬 Поддержка"],
+    ]
+    return ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
+
+@functools.lru_cache(maxsize=None)
+def get_categories_inline_keyboard() -> InlineKeyboardMarkup:
+    keyboard = [
+        [InlineKeyboardButton("👕 Одежда", callback_data="Одежда")],
+        [InlineKeyboardButton("👟 Обувь", callback_data="Обувь")],
+        [InlineKeyboardButton("👜 Аксессуары", callback_data="Аксессуары")],
+        [InlineKeyboardButton("🎒 Сумки", callback_data="Сумки")],
+        [InlineKeyboardButton("⌚ Часы", callback_data="Часы")],
+        [InlineKeyboardButton("💐 Парфюм", callback_data="Парфюм")],
+    ]
+    return InlineKeyboardMarkup(keyboard)
+
+@functools.lru_cache(maxsize=None)
+def cabinet_menu_keyboard() -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton("📝 История заказов", callback_data=encode_callback(CB_CABINET_HISTORY, None))],
+        [InlineKeyboardButton("🔗 Реферальная программа", callback_data=encode_callback(CB_REFERRAL_PROGRAM))],
+        [InlineKeyboardButton("🧮 Новый расчёт", callback_data=encode_callback(CB_NEW_CALC_CABINET))],
+    ])
+
+@functools.lru_cache(maxsize=None)
+def cabinet_back_keyboard() -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data=encode_callback(CB_PERSONAL_CABINET))]])
+
+@functools.lru_cache(maxsize=None)
+def admin_main_keyboard() -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton("📦 Заказы", callback_data=orders_page_data(ORDERS_PAGE_FIRST))],
+        [InlineKeyboardButton("🏷️ Промокоды", callback_data=encode_callback(CB_ADMIN_PROMOS))],
+        [InlineKeyboardButton("📊 Аналитика", callback_data=encode_callback(CB_ADMIN_ANALYTICS))],
+    ])
+
+@functools.lru_cache(maxsize=None)
+def admin_back_keyboard() -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data=encode_callback(CB_ADMIN_MAIN))]])
+
+@functools.lru_cache(maxsize=None)
+def orders_back_keyboard() -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data=orders_page_data(ORDERS_PAGE_FIRST))]])
+
+# Карточка заказа для админа: /order_details и просмотр из списка заказов
+def render_order_card(order: sqlite3.Row) -> str:
+    discount_value = order["discount"] if order["discount"] is not None else 0
+    return (
+        f"ID: {order['order_id']}\n"
+        f"Пользователь: {order['username']} (ID: {order['user_id']})\n"
+        f"Категория: {order['category']}\n"
+        f"Цена: {order['price_yuan']}\n"
+        f"Комиссия: {order['commission']}\n"
+        f"Итог: {order['final_price']}\n"
+        f"Название: {order['order_name']}\n"
+        f"Ссылка: {order['order_link']}\n"
+        f"Статус: {order['status']}\n"
+        f"Дата: {order['created_at']}\n"
+        f"Квитанция: {'Да' if order['receipt'] else 'Нет'}\n"
+        f"Скидка: {discount_value}₽\n"
+        f"Промокод: {order['promo_code_used'] if order['promo_code_used'] is not None else '-'}"
+    )
+
+# Фото заказа, которые админ может открыть из карточки: (столбец orders, подпись)
+ORDER_MEDIA_KINDS: List[Tuple[str, str]] = [("screenshot", "🖼 Скриншот"), ("receipt", "🧾 Квитанция")]
+
+def render_order_keyboard(order: sqlite3.Row) -> InlineKeyboardMarkup:
+    key = order["id"]
+    keyboard = []
+    row = []
+    for idx, status in enumerate(ORDER_STATUSES):
+        row.append(InlineKeyboardButton(status.capitalize(), callback_data=encode_callback(CB_ORDER_STATUS, key, idx)))
+        if len(row) == 3:
+            keyboard.append(row)
+            row = []
+    if row:
+        keyboard.append(row)
+    media = [
+        InlineKeyboardButton(title, callback_data=encode_callback(CB_ORDER_MEDIA, key, idx))
+        for idx, (column, title) in enumerate(ORDER_MEDIA_KINDS) if order[column]
+    ]
+    if media:
+        keyboard.append(media)
+    keyboard.append([InlineKeyboardButton("⬅️ Назад", callback_data=orders_page_data(ORDERS_PAGE_FIRST))])
+    return InlineKeyboardMarkup(keyboard)
+
+# Уведомление админам о полученной квитанции; order — заказ из корзины
+def render_receipt_notice(order: Dict[str, Any]) -> str:
+    return (
+        f"Заказ №{order['order_id']} перешёл в статус '{order['status']}'.\n"
+        f"Пользователь: {order['username']} (ID: {order['user_id']})\n"
+        f"Название: {order['order_name']}\n"
+        f"Ссылка: {order['order_link']}\n"
+        f"Итоговая стоимость: {order['final_price']}₽\n"
+        f"Скидка: {order.get('discount') or 0}₽\n"
+        f"Квитанция: получена"
+    )
+
+class OrderCard:
+    __slots__ = ("key", "text", "reply_markup")
+
+    def __init__(self, key: int, text: str, reply_markup: InlineKeyboardMarkup) -> None:
+        self.key = key
+        self.text = text
+        self.reply_markup = reply_markup
+
+# LRU отрисованных карточек по ключу заказа. Изменения заказа из этого
+# процесса сбрасывают карточку (db_update_order_status, квитанция, массовая
+# смена статуса). Поколение защищает от гонки: карточку по строке,
+# прочитанной до сброса, put() не сохраняет.
+class OrderCardCache:
+    def __init__(self, max_size: int = ORDER_CARD_CACHE_SIZE) -> None:
+        self.max_size = max_size
+        self._cards: "OrderedDict[int, OrderCard]" = OrderedDict()
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: int) -> Optional[OrderCard]:
+        card = self._cards.get(key)
+        if card is None:
+            self.misses += 1
+            return None
+        self._cards.move_to_end(key)
+        self.hits += 1
+        return card
+
+    def put(self, row: sqlite3.Row, generation: Optional[int] = None) -> OrderCard:
+        card = OrderCard(row["id"], render_order_card(row), render_order_keyboard(row))
+        if generation is None or generation == self.generation:
+            self._cards[card.key] = card
+            self._cards.move_to_end(card.key)
+            while len(self._cards) > self.max_size:
+                self._cards.popitem(last=False)
+        return card
+
+    def invalidate(self, key: int) -> None:
+        self.generation += 1
+        self._cards.pop(key, None)
+
+    def clear(self) -> None:
+        self.generation += 1
+        self._cards.clear()
+
+    def stats_text(self) -> str:
+        return f"Карточки заказов: {len(self._cards)}/{self.max_size}, попаданий {self.hits}, промахов {self.misses}"
+
+order_cards = OrderCardCache()
+
+# Карточка по ключу заказа: из кэша или одним чтением строки из БД
+async def get_order_card(key: int) -> Optional[OrderCard]:
+    card = order_cards.get(key)
+    if card is not None:
+        return card
+    generation = order_cards.generation
+    row = await db_get_order_by_key(key)
+    return order_cards.put(row, generation) if row is not None else None
+
+# ================= Сводка пользователя =================
+
+class UserSummary:
+    __slots__ = ("user_id", "referral_code", "bonus", "orders_count", "orders_total")
+
+    def __init__(self, user_id: int, referral_code: Optional[str], bonus: int,
+                 orders_count: int, orders_total: float) -> None:
+        self.user_id = user_id
+        self.referral_code = referral_code
+        self.bonus = bonus
+        self.orders_count = orders_count
+        # Без заказов — целый 0, как и раньше выводилась сумма пустой истории
+        self.orders_total = orders_total if orders_count else 0
+
+# LRU сводок личного кабинета по user_id, читается насквозь: промах — одно
+# чтение строки users со счётчиками. Запись заказа, оформление корзины,
+# смена бонусов и выдача реферального кода сбрасывают сводку (db_* обёртки).
+# Пользователь без строки в users кэшируется пустой сводкой. Поколение, как в
+# OrderCardCache, не даёт сохранить строку, прочитанную до сброса.
+class UserSummaryCache:
+    def __init__(self, max_size: int = USER_SUMMARY_CACHE_SIZE) -> None:
+        self.max_size = max_size
+        self._summaries: "OrderedDict[int, UserSummary]" = OrderedDict()
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, user_id: int) -> Optional[UserSummary]:
+        summary = self._summaries.get(user_id)
+        if summary is None:
+            self.misses += 1
+            return None
+        self._summaries.move_to_end(user_id)
+        self.hits += 1
+        return summary
+
+    def put(self, user_id: int, row: Optional[sqlite3.Row], generation: Optional[int] = None) -> UserSummary:
+        if row is None:
+            summary = UserSummary(user_id, None, 0, 0, 0)
         else:
-            cur.execute("INSERT INTO users (user_id, referral_code, bonus) VALUES (?, ?, ?)", (user_id, "", bonus_change))
-        conn.commit()
+            summary = UserSummary(user_id, row["referral_code"], row["bonus"] or 0,
+                                  row["orders_count"], row["orders_total"])
+        if generation is None or generation == self.generation:
+            self._summaries[user_id] = summary
+            self._summaries.move_to_end(user_id)
+            while len(self._summaries) > self.max_size:
+                self._summaries.popitem(last=False)
+        return summary
 
-# ================= Вспомогательные функции =================
+    def invalidate(self, user_id: int) -> None:
+        self.generation += 1
+        self._summaries.pop(user_id, None)
 
-def generate_random_code(length: int = 6) -> str:
-    return ''.join(random.choices(string.ascii_uppercase + string.digits, k=length))
+    def clear(self) -> None:
+        self.generation += 1
+        self._summaries.clear()
 
-def generate_order_id() -> str:
-    return str(uuid.uuid4())
+    def stats_text(self) -> str:
+        return (f"Сводки пользователей: {len(self._summaries)}/{self.max_size}, "
+                f"попаданий {self.hits}, промахов {self.misses}")
 
-def get_main_menu_keyboard() -> ReplyKeyboardMarkup:
-    keyboard = [
-        ["💼 Личный кабинет", "🧮 Рассчитать"],
-        ["💬 Поддержка"],
-    ]
-    return ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
+user_summaries = UserSummaryCache()
 
-def get_categories_inline_keyboard() -> InlineKeyboardMarkup:
-    keyboard = [
-        [InlineKeyboardButton("👕 Одежда", callback_data="Одежда")],
-        [InlineKeyboardButton("👟 Обувь", callback_data="Обувь")],
-        [InlineKeyboardButton("👜 Аксессуары", callback_data="Аксессуары")],
-        [InlineKeyboardButton("🎒 Сумки", callback_data="Сумки")],
-        [InlineKeyboardButton("⌚ Часы", callback_data="Часы")],
-        [InlineKeyboardButton("💐 Парфюм", callback_data="Парфюм")],
-    ]
-    return InlineKeyboardMarkup(keyboard)
+async def get_user_summary(user_id: int) -> UserSummary:
+    summary = user_summaries.get(user_id)
+    if summary is not None:
+        return summary
+    generation = user_summaries.generation
+    row = await db_get_user_summary(user_id)
+    return user_summaries.put(user_id, row, generation)
 
 # ================= ОБРАБОТЧИКИ ПОЛЬЗОВАТЕЛЬСКОГО ИНТЕРФЕЙСА =================
 
@@ -191,12 +2913,12 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     if len(args) > 1:
         context.user_data["referral_received"] = args[1]
     try:
-        with open("category.jpg", "rb") as photo:
-            await update.message.reply_photo(
-                photo=photo,
-                caption="Добро пожаловать! Выберите категорию:",
-                reply_markup=get_categories_inline_keyboard()
-            )
+        await media_registry.send_photo(
+            update.message.reply_photo,
+            "category.jpg",
+            caption="Добро пожаловать! Выберите категорию:",
+            reply_markup=get_categories_inline_keyboard()
+        )
     except Exception as e:
         logger.error("Ошибка при отправке category.jpg: %s", e)
         await update.message.reply_text("Добро пожаловать! Выберите категорию:",
@@ -212,12 +2934,9 @@ async def category_chosen(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     except Exception as e:
         logger.error("Ошибка редактирования подписи: %s", e)
     try:
-        media = []
-        for file in ["instructions1.jpg", "instructions2.jpg"]:
-            if os.path.exists(file):
-                media.append(InputMediaPhoto(media=open(file, "rb")))
-        if media:
-            await context.bot.send_media_group(chat_id=query.message.chat_id, media=media)
+        await media_registry.send_media_group(
+            context.bot, query.message.chat_id, ["instructions1.jpg", "instructions2.jpg"]
+        )
     except Exception as e:
         logger.error("Ошибка отправки медиа-группы: %s", e)
     await query.message.reply_text("Введите цену в юанях:")
@@ -227,11 +2946,15 @@ async def calculate_price(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     try:
         price_yuan = float(update.message.text)
     except ValueError:
+        price_yuan = math.nan
+    # float() принимает "nan", "inf" и отрицательные числа — такие цены ломают quote()
+    # и NOT NULL-счётчики users.orders_total при оформлении
+    if not math.isfinite(price_yuan) or price_yuan <= 0:
         await update.message.reply_text("Введите корректное число.")
         return GETTING_PRICE
-    commission = 2500 if price_yuan > 3000 else 1500
-    final_price = price_yuan * 13 + commission
     category = context.user_data.get("category", "не указана")
+    rules = await pricing.current()
+    commission, final_price = rules.quote(category, price_yuan)
     context.user_data["order"] = {
         "user_id": update.effective_user.id,
         "username": update.effective_user.username or update.effective_user.first_name,
@@ -239,6 +2962,7 @@ async def calculate_price(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         "price_yuan": price_yuan,
         "commission": commission,
         "final_price": final_price,
+        "pricing_version": rules.version,
         "status": "создан",
         "created_at": datetime.now().isoformat(),
     }
@@ -246,9 +2970,9 @@ async def calculate_price(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         f"**Рассчёт стоимости**\n"
         f"Категория: {category}\n"
         f"Цена в юанях: {price_yuan}\n"
-        f"Курс: 13\n"
-        f"Комиссия: {commission}\n"
-        f"**Итоговая стоимость: {final_price}₽**"
+        f"Курс: {rules.rate}\n"
+        f"Комиссия: {commission:.2f}\n"
+        f"**Итоговая стоимость: {final_price:.2f}₽**"
     )
     await update.message.reply_text(response_text)
     keyboard = [
@@ -277,11 +3001,11 @@ async def order_name_handler(update: Update, context: ContextTypes.DEFAULT_TYPE)
     order_name = update.message.text.strip()
     context.user_data["order"]["order_name"] = order_name
     try:
-        with open("link.jpg", "rb") as photo:
-            await update.message.reply_photo(
-                photo=photo,
-                caption="Что покупаем?\nУкажите ссылку на товар с сайта Poizon 🔗"
-            )
+        await media_registry.send_photo(
+            update.message.reply_photo,
+            "link.jpg",
+            caption="Что покупаем?\nУкажите ссылку на товар с сайта Poizon 🔗"
+        )
     except Exception as e:
         logger.error("Ошибка при отправке link.jpg: %s", e)
         await update.message.reply_text("Укажите ссылку на товар с сайта Poizon 🔗")
@@ -293,11 +3017,11 @@ async def order_link_handler(update: Update, context: ContextTypes.DEFAULT_TYPE)
     extracted_link = match.group(0) if match else text_received
     context.user_data["order"]["order_link"] = extracted_link
     try:
-        with open("screenorder.jpg", "rb") as photo:
-            await update.message.reply_photo(
-                photo=photo,
-                caption="Отправьте скриншот, на котором видно: Товар, размер, цвет"
-            )
+        await media_registry.send_photo(
+            update.message.reply_photo,
+            "screenorder.jpg",
+            caption="Отправьте скриншот, на котором видно: Товар, размер, цвет"
+        )
     except Exception as e:
         logger.error("Ошибка при отправке screenorder.jpg: %s", e)
         await update.message.reply_text("Отправьте скриншот, на котором видно: Товар, размер, цвет")
@@ -332,7 +3056,7 @@ async def order_screenshot_handler(update: Update, context: ContextTypes.DEFAULT
         await update.message.reply_text("Ошибка: данные заказа отсутствуют.")
     return FINISH_ORDER
 
-# При завершении заказа: если запущен по реферальной ссылке – автоматически применяется скидка 300₽.
+# При завершении заказа: если запущен по действующей реферальной ссылке – автоматически применяется скидка REFERRAL_DISCOUNT.
 async def order_finalization_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
     await query.answer()
@@ -343,9 +3067,9 @@ async def order_finalization_callback(update: Update, context: ContextTypes.DEFA
         if not basket:
             await query.edit_message_text("Корзина пуста.")
             return ConversationHandler.END
+        # Заказ пишется в БД целиком одной транзакцией, как только известна скидка
         for item in basket:
-            item["order_id"] = generate_order_id()
-            db_insert_order(item)
+            assign_order_id(item)
         total_cost = sum(item["final_price"] for item in basket)
         details = "Ваш заказ:\n"
         for item in basket:
@@ -354,8 +3078,20 @@ async def order_finalization_callback(update: Update, context: ContextTypes.DEFA
                 f"Ссылка: {item['order_link']}\n"
             )
         details += f"\nОбщая стоимость: {total_cost}₽"
-        if context.user_data.get("referral_received"):
-            discount = 300
+        user_id = update.effective_user.id
+        referral_code = context.user_data.get("referral_received")
+        checkout_id = None
+        resolved = await resolve_discount_code(referral_code, user_id) if referral_code else None
+        if resolved and resolved[1] == "referral":
+            try:
+                checkout_id = await db_checkout_basket(
+                    user_id, basket, discount=resolved[0], promo_code=referral_code, redemption="referral"
+                )
+            except ValueError as e:
+                logger.info("Реферальный код %s не применён: %s", referral_code, e)
+        if checkout_id is not None:
+            context.user_data["checkout_id"] = checkout_id
+            discount = resolved[0]
             new_total = max(total_cost - discount, 0)
             details += f"\nОбщая стоимость со скидкой: {new_total}₽\nПромокод (реферальный) использован. Скидка {discount}₽ применена."
             await context.bot.send_message(chat_id=query.message.chat_id, text=details)
@@ -381,50 +3117,47 @@ async def order_finalization_callback(update: Update, context: ContextTypes.DEFA
 
 async def promo_input_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     promo_input = update.message.text.strip()
-    order = context.user_data.get("order")
-    discount = 300
+    basket: List[Dict[str, Any]] = context.user_data.get("basket", [])
+    total_cost = sum(item["final_price"] for item in basket)
+    discount = 0
+    promo_code_used = None
+    redemption = None
+    bonus_debit = 0
     user_id = update.effective_user.id
     if promo_input.lower() == "нет":
-        final_price = order["final_price"]
+        pass
     elif promo_input.lower() == "бонус":
-        user_data = db_get_user(user_id)
+        user_data = await db_get_user(user_id)
         bonus_value = user_data["bonus"] if user_data else 0
         if bonus_value > 0:
-            final_price = max(order["final_price"] - bonus_value, 0)
-            order["discount"] = bonus_value
-            order["promo_code_used"] = "БОНУС"
-            db_update_user_bonus(user_id, -bonus_value)
-            await update.message.reply_text(f"Бонусы применены! Скидка {bonus_value}₽ получена.")
+            bonus_debit = min(bonus_value, int(total_cost))
+            discount = bonus_debit
+            promo_code_used = "БОНУС"
         else:
             await update.message.reply_text("У вас недостаточно бонусов.")
-            final_price = order["final_price"]
     else:
-        valid = False
-        if promo_input in promo_codes:
-            data = promo_codes[promo_input]
-            if data["type"] == "one-time" and user_id in data["used_by"]:
-                valid = False
-            else:
-                valid = True
-                data["used_by"].add(user_id)
-        if not valid:
-            with get_db_connection() as conn:
-                cur = conn.cursor()
-                cur.execute("SELECT user_id FROM users WHERE referral_code=?", (promo_input,))
-                row = cur.fetchone()
-            if row:
-                owner = row["user_id"]
-                if owner != user_id:
-                    valid = True
-        if valid:
-            final_price = max(order["final_price"] - discount, 0)
-            order["discount"] = discount
-            order["promo_code_used"] = promo_input
-            await update.message.reply_text(f"Код принят! Скидка {discount}₽ применена.")
+        resolved = await resolve_discount_code(promo_input, user_id)
+        if resolved:
+            discount, redemption = resolved
+            promo_code_used = promo_input
         else:
             await update.message.reply_text("Введённый код недействителен. Скидка не применена.")
-            final_price = order["final_price"]
-    order["final_price"] = final_price
+    try:
+        context.user_data["checkout_id"] = await db_checkout_basket(
+            user_id, basket, discount=discount, promo_code=promo_code_used,
+            bonus_debit=bonus_debit, redemption=redemption
+        )
+        if bonus_debit:
+            await update.message.reply_text(f"Бонусы применены! Скидка {bonus_debit}₽ получена.")
+        elif redemption:
+            await update.message.reply_text(f"Код принят! Скидка {discount}₽ применена.")
+    except ValueError as e:
+        # Бонусы или промокод успели израсходовать параллельно — оформляем без скидки
+        await update.message.reply_text(f"{e}. Скидка не применена.")
+        context.user_data["checkout_id"] = await db_checkout_basket(user_id, basket)
+    if redemption == "promo":
+        promo_cache.invalidate(promo_input)
+    final_price = sum(item["final_price"] for item in basket)
     payment_text = (
         "Заказ проверен нашими менеджерами и готов к оформлению.\n"
         "Доставка по России оплачивается отдельно.\n"
@@ -444,27 +3177,11 @@ async def order_receipt_handler(update: Update, context: ContextTypes.DEFAULT_TY
         basket[-1]["receipt"] = receipt_file_id
         order = basket[-1]
         order["status"] = "на_подтверждении"
-        db_update_order_status(order["order_id"], order["status"])
-        # Обращаемся к данным через индексирование
-        discount_value = order["discount"] if order["discount"] is not None else 0
-        admin_text = (
-            f"Заказ №{order['order_id']} перешёл в статус 'на_подтверждении'.\n"
-            f"Пользователь: {order['username']} (ID: {order['user_id']})\n"
-            f"Название: {order['order_name']}\n"
-            f"Ссылка: {order['order_link']}\n"
-            f"Итоговая стоимость: {order['final_price']}₽\n"
-            f"Скидка: {discount_value}₽\n"
-            f"Квитанция: получена"
-        )
-        for admin_id in ADMIN_IDS:
-            try:
-                await context.bot.send_photo(
-                    chat_id=admin_id,
-                    photo=receipt_file_id,
-                    caption=admin_text,
-                )
-            except Exception as e:
-                logger.error("Ошибка уведомления админа: %s", e)
+        await db_attach_order_receipt(order["id"], receipt_file_id, order["status"])
+        admin_text = render_receipt_notice(order)
+        await outbox.enqueue_many([
+            (admin_id, "send_photo", {"photo": receipt_file_id, "caption": admin_text}) for admin_id in ADMIN_IDS
+        ])
         await update.message.reply_text("Квитанция получена. Ваш заказ передан в обработку!")
     else:
         await update.message.reply_text("Ошибка: заказ не найден.")
@@ -474,87 +3191,84 @@ async def order_receipt_handler(update: Update, context: ContextTypes.DEFAULT_TY
 
 async def personal_cabinet_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user_id = update.effective_user.id
-    user_orders = db_get_user_orders(user_id)
-    total_sum = sum(o["final_price"] for o in user_orders) if user_orders else 0
-    user_data = db_get_user(user_id)
-    if user_data is None or user_data["referral_code"] is None:
-        new_ref = generate_random_code()
-        db_set_referral_code(user_id, new_ref)
-        ref_code = new_ref
-        bonus = 0
-    else:
-        ref_code = user_data["referral_code"]
-        bonus = user_data["bonus"]
+    summary = await get_user_summary(user_id)
+    # Код выдаётся при первом входе; db_set_referral_code сбросит сводку
+    ref_code = summary.referral_code or await issue_referral_code(user_id)
     text = (
         f"💼 Личный кабинет:\n\n"
-        f"История заказов: {len(user_orders)}\n"
-        f"Общая сумма заказов: {total_sum}₽\n"
-        f"Ваш бонус: {bonus}₽\n\n"
+        f"История заказов: {summary.orders_count}\n"
+        f"Общая сумма заказов: {summary.orders_total}₽\n"
+        f"Ваш бонус: {summary.bonus}₽\n\n"
         f"Ваш реферальный код: {ref_code}\n\n"
         "Выберите пункт меню:"
     )
-    keyboard = [
-        [InlineKeyboardButton("📝 История заказов", callback_data="cabinet_history")],
-        [InlineKeyboardButton("🔗 Реферальная программа", callback_data="referral_program")],
-        [InlineKeyboardButton("🧮 Новый расчёт", callback_data="new_calc_cabinet")],
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    reply_markup = cabinet_menu_keyboard()
     if update.message:
         await update.message.reply_text(text, reply_markup=reply_markup)
     elif update.callback_query:
+        await update.callback_query.answer()
         await update.callback_query.edit_message_text(text, reply_markup=reply_markup)
 
-async def cabinet_history_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+# before_id — страница заказов старше этого id, None — последние заказы
+async def cabinet_history_callback(update: Update, context: ContextTypes.DEFAULT_TYPE,
+                                   before_id: Optional[int] = None) -> None:
     query = update.callback_query
     await query.answer()
     user_id = update.effective_user.id
-    orders_list = db_get_user_orders(user_id)
+    orders_list = await db_get_user_orders_page(user_id, before_id, CABINET_HISTORY_PAGE_SIZE + 1)
+    keyboard = []
     if not orders_list:
         text = "У вас пока нет заказов."
     else:
-        text = "📝 История заказов:\n\n"
-        for o in orders_list:
-            text += (
+        # Страница ограничена и числом заказов, и длиной сообщения
+        chunker = MessageChunker("📝 История заказов:\n\n", limit=TELEGRAM_MESSAGE_LIMIT - 100)
+        shown = 0
+        for o in orders_list[:CABINET_HISTORY_PAGE_SIZE]:
+            block = (
                 f"ID: {o['order_id']}\n"
                 f"Название: {o['order_name']}\n"
                 f"Статус: {o['status']}\n"
                 f"Стоимость: {o['final_price']}₽\n\n"
             )
-    keyboard = [[InlineKeyboardButton("⬅️ Назад", callback_data="personal_cabinet")]]
+            if shown and not chunker.fits(block):
+                break
+            chunker.add(block)
+            shown += 1
+        text = chunker.flush()
+        if shown < len(orders_list):
+            older_id = orders_list[shown - 1]["id"]
+            keyboard.append([InlineKeyboardButton("Старые заказы ➡️", callback_data=encode_callback(CB_CABINET_HISTORY, older_id))])
+    if before_id is not None:
+        keyboard.append([InlineKeyboardButton("⏮ К последним заказам", callback_data=encode_callback(CB_CABINET_HISTORY, None))])
+    keyboard.append([InlineKeyboardButton("⬅️ Назад", callback_data=encode_callback(CB_PERSONAL_CABINET))])
     await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard))
 
 async def referral_program_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     query = update.callback_query
     await query.answer()
     user_id = update.effective_user.id
-    user_data = db_get_user(user_id)
-    if user_data is None or user_data["referral_code"] is None:
-        new_ref = generate_random_code()
-        db_set_referral_code(user_id, new_ref)
-        ref_code = new_ref
-    else:
-        ref_code = user_data["referral_code"]
+    summary = await get_user_summary(user_id)
+    ref_code = summary.referral_code or await issue_referral_code(user_id)
     referral_link = f"t.me/{context.bot.username}?start={ref_code}"
     text = (
         "🔗 Реферальная программа:\n\n"
-        "Приглашайте друзей и получите скидку 300₽ на первый заказ!\n\n"
+        f"Приглашайте друзей и получите скидку {REFERRAL_DISCOUNT}₽ на первый заказ!\n\n"
         f"Ваша реферальная ссылка:\n{referral_link}\n\n"
         "Каждый пользователь может получить скидку по чужому коду только один раз."
     )
-    keyboard = [[InlineKeyboardButton("⬅️ Назад", callback_data="personal_cabinet")]]
-    await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard))
+    await query.edit_message_text(text, reply_markup=cabinet_back_keyboard())
 
 async def new_calc_cabinet_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     query = update.callback_query
     await query.answer()
     try:
-        with open("category.jpg", "rb") as photo:
-            await context.bot.send_photo(
-                chat_id=query.message.chat_id,
-                photo=photo,
-                caption="Новый расчёт. Выберите категорию:",
-                reply_markup=get_categories_inline_keyboard()
-            )
+        await media_registry.send_photo(
+            context.bot.send_photo,
+            "category.jpg",
+            chat_id=query.message.chat_id,
+            caption="Новый расчёт. Выберите категорию:",
+            reply_markup=get_categories_inline_keyboard()
+        )
     except Exception as e:
         logger.error("Ошибка при отправке category.jpg: %s", e)
         await context.bot.send_message(
@@ -563,19 +3277,6 @@ async def new_calc_cabinet_callback(update: Update, context: ContextTypes.DEFAUL
             reply_markup=get_categories_inline_keyboard()
         )
 
-async def personal_cabinet_menu_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    query = update.callback_query
-    data = query.data
-    logger.info("Личный кабинет: нажата кнопка %s", data)
-    if data == "cabinet_history":
-        await cabinet_history_callback(update, context)
-    elif data == "referral_program":
-        await referral_program_callback(update, context)
-    elif data == "new_calc_cabinet":
-        await new_calc_cabinet_callback(update, context)
-    elif data == "personal_cabinet":
-        await personal_cabinet_handler(update, context)
-
 # ================= ОБРАБОТЧИКИ АДМИН-ПАНЕЛИ =================
 
 async def admin_main_menu_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -585,133 +3286,188 @@ async def admin_main_menu_handler(update: Update, context: ContextTypes.DEFAULT_
         else:
             await update.callback_query.answer("Нет доступа.", show_alert=True)
         return
-    keyboard = [
-        [InlineKeyboardButton("📦 Заказы", callback_data="admin_menu_orders")],
-        [InlineKeyboardButton("🏷️ Промокоды", callback_data="admin_menu_promos")],
-        [InlineKeyboardButton("📊 Аналитика", callback_data="admin_menu_analytics")],
-    ]
     # Если это сообщение, используем update.message, иначе редактируем сообщение callback
     if update.message:
-        await update.message.reply_text("Админ-консоль:", reply_markup=InlineKeyboardMarkup(keyboard))
+        await update.message.reply_text("Админ-консоль:", reply_markup=admin_main_keyboard())
     elif update.callback_query:
-        await update.callback_query.edit_message_text("Админ-консоль:", reply_markup=InlineKeyboardMarkup(keyboard))
+        await update.callback_query.answer()
+        await update.callback_query.edit_message_text("Админ-консоль:", reply_markup=admin_main_keyboard())
 
-async def admin_menu_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+async def admin_promos_menu_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     query = update.callback_query
     await query.answer()
-    data = query.data
-    if data == "admin_main":
-        await admin_main_menu_handler(update, context)
-    elif data == "admin_menu_orders":
-        await admin_orders_list_handler(update, context)
-    elif data == "admin_menu_promos":
-        keyboard = [
-            [InlineKeyboardButton("Просмотр промокодов", callback_data="admin_list_promos")],
-            [InlineKeyboardButton("Добавить промокод", callback_data="admin_add_promo")],
-            [InlineKeyboardButton("⬅️ Назад", callback_data="admin_main")],
-        ]
-        await query.edit_message_text("Меню промокодов:", reply_markup=InlineKeyboardMarkup(keyboard))
-    elif data == "admin_menu_analytics":
-        orders_db = db_get_orders()
-        paid_orders = [o for o in orders_db if o["status"].lower() in
-                       ["оплачен", "выкуплен", "отправлен в РФ", "прибыл", "отправлен внутри РФ", "доставлен"]]
-        total_count = len(paid_orders)
-        total_sum = sum(o["final_price"] for o in paid_orders)
-        text = f"📊 Аналитика:\nОплаченные заказы: {total_count}\nОбщая сумма: {total_sum}₽"
-        keyboard = [[InlineKeyboardButton("⬅️ Назад", callback_data="admin_main")]]
-        await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard))
-
-async def admin_orders_list_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    keyboard = [
+        [InlineKeyboardButton("Просмотр промокодов", callback_data=encode_callback(CB_ADMIN_PROMO_LIST))],
+        [InlineKeyboardButton("Добавить промокод", callback_data=encode_callback(CB_ADMIN_PROMO_ADD))],
+        [InlineKeyboardButton("⬅️ Назад", callback_data=encode_callback(CB_ADMIN_MAIN))],
+    ]
+    await query.edit_message_text("Меню промокодов:", reply_markup=InlineKeyboardMarkup(keyboard))
+
+async def admin_promo_list_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     query = update.callback_query
     await query.answer()
-    orders = db_get_orders()
-    if not orders:
-        await query.edit_message_text("Нет заказов.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data="admin_main")]]))
-        return
-    keyboard = []
-    for order in orders:
-        keyboard.append([InlineKeyboardButton(f"ID: {order['order_id']}, {order['order_name']}", callback_data=f"admin_order:{order['order_id']}")])
-    keyboard.append([InlineKeyboardButton("⬅️ Назад", callback_data="admin_main")])
-    await query.edit_message_text("Список заказов:", reply_markup=InlineKeyboardMarkup(keyboard))
+    lines = []
+    for d in await db_list_promos():
+        limit = d["max_uses"] if d["max_uses"] is not None else "∞"
+        lines.append(f"{d['code']} – {d['discount']}₽, использован {d['uses']}/{limit}")
+    text = "Промокоды:\n" + "\n".join(lines) if lines else "Промокодов нет."
+    if telegram_len(text) > TELEGRAM_MESSAGE_LIMIT:
+        text = "Промокодов слишком много для одного сообщения, используйте /listpromos."
+    await query.edit_message_text(text, reply_markup=admin_back_keyboard())
 
-async def admin_order_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+async def admin_promo_add_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     query = update.callback_query
     await query.answer()
-    # callback_data: "admin_order:{order_id}"
-    order_id = query.data.split(":", 1)[1]
-    with get_db_connection() as conn:
-        cur = conn.cursor()
-        cur.execute("SELECT * FROM orders WHERE order_id=?", (order_id,))
-        order = cur.fetchone()
-    if not order:
-        await query.edit_message_text("Заказ не найден.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data="admin_menu_orders")]]))
-        return
-    # Обращаемся к значениям через индексирование
-    discount_value = order["discount"] if order["discount"] is not None else 0
-    details = (
-        f"ID: {order['order_id']}\n"
-        f"Пользователь: {order['username']} (ID: {order['user_id']})\n"
-        f"Категория: {order['category']}\n"
-        f"Цена: {order['price_yuan']}\n"
-        f"Комиссия: {order['commission']}\n"
-        f"Итог: {order['final_price']}\n"
-        f"Название: {order['order_name']}\n"
-        f"Ссылка: {order['order_link']}\n"
-        f"Статус: {order['status']}\n"
-        f"Дата: {order['created_at']}\n"
-        f"Квитанция: {'Да' if order['receipt'] else 'Нет'}\n"
-        f"Скидка: {discount_value}₽\n"
-        f"Промокод: {order['promo_code_used'] if order['promo_code_used'] is not None else '-'}"
+    await query.edit_message_text(
+        "Чтобы добавить промокод, отправьте команду:\n"
+        "/addpromo <код> <тип: one-time/multi> <скидка> [макс. использований] [действует до ГГГГ-ММ-ДД]",
+        reply_markup=admin_back_keyboard(),
     )
-    statuses = ["создан", "на_подтверждении", "оплачен", "выкуплен", "ждет отправки", "отправлен в РФ", "прибыл", "отправлен внутри РФ", "доставлен"]
+
+async def admin_analytics_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    query = update.callback_query
+    await query.answer()
+    by_status = await db_get_order_stats("status")
+    paid = [r for r in by_status if r["key"] in PAID_STATUSES]
+    total_count = sum(r["orders_count"] for r in paid)
+    total_sum = sum(r["revenue"] for r in paid)
+    lines = [f"📊 Аналитика:\nОплаченные заказы: {total_count}\nОбщая сумма: {total_sum}₽"]
+    by_category = await db_get_order_stats("category")
+    if by_category:
+        lines.append("\nПо категориям:")
+        lines.extend(f"{r['key'] or 'не указана'}: {r['orders_count']} — {r['revenue']}₽" for r in by_category)
+    by_day = await db_get_order_stats("day", ANALYTICS_DAYS)
+    if by_day:
+        lines.append(f"\nПо дням (последние {ANALYTICS_DAYS}):")
+        lines.extend(f"{r['key']}: {r['orders_count']} — {r['revenue']}₽" for r in by_day)
+    text = "\n".join(lines)
+    await query.edit_message_text(text, reply_markup=admin_back_keyboard())
+
+def _filter_value(values: List[str], idx: Optional[int]) -> Optional[str]:
+    return values[idx] if idx is not None and idx < len(values) else None
+
+async def admin_orders_list_handler(update: Update, context: ContextTypes.DEFAULT_TYPE,
+                                    mode: Optional[int] = ORDERS_PAGE_FIRST, status_idx: Optional[int] = None,
+                                    category_idx: Optional[int] = None, cursor: Optional[int] = None) -> None:
+    query = update.callback_query
+    await query.answer()
+    status = _filter_value(ORDER_STATUSES, status_idx)
+    category = _filter_value(CATEGORIES, category_idx)
+    if status is None:
+        status_idx = None
+    if category is None:
+        category_idx = None
+    if cursor is None:
+        mode = ORDERS_PAGE_FIRST
+    backward = mode == ORDERS_PAGE_NEWER
+    rows = await db_get_orders_page(status, category, cursor if mode != ORDERS_PAGE_FIRST else None,
+                                    backward, ADMIN_ORDERS_PAGE_SIZE + 1)
+    has_more = len(rows) > ADMIN_ORDERS_PAGE_SIZE
+    rows = rows[:ADMIN_ORDERS_PAGE_SIZE]
+    if backward:
+        rows = rows[::-1]
+    # Есть ли страницы в обе стороны: в направлении листания знаем по лишней строке,
+    # в обратном — они есть всегда, если мы пришли по курсору
+    has_older = has_more if not backward else True
+    has_newer = (mode != ORDERS_PAGE_FIRST) if not backward else has_more
+    keyboard = [[
+        InlineKeyboardButton(f"Статус: {status or 'все'}",
+                             callback_data=encode_callback(CB_ADMIN_ORDERS_FILTER, ORDERS_FILTER_STATUS, status_idx, category_idx)),
+        InlineKeyboardButton(f"Категория: {category or 'все'}",
+                             callback_data=encode_callback(CB_ADMIN_ORDERS_FILTER, ORDERS_FILTER_CATEGORY, status_idx, category_idx)),
+    ]]
+    for order in rows:
+        keyboard.append([InlineKeyboardButton(f"ID: {order['order_id']}, {order['order_name']}",
+                                              callback_data=encode_callback(CB_ADMIN_ORDER, order["id"]))])
+    nav = []
+    if rows and has_newer:
+        first = rows[0]
+        nav.append(InlineKeyboardButton("⬅️ Новее", callback_data=orders_page_data(ORDERS_PAGE_NEWER, status_idx, category_idx, first["id"])))
+    if rows and has_older:
+        last = rows[-1]
+        nav.append(InlineKeyboardButton("Старее ➡️", callback_data=orders_page_data(ORDERS_PAGE_OLDER, status_idx, category_idx, last["id"])))
+    if nav:
+        keyboard.append(nav)
+    keyboard.append([InlineKeyboardButton("⬅️ Назад", callback_data=encode_callback(CB_ADMIN_MAIN))])
+    text = "Список заказов:" if rows else "Нет заказов."
+    await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard))
+
+# Выбор значения фильтра списка заказов; kind — ORDERS_FILTER_STATUS или ORDERS_FILTER_CATEGORY
+async def admin_orders_filter_handler(update: Update, context: ContextTypes.DEFAULT_TYPE, kind: Optional[int],
+                                      status_idx: Optional[int], category_idx: Optional[int]) -> None:
+    query = update.callback_query
+    await query.answer()
     keyboard = []
-    row = []
-    for status in statuses:
-        row.append(InlineKeyboardButton(status.capitalize(), callback_data=f"update:{order['order_id']}:{status}"))
-        if len(row) == 3:
-            keyboard.append(row)
-            row = []
-    if row:
-        keyboard.append(row)
-    keyboard.append([InlineKeyboardButton("⬅️ Назад", callback_data="admin_menu_orders")])
-    await query.edit_message_text(details, reply_markup=InlineKeyboardMarkup(keyboard))
+    if kind == ORDERS_FILTER_STATUS:
+        keyboard.append([InlineKeyboardButton("Все статусы", callback_data=orders_page_data(ORDERS_PAGE_FIRST, None, category_idx))])
+        for idx, status in enumerate(ORDER_STATUSES):
+            keyboard.append([InlineKeyboardButton(status, callback_data=orders_page_data(ORDERS_PAGE_FIRST, idx, category_idx))])
+    else:
+        keyboard.append([InlineKeyboardButton("Все категории", callback_data=orders_page_data(ORDERS_PAGE_FIRST, status_idx, None))])
+        for idx, category in enumerate(CATEGORIES):
+            keyboard.append([InlineKeyboardButton(category, callback_data=orders_page_data(ORDERS_PAGE_FIRST, status_idx, idx))])
+    keyboard.append([InlineKeyboardButton("⬅️ Назад", callback_data=orders_page_data(ORDERS_PAGE_FIRST, status_idx, category_idx))])
+    await query.edit_message_text("Выберите фильтр:", reply_markup=InlineKeyboardMarkup(keyboard))
 
-async def update_order_status_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+async def admin_order_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, key: Optional[int]) -> None:
     query = update.callback_query
     await query.answer()
-    parts = query.data.split(":")
-    if len(parts) < 3:
-        await query.edit_message_text("Неверный формат данных.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data="admin_menu_orders")]]))
-        return
-    _, order_id, new_status = parts
-    db_update_order_status(order_id, new_status)
-    with get_db_connection() as conn:
-        cur = conn.cursor()
-        cur.execute("SELECT * FROM orders WHERE order_id=?", (order_id,))
-        order = cur.fetchone()
-    if order:
-        client_message = f"Ваш заказ (ID: {order_id}) изменил статус на '{new_status}'."
-        try:
-            await context.bot.send_message(chat_id=order["user_id"], text=client_message)
-        except Exception as e:
-            logger.error("Ошибка отправки уведомления клиенту: %s", e)
-    await query.edit_message_text(f"Статус заказа {order_id} обновлён на '{new_status}'.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data="admin_menu_orders")]]))
+    card = await get_order_card(key) if key is not None else None
+    if card is None:
+        await query.edit_message_text("Заказ не найден.", reply_markup=orders_back_keyboard())
+        return
+    await query.edit_message_text(card.text, reply_markup=card.reply_markup)
+
+async def update_order_status_callback(update: Update, context: ContextTypes.DEFAULT_TYPE,
+                                       key: Optional[int], status_idx: Optional[int]) -> None:
+    query = update.callback_query
+    await query.answer()
+    new_status = _filter_value(ORDER_STATUSES, status_idx)
+    if key is None or new_status is None:
+        await query.edit_message_text("Неверный формат данных.", reply_markup=orders_back_keyboard())
+        return
+    changed = await db_update_order_status(key, new_status)
+    if changed is None:
+        order = await db_get_order_by_key(key)
+        order_id = order["order_id"] if order else key
+    else:
+        order_id, user_id = changed
+        await outbox.enqueue(user_id, "send_message", text=order_status_message(order_id, new_status))
+    await query.edit_message_text(f"Статус заказа {order_id} обновлён на '{new_status}'.", reply_markup=orders_back_keyboard())
+
+# Фото заказа для админа: по file_id, а если он больше не действует — из архива
+async def admin_order_media_callback(update: Update, context: ContextTypes.DEFAULT_TYPE,
+                                     key: Optional[int], kind: Optional[int]) -> None:
+    query = update.callback_query
+    row = await db_get_order_media(key) if key is not None else None
+    if row is None or kind is None or kind >= len(ORDER_MEDIA_KINDS) or not row[ORDER_MEDIA_KINDS[kind][0]]:
+        await query.answer("Фото не найдено.", show_alert=True)
+        return
+    await query.answer()
+    column, title = ORDER_MEDIA_KINDS[kind]
+    sent = await send_archived_photo(context.bot, query.message.chat_id, row[column], row[f"{column}_sha256"],
+                                     f"{title} заказа {row['order_id']}")
+    if not sent:
+        await context.bot.send_message(query.message.chat_id, "Фото больше недоступно в Telegram, копии в архиве нет.")
 
 async def payment_confirmation_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     query = update.callback_query
     await query.answer()
-    await query.edit_message_text("Пожалуйста, отправьте фото квитанции об оплате.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data="personal_cabinet")]]))
+    await query.edit_message_text("Пожалуйста, отправьте фото квитанции об оплате.", reply_markup=cabinet_back_keyboard())
 
 # Дополнительные админ-команды
 async def orders_status_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if update.effective_user.id not in ADMIN_IDS:
         await update.message.reply_text("Нет доступа.")
         return
-    orders_db = db_get_orders()
-    text = "Список заказов:\n"
-    for o in orders_db:
-        text += f"ID: {o['order_id']}, {o['order_name']} — {o['status']}\n"
-    await update.message.reply_text(text)
+
+    async def lines() -> AsyncIterator[str]:
+        async for o in db_iter_orders():
+            yield f"ID: {o['order_id']}, {o['order_name']} — {o['status']}\n"
+
+    sent = await send_chunked(update.message.reply_text, lines(), header="Список заказов:\n")
+    if sent == 0:
+        await update.message.reply_text("Нет заказов.")
 
 async def order_details_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if update.effective_user.id not in ADMIN_IDS:
@@ -721,58 +3477,316 @@ async def order_details_handler(update: Update, context: ContextTypes.DEFAULT_TY
     if not args:
         await update.message.reply_text("Используйте: /order_details <order_id>")
         return
-    order_id = args[0]
-    with get_db_connection() as conn:
-        cur = conn.cursor()
-        cur.execute("SELECT * FROM orders WHERE order_id=?", (order_id,))
-        order = cur.fetchone()
-    if not order:
+    # Код заказа сразу даёт ключ; UUID старых заказов ищутся через БД
+    key = parse_order_code(args[0])
+    if key is None:
+        order = await db_get_order(args[0])
+        key = order["id"] if order else None
+    card = await get_order_card(key) if key is not None else None
+    if card is None:
         await update.message.reply_text("Заказ не найден.")
         return
-    discount_value = order["discount"] if order["discount"] is not None else 0
-    details = (
-        f"ID: {order['order_id']}\n"
-        f"Пользователь: {order['username']} (ID: {order['user_id']})\n"
-        f"Категория: {order['category']}\n"
-        f"Цена: {order['price_yuan']}\n"
-        f"Комиссия: {order['commission']}\n"
-        f"Итог: {order['final_price']}\n"
-        f"Название: {order['order_name']}\n"
-        f"Ссылка: {order['order_link']}\n"
-        f"Статус: {order['status']}\n"
-        f"Дата: {order['created_at']}\n"
-        f"Квитанция: {'Да' if order['receipt'] else 'Нет'}\n"
-        f"Скидка: {discount_value}₽\n"
-        f"Промокод: {order['promo_code_used'] if order['promo_code_used'] is not None else '-'}"
+    await update.message.reply_text(card.text)
+
+# /find <запрос> — поиск заказов по названию, ссылке, username и ID.
+# Слова ищутся по префиксу: «найк эйр», «@ivan», «01J8» или кусок ссылки
+async def find_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if update.effective_user.id not in ADMIN_IDS:
+        await update.message.reply_text("Нет доступа.")
+        return
+    terms = order_search_terms(" ".join(context.args or ()))
+    if not terms:
+        await update.message.reply_text("Используйте: /find <название, ссылка, username или ID заказа>")
+        return
+    rows = await db_search_orders(terms)
+    if not rows:
+        await update.message.reply_text("Ничего не найдено.")
+        return
+    keyboard = [[InlineKeyboardButton(f"{order['order_id']}, {order['order_name']} — {order['status']}",
+                                      callback_data=encode_callback(CB_ADMIN_ORDER, order["id"]))]
+                for order in rows]
+    await update.message.reply_text(f"Найдено заказов: {len(rows)}", reply_markup=InlineKeyboardMarkup(keyboard))
+
+# /bulk_status <новый статус> [ids=ID,ID,...] [status=<текущий>] [from=ГГГГ-ММ-ДД] [to=ГГГГ-ММ-ДД]
+async def bulk_status_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if update.effective_user.id not in ADMIN_IDS:
+        await update.message.reply_text("Нет доступа.")
+        return
+    statuses = ", ".join(f"{i}={s.replace(' ', '_')}" for i, s in enumerate(ORDER_STATUSES, 1))
+    usage = (
+        "Используйте: /bulk_status <новый статус> [ids=ID,ID,...] [status=<текущий>] "
+        "[from=ГГГГ-ММ-ДД] [to=ГГГГ-ММ-ДД]\n"
+        f"Статусы: {statuses}"
+    )
+    args = context.args
+    new_status = parse_status_arg(args[0]) if args else None
+    if new_status is None:
+        await update.message.reply_text(usage)
+        return
+    try:
+        conditions = parse_order_filters(args[1:], ("ids", "status", "from", "to"))
+    except ValueError as e:
+        await update.message.reply_text(f"{e}\n{usage}")
+        return
+    if not conditions:
+        await update.message.reply_text("Укажите хотя бы один фильтр: ids, status, from или to.\n" + usage)
+        return
+    changed, message_ids, unmatched = await db_bulk_update_order_status(new_status, **conditions)
+    if unmatched:
+        shown = ", ".join(unmatched[:BULK_UNMATCHED_SHOWN])
+        more = f" и ещё {len(unmatched) - BULK_UNMATCHED_SHOWN}" if len(unmatched) > BULK_UNMATCHED_SHOWN else ""
+        await update.message.reply_text(f"Не найдены заказы: {shown}{more}")
+    if not changed:
+        await update.message.reply_text("Нет заказов для обновления.")
+        return
+    outbox.wake()
+    progress = await update.message.reply_text(
+        f"Статус '{new_status}' установлен для {len(changed)} заказов. Отправляем уведомления…"
+    )
+    start_outbox_progress(progress, message_ids, f"Статус '{new_status}': {len(changed)} заказов.")
+
+async def stats_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if update.effective_user.id not in ADMIN_IDS:
+        await update.message.reply_text("Нет доступа.")
+        return
+    titles = {"handler": "Обработчики", "callback": "Кнопки", "db": "БД", "telegram_api": "Bot API"}
+    lines = []
+    for kind in Metrics.KINDS:
+        lines.append(f"{titles[kind]} (вызовов, среднее / p95 / max, мс, ошибок, сейчас):")
+        for name, h in metrics.top(kind, STATS_TOP_LIMIT):
+            errors = metrics.errors.get((kind, name), 0)
+            in_flight = metrics.in_flight.get((kind, name), 0)
+            lines.append(
+                f"  {name}: {h.count}, {h.sum / h.count * 1000:.1f} / {h.quantile(0.95) * 1000:.0f} / "
+                f"{h.max * 1000:.0f}, {errors}, {in_flight}"
+            )
+        lines.append("")
+    lines.append(rate_limiter.stats_text())
+    if isinstance(context.application.update_processor, KeyedUpdateProcessor):
+        lines.append(context.application.update_processor.stats_text())
+    lines.append(order_cards.stats_text())
+    lines.append(user_summaries.stats_text())
+    archive = await db_get_media_archive_stats()
+    lines.append(
+        f"Архив фото: сохранено {archive['archived']} ({archive['files']} файлов), "
+        f"в очереди {archive['pending']}, ошибок {archive['failed']}"
+    )
+    await update.message.reply_text("\n".join(lines)[:TELEGRAM_MESSAGE_LIMIT])
+
+async def ratelimit_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if update.effective_user.id not in ADMIN_IDS:
+        await update.message.reply_text("Нет доступа.")
+        return
+    await update.message.reply_text(rate_limiter.stats_text())
+
+# ----- Правила ценообразования -----
+
+def pricing_rules_text(rules: PricingRules) -> str:
+    data = rules.to_dict()
+    lines = [f"Правила цен, версия {rules.version}", f"Курс: {rules.rate}", f"Округление: {rules.rounding:.2f}"]
+    for category, spec in sorted(data["commission"].items()):
+        tiers = ", ".join(f"> {float(threshold):.2f}¥: {float(value):.2f}₽" for threshold, value in spec.get("tiers", []))
+        lines.append(f"{'по умолчанию' if category == '*' else category}: {float(spec['base']):.2f}₽" + (f"; {tiers}" if tiers else ""))
+    return "\n".join(lines)
+
+async def pricing_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if update.effective_user.id not in ADMIN_IDS:
+        await update.message.reply_text("Нет доступа.")
+        return
+    await update.message.reply_text(pricing_rules_text(await pricing.current()))
+
+async def apply_pricing_change(update: Update, change: Callable[[Dict[str, Any]], None]) -> None:
+    try:
+        rules = await pricing.update(change, update.effective_user.id)
+    except ValueError as e:
+        await update.message.reply_text(f"Правила не изменены: {e}")
+        return
+    await update.message.reply_text(pricing_rules_text(rules))
+
+async def setrate_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if update.effective_user.id not in ADMIN_IDS:
+        await update.message.reply_text("Нет доступа.")
+        return
+    try:
+        rate = float(context.args[0].replace(",", "."))
+    except (IndexError, ValueError):
+        await update.message.reply_text("Используйте: /setrate <курс юаня>")
+        return
+    await apply_pricing_change(update, lambda rules: rules.update(rate=rate))
+
+async def setrounding_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if update.effective_user.id not in ADMIN_IDS:
+        await update.message.reply_text("Нет доступа.")
+        return
+    try:
+        rounding = float(context.args[0])
+    except (IndexError, ValueError):
+        await update.message.reply_text("Используйте: /setrounding <шаг в рублях, 0 — без округления>")
+        return
+    await apply_pricing_change(update, lambda rules: rules.update(rounding=rounding))
+
+# /setcommission <категория|*> <база> [порог:комиссия ...]; "-" вместо базы удаляет категорию
+async def setcommission_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if update.effective_user.id not in ADMIN_IDS:
+        await update.message.reply_text("Нет доступа.")
+        return
+    usage = (
+        "Используйте: /setcommission <категория|*> <комиссия> [порог:комиссия ...]\n"
+        "Например: /setcommission Обувь 1500 3000:2500 10000:4000\n"
+        "/setcommission Обувь - — вернуть категории комиссию по умолчанию"
+    )
+    args = context.args
+    if len(args) < 2 or (args[0] != "*" and args[0] not in CATEGORIES):
+        await update.message.reply_text(usage)
+        return
+    category = args[0]
+    if args[1] == "-":
+        if category == "*":
+            await update.message.reply_text(usage)
+            return
+        await apply_pricing_change(update, lambda rules: rules["commission"].pop(category, None))
+        return
+    try:
+        spec = {
+            "base": float(args[1]),
+            "tiers": [[float(t) for t in arg.split(":", 1)] for arg in args[2:]],
+        }
+    except ValueError:
+        await update.message.reply_text(usage)
+        return
+    if any(len(tier) != 2 for tier in spec["tiers"]):
+        await update.message.reply_text(usage)
+        return
+    await apply_pricing_change(update, lambda rules: rules["commission"].__setitem__(category, spec))
+
+# Пересчёт всех заказов по текущим правилам: сколько заказов изменились бы
+# и на какую сумму (без учёта скидок)
+async def reprice_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if update.effective_user.id not in ADMIN_IDS:
+        await update.message.reply_text("Нет доступа.")
+        return
+    rules = await pricing.current()
+    total = changed = 0
+    recorded_sum = repriced_sum = 0.0
+    batch: List[sqlite3.Row] = []
+
+    def flush() -> None:
+        nonlocal total, changed, recorded_sum, repriced_sum
+        quotes = rules.quote_many([(row["category"], row["price_yuan"] or 0) for row in batch])
+        for row, (_, final_price) in zip(batch, quotes):
+            recorded = (row["final_price"] or 0) + (row["discount"] or 0)
+            total += 1
+            recorded_sum += recorded
+            repriced_sum += final_price
+            if abs(recorded - final_price) > 0.005:
+                changed += 1
+        batch.clear()
+
+    async for row in db_iter_orders(columns=("category", "price_yuan", "final_price", "discount")):
+        batch.append(row)
+        if len(batch) >= ORDERS_BATCH_SIZE:
+            flush()
+    flush()
+    await update.message.reply_text(
+        f"Пересчёт по правилам версии {rules.version}:\n"
+        f"Заказов: {total}, цена изменилась бы у {changed}\n"
+        f"Сумма без скидок: {recorded_sum:.2f}₽ → {repriced_sum:.2f}₽ ({repriced_sum - recorded_sum:+.2f}₽)"
     )
-    await update.message.reply_text(details)
+
+# /export [status=<статус>] [from=ГГГГ-ММ-ДД] [to=ГГГГ-ММ-ДД] [user=<user_id>] — заказы в .csv.gz
+async def export_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if update.effective_user.id not in ADMIN_IDS:
+        await update.message.reply_text("Нет доступа.")
+        return
+    try:
+        conditions = parse_order_filters(context.args, ("status", "from", "to", "user"))
+    except ValueError as e:
+        await update.message.reply_text(
+            f"{e}\nИспользуйте: /export [status=<статус>] [from=ГГГГ-ММ-ДД] [to=ГГГГ-ММ-ДД] [user=<user_id>]"
+        )
+        return
+    await update.message.reply_text("Готовлю выгрузку…")
+    filename = f"orders_{datetime.now():%Y%m%d_%H%M%S}.csv.gz"
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, filename)
+        rows = await db_export_orders(path, **conditions)
+        if rows == 0:
+            await update.message.reply_text("Нет заказов для выгрузки.")
+            return
+        if os.path.getsize(path) > TELEGRAM_DOCUMENT_LIMIT:
+            await update.message.reply_text(
+                "Выгрузка больше 50 МБ и не может быть отправлена в Telegram. "
+                "Сузьте фильтры или используйте на сервере: python bot.py export"
+            )
+            return
+        with open(path, "rb") as f:
+            await update.message.reply_document(document=f, filename=filename, caption=f"Заказов: {rows}")
+
+async def rebuild_stats_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if update.effective_user.id not in ADMIN_IDS:
+        await update.message.reply_text("Нет доступа.")
+        return
+    await db_rebuild_order_stats()
+    await update.message.reply_text("Агрегаты аналитики пересчитаны.")
+
+# /bonus_history <user_id> — журнал бонусов пользователя и сверка баланса
+async def bonus_history_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if update.effective_user.id not in ADMIN_IDS:
+        await update.message.reply_text("Нет доступа.")
+        return
+    args = context.args
+    if not args or not args[0].isdigit():
+        await update.message.reply_text("Используйте: /bonus_history <user_id>")
+        return
+    user_id = int(args[0])
+    user_data = await db_get_user(user_id)
+    history = await db_get_bonus_history(user_id)
+    lines = [f"Бонусы пользователя {user_id}: {user_data['bonus'] if user_data else 0}₽\n"]
+    for entry in history:
+        checkout = f" (заказ #{entry['checkout_id']})" if entry["checkout_id"] else ""
+        lines.append(f"{entry['created_at'][:16]} {entry['amount']:+}₽ — {entry['reason']}{checkout}")
+    mismatches = await db_audit_bonus_balances()
+    if mismatches:
+        lines.append(f"\n⚠️ Расхождения баланса с журналом: {len(mismatches)} польз.")
+    await update.message.reply_text("\n".join(lines))
 
 async def addpromo_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if update.effective_user.id not in ADMIN_IDS:
         await update.message.reply_text("Нет доступа.")
         return
     args = context.args
-    if len(args) < 3:
-        await update.message.reply_text("Используйте: /addpromo <код> <тип: one-time/multi> <скидка>")
+    usage = "Используйте: /addpromo <код> <тип: one-time/multi> <скидка> [макс. использований] [действует до ГГГГ-ММ-ДД]"
+    if len(args) < 3 or args[1] not in PROMO_TYPES:
+        await update.message.reply_text(usage)
         return
     code = args[0]
     promo_type = args[1]
     try:
         discount = int(args[2])
+        max_uses = int(args[3]) if len(args) > 3 and args[3] != "-" else None
+        expires_at = datetime.strptime(args[4], "%Y-%m-%d").replace(hour=23, minute=59, second=59).isoformat() if len(args) > 4 else None
     except ValueError:
-        await update.message.reply_text("Скидка должна быть числом.")
+        await update.message.reply_text("Скидка и лимит должны быть числами, дата — в формате ГГГГ-ММ-ДД.")
         return
-    promo_codes[code] = {"type": promo_type, "discount": discount, "used_by": set()}
+    await db_upsert_promo(code, promo_type, discount, max_uses, expires_at)
+    promo_cache.invalidate(code)
     await update.message.reply_text(f"Промокод {code} добавлен.")
 
 async def listpromos_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if update.effective_user.id not in ADMIN_IDS:
         await update.message.reply_text("Нет доступа.")
         return
-    text = "Активные промокоды:\n"
-    for code, d in promo_codes.items():
-        text += f"{code} – тип: {d['type']}, скидка: {d['discount']}₽, использован: {len(d['used_by'])} раз(а)\n"
-    await update.message.reply_text(text)
+
+    async def lines() -> AsyncIterator[str]:
+        for d in await db_list_promos():
+            limit = d["max_uses"] if d["max_uses"] is not None else "∞"
+            expires = d["expires_at"][:10] if d["expires_at"] else "бессрочно"
+            yield (f"{d['code']} – тип: {d['type']}, скидка: {d['discount']}₽, "
+                   f"использован: {d['uses']}/{limit} раз(а), до: {expires}\n")
+
+    sent = await send_chunked(update.message.reply_text, lines(), header="Промокоды:\n")
+    if sent == 0:
+        await update.message.reply_text("Промокодов нет.")
 
 # ================= Команды поддержки и меню =================
 
@@ -782,13 +3796,299 @@ async def menu_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
 async def support_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     await update.message.reply_text("Свяжитесь с нашим менеджером: t.me/blvck_td")
 
+# ================= Маршрутизация кнопок =================
+
+class CallbackRoute:
+    __slots__ = ("name", "handler", "arity", "admin_only")
+
+    def __init__(self, handler: Callable[..., Awaitable[None]], arity: int = 0, admin_only: bool = False) -> None:
+        self.name = handler.__name__
+        self.handler = handler
+        self.arity = arity
+        self.admin_only = admin_only
+
+# Номер действия из encode_callback -> обработчик. Аргументы передаются
+# обработчику позиционно после update и context.
+CALLBACK_ROUTES: Dict[int, CallbackRoute] = {
+    CB_PERSONAL_CABINET: CallbackRoute(personal_cabinet_handler),
+    CB_CABINET_HISTORY: CallbackRoute(cabinet_history_callback, 1),
+    CB_REFERRAL_PROGRAM: CallbackRoute(referral_program_callback),
+    CB_NEW_CALC_CABINET: CallbackRoute(new_calc_cabinet_callback),
+    CB_CONFIRM_PAYMENT: CallbackRoute(payment_confirmation_callback),
+    CB_ADMIN_MAIN: CallbackRoute(admin_main_menu_handler, admin_only=True),
+    CB_ADMIN_PROMOS: CallbackRoute(admin_promos_menu_callback, admin_only=True),
+    CB_ADMIN_ANALYTICS: CallbackRoute(admin_analytics_callback, admin_only=True),
+    CB_ADMIN_ORDERS: CallbackRoute(admin_orders_list_handler, 4, admin_only=True),
+    CB_ADMIN_ORDERS_FILTER: CallbackRoute(admin_orders_filter_handler, 3, admin_only=True),
+    CB_ADMIN_ORDER: CallbackRoute(admin_order_callback, 1, admin_only=True),
+    CB_ORDER_STATUS: CallbackRoute(update_order_status_callback, 2, admin_only=True),
+    CB_ADMIN_PROMO_LIST: CallbackRoute(admin_promo_list_callback, admin_only=True),
+    CB_ADMIN_PROMO_ADD: CallbackRoute(admin_promo_add_callback, admin_only=True),
+    CB_ORDER_MEDIA: CallbackRoute(admin_order_media_callback, 2, admin_only=True),
+}
+
+def resolve_callback(data: str) -> Optional[Tuple[CallbackRoute, List[Optional[int]]]]:
+    try:
+        action, args = decode_callback(data)
+    except (ValueError, binascii.Error):
+        return None
+    route = CALLBACK_ROUTES.get(action)
+    if route is None or len(args) != route.arity:
+        return None
+    return route, args
+
+# Единственный обработчик закодированных кнопок: разбирает callback_data,
+# проверяет доступ к админским действиям и вызывает обработчик из таблицы
+async def callback_dispatcher(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    query = update.callback_query
+    resolved = resolve_callback(query.data)
+    if resolved is None:
+        await stale_callback_handler(update, context)
+        return
+    route, args = resolved
+    if route.admin_only and update.effective_user.id not in ADMIN_IDS:
+        await query.answer("Нет доступа.", show_alert=True)
+        return
+    with metrics.track("callback", route.name):
+        await route.handler(update, context, *args)
+
+# Кнопки, которые больше ничем не обрабатываются: старые форматы callback_data
+# и клавиатуры завершённых диалогов
+async def stale_callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    await update.callback_query.answer("Кнопка устарела, откройте меню заново.", show_alert=True)
+
+# ================= Вебхук =================
+
+# Встроенный HTTP-сервер на h11 для режима вебхука. Проверяет секрет из
+# X-Telegram-Bot-Api-Secret-Token, одновременно обрабатывает не больше
+# max_concurrency запросов и отвечает 503, когда в очереди Application скопилось
+# больше max_pending обновлений (Telegram повторит доставку позже).
+# stop() перестаёт принимать соединения и дожидается запросов в обработке.
+class WebhookServer:
+    def __init__(self, application: Application, url_path: str, secret_token: Optional[str],
+                 listen: str = WEBHOOK_LISTEN, port: int = WEBHOOK_PORT,
+                 max_concurrency: int = WEBHOOK_MAX_CONCURRENCY,
+                 max_pending: int = WEBHOOK_MAX_PENDING) -> None:
+        self.application = application
+        self.url_path = url_path
+        self.secret_token = secret_token
+        self.listen = listen
+        self.port = port
+        self.max_pending = max_pending
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._server: Optional[asyncio.base_events.Server] = None
+        self._connections: Set[asyncio.Task] = set()
+        self._in_flight = 0
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._closing = False
+
+    async def start(self) -> None:
+        self._server = await asyncio.start_server(self._handle_connection, self.listen, self.port)
+        if not self.port:
+            self.port = self._server.sockets[0].getsockname()[1]
+        logger.info("Вебхук слушает http://%s:%s%s", self.listen, self.port, self.url_path)
+
+    async def stop(self, timeout: float = WEBHOOK_DRAIN_TIMEOUT) -> None:
+        self._closing = True
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning("Вебхук: не дождались %s запросов при остановке", self._in_flight)
+        for task in list(self._connections):
+            task.cancel()
+        await asyncio.gather(*self._connections, return_exceptions=True)
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        task = asyncio.current_task()
+        self._connections.add(task)
+        conn = h11.Connection(h11.SERVER, max_incomplete_event_size=WEBHOOK_MAX_BODY)
+        try:
+            while not self._closing:
+                event = await self._next_event(conn, reader)
+                if not isinstance(event, h11.Request):
+                    break
+                self._in_flight += 1
+                self._idle.clear()
+                try:
+                    status = await self._handle_request(conn, reader, event)
+                    headers = [("content-length", "0")]
+                    if self._closing:
+                        headers.append(("connection", "close"))
+                    writer.write(conn.send(h11.Response(status_code=status, headers=headers)))
+                    writer.write(conn.send(h11.EndOfMessage()))
+                    await writer.drain()
+                finally:
+                    self._in_flight -= 1
+                    if self._in_flight == 0:
+                        self._idle.set()
+                if conn.our_state is h11.MUST_CLOSE:
+                    break
+                conn.start_next_cycle()
+        except (h11.ProtocolError, ConnectionError) as e:
+            logger.debug("Вебхук: соединение закрыто с ошибкой: %s", e)
+        except asyncio.CancelledError:
+            pass
+        finally:
+            self._connections.discard(task)
+            writer.close()
+
+    async def _next_event(self, conn: h11.Connection, reader: asyncio.StreamReader) -> Any:
+        while True:
+            event = conn.next_event()
+            if event is not h11.NEED_DATA:
+                return event
+            conn.receive_data(await reader.read(65536))
+
+    async def _handle_request(self, conn: h11.Connection, reader: asyncio.StreamReader, request: h11.Request) -> int:
+        body = bytearray()
+        while True:
+            event = await self._next_event(conn, reader)
+            if isinstance(event, h11.Data):
+                body += event.data
+                if len(body) > WEBHOOK_MAX_BODY:
+                    return 413
+            elif isinstance(event, h11.EndOfMessage):
+                break
+            else:
+                return 400
+        if request.target.decode().split("?", 1)[0] != self.url_path:
+            return 404
+        if request.method != b"POST":
+            return 405
+        headers = dict(request.headers)
+        received_secret = headers.get(b"x-telegram-bot-api-secret-token", b"").decode()
+        if self.secret_token and not secrets.compare_digest(received_secret, self.secret_token):
+            return 403
+        if self.application.update_queue.qsize() >= self.max_pending:
+            return 503
+        async with self._semaphore:
+            try:
+                update = Update.de_json(json.loads(body), self.application.bot)
+            except (ValueError, TypeError, KeyError) as e:
+                logger.warning("Вебхук: некорректное обновление: %s", e)
+                return 400
+            await self.application.update_queue.put(update)
+        return 200
+
+async def run_webhook(application: Application, args: argparse.Namespace) -> None:
+    secret_token = args.secret_token or secrets.token_urlsafe(32)
+    server = WebhookServer(application, args.url_path, secret_token, args.listen, args.port, args.max_concurrency)
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+    await application.initialize()
+    try:
+        await application.bot.set_webhook(
+            url=args.webhook_url, secret_token=secret_token,
+            max_connections=args.max_concurrency, allowed_updates=Update.ALL_TYPES,
+        )
+        await application.start()
+        await on_startup(application)
+        await server.start()
+        await stop_event.wait()
+        logger.info("Остановка: дожидаемся обработки принятых обновлений")
+    finally:
+        await server.stop()
+        if application.running:
+            await application.stop()
+        await application.shutdown()
+        await on_shutdown(application)
+
 # ================= Основной запуск =================
 
+async def on_startup(application: Application) -> None:
+    await pricing.reload()
+    outbox.start(application.bot)
+    media_archiver.start(application.bot)
+    await metrics_server.start()
+
+async def on_shutdown(application: Application) -> None:
+    await metrics_server.stop()
+    await media_archiver.stop()
+    await cancel_outbox_progress()
+    await outbox.stop()
+    storage.close()
+
+def rebuild_stats_command(args: argparse.Namespace) -> None:
+    conn = get_db_connection()
+    try:
+        with conn:
+            _rebuild_order_stats(conn)
+    finally:
+        conn.close()
+    logger.info("Агрегаты аналитики пересчитаны")
+
+def export_command(args: argparse.Namespace) -> None:
+    try:
+        conditions = parse_order_filters(args.filters, ("status", "from", "to", "user"))
+    except ValueError as e:
+        sys.exit(str(e))
+    conn = get_db_connection()
+    try:
+        rows = _export_orders(conn, args.output, **conditions)
+    finally:
+        conn.close()
+    logger.info("Выгружено заказов: %s в %s", rows, args.output)
+
 def main() -> None:
+    parser = argparse.ArgumentParser(description="Telegram-бот BuyZon")
+    commands = parser.add_subparsers(dest="command")
+    run_parser = commands.add_parser("run", help="запустить бота (по умолчанию)")
+    run_parser.add_argument("--webhook-url", help="публичный URL вебхука; без него бот работает через polling")
+    run_parser.add_argument("--listen", default=WEBHOOK_LISTEN)
+    run_parser.add_argument("--port", type=int, default=WEBHOOK_PORT)
+    run_parser.add_argument("--url-path", default=WEBHOOK_PATH)
+    run_parser.add_argument("--secret-token", help="секрет для X-Telegram-Bot-Api-Secret-Token (по умолчанию случайный)")
+    run_parser.add_argument("--max-concurrency", type=int, default=WEBHOOK_MAX_CONCURRENCY)
+    run_parser.add_argument("--metrics-port", type=int, default=METRICS_PORT, help="порт эндпоинта метрик Prometheus (0 — отключить)")
+    run_parser.add_argument("--update-concurrency", type=int, default=UPDATE_CONCURRENCY,
+                            help="сколько обновлений разных пользователей обрабатывать одновременно")
+    commands.add_parser("rebuild-stats", help="пересчитать агрегаты аналитики из orders")
+    export_parser = commands.add_parser("export", help="выгрузить заказы в .csv.gz")
+    export_parser.add_argument("output", help="путь к файлу .csv.gz")
+    export_parser.add_argument("filters", nargs="*", help="фильтры как у /export: status=, from=, to=, user=")
+    args = parser.parse_args(sys.argv[1:] or ["run"])
     init_db()
-    application = Application.builder().token(botkey).build()
+    if args.command == "rebuild-stats":
+        rebuild_stats_command(args)
+        return
+    if args.command == "export":
+        export_command(args)
+        return
+    run_bot(args)
+
+def run_bot(args: argparse.Namespace) -> None:
+    storage.open()
+    metrics_server.port = args.metrics_port
+    if args.webhook_url:
+        application = build_application(Application.builder().updater(None), args.update_concurrency)
+        asyncio.run(run_webhook(application, args))
+    else:
+        application = build_application(Application.builder().post_init(on_startup).post_shutdown(on_shutdown),
+                                        args.update_concurrency)
+        application.run_polling()
+
+def build_application(builder: ApplicationBuilder, update_concurrency: int = UPDATE_CONCURRENCY) -> Application:
+    application = (
+        builder
+        .token(botkey)
+        .request(InstrumentedRequest(connection_pool_size=TELEGRAM_CONNECTION_POOL_SIZE))
+        .persistence(SQLitePersistence())
+        .concurrent_updates(KeyedUpdateProcessor(update_concurrency))
+        .build()
+    )
+
+    # Группа -1 выполняется раньше всех остальных обработчиков
+    application.add_handler(TypeHandler(Update, rate_limiter), group=-1)
 
     conv_handler = ConversationHandler(
+        name="order",
+        persistent=True,
         entry_points=[CommandHandler("start", start)],
         states={
             CHOOSING_CATEGORY: [CallbackQueryHandler(category_chosen)],
@@ -810,25 +4110,32 @@ def main() -> None:
     application.add_handler(CommandHandler("calculate", calculate_price))
     application.add_handler(CommandHandler("support", support_handler))
     
-    # Обработчик кнопок личного кабинета
-    application.add_handler(CallbackQueryHandler(
-        personal_cabinet_menu_handler, pattern=r"^(cabinet_history|referral_program|new_calc_cabinet|personal_cabinet)$"
-    ))
+    # Все кнопки вне диалога заказа — через таблицу CALLBACK_ROUTES
+    application.add_handler(CallbackQueryHandler(callback_dispatcher, pattern=is_encoded_callback))
     
     # Админ-команды (доступ проверяется в функциях)
     application.add_handler(CommandHandler("admin", admin_main_menu_handler))
-    application.add_handler(CallbackQueryHandler(admin_menu_handler, pattern=r"^(admin_main|admin_menu_orders|admin_menu_promos|admin_menu_analytics)$"))
-    application.add_handler(CallbackQueryHandler(admin_orders_list_handler, pattern=r"^admin_orders_list$"))
-    application.add_handler(CallbackQueryHandler(admin_order_callback, pattern=r"^admin_order:\S+"))
-    application.add_handler(CallbackQueryHandler(update_order_status_callback, pattern=r"^update:\S+:\S+"))
-    application.add_handler(CallbackQueryHandler(payment_confirmation_callback, pattern=r"^confirm_payment$"))
     application.add_handler(CommandHandler("orders_status", orders_status_handler))
     application.add_handler(CommandHandler("order_details", order_details_handler))
+    application.add_handler(CommandHandler("find", find_handler))
+    application.add_handler(CommandHandler("rebuild_stats", rebuild_stats_handler))
+    application.add_handler(CommandHandler("bulk_status", bulk_status_handler))
+    application.add_handler(CommandHandler("ratelimit", ratelimit_handler))
+    application.add_handler(CommandHandler("stats", stats_handler))
+    application.add_handler(CommandHandler("pricing", pricing_handler))
+    application.add_handler(CommandHandler("setrate", setrate_handler))
+    application.add_handler(CommandHandler("setrounding", setrounding_handler))
+    application.add_handler(CommandHandler("setcommission", setcommission_handler))
+    application.add_handler(CommandHandler("reprice", reprice_handler))
+    application.add_handler(CommandHandler("export", export_handler))
+    application.add_handler(CommandHandler("bonus_history", bonus_history_handler))
     application.add_handler(CommandHandler("addpromo", addpromo_handler))
     application.add_handler(CommandHandler("listpromos", listpromos_handler))
     
     application.add_handler(conv_handler)
-    application.run_polling()
+    application.add_handler(CallbackQueryHandler(stale_callback_handler))
+    instrument_handlers(application)
+    return application
 
 if __name__ == '__main__':
     main()